@@ -1,50 +1,51 @@
 import os
 import pandas as pd
-import geopandas as gpd
-from flask import Flask, jsonify, render_template, request
+from flask import Blueprint, Flask, current_app, jsonify, render_template, request
 import json
+import hashlib
+import hmac
 from datetime import datetime
-from sklearn.linear_model import LinearRegression
 import numpy as np
 import warnings
+import threading
+import functools
+import time
+import shutil
+import pickle
+import sys
+import io
+import tempfile
+from collections import OrderedDict
 
-from shapely.errors import ShapelyDeprecationWarning
-warnings.filterwarnings("ignore", category=ShapelyDeprecationWarning) 
 pd.options.mode.chained_assignment = None 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-app = Flask(__name__)
-app.json.ensure_ascii = False
+# As rotas ficam no blueprint; a aplicação é montada por create_app (ver o fim do arquivo)
+bp = Blueprint('multidash', __name__)
 
-print("Iniciando o carregamento e processamento dos dados...")
-try:
-    crimes_path = os.path.join(BASE_DIR, 'crimes.csv')
-    municipios_path = os.path.join(BASE_DIR, 'municipios_ce.geojson')
-    populacao_path = os.path.join(BASE_DIR, 'populacao_ce.csv')
-
-    df_crimes_raw = pd.read_csv(crimes_path, sep=',')
-    gdf_municipios_raw = gpd.read_file(municipios_path)
-    df_populacao = pd.read_csv(populacao_path)
-    
-    df_crimes_raw.columns = [
-        'AIS', 'NATUREZA', 'MUNICIPIO', 'LOCAL', 'DATA', 'HORA', 'DIA_SEMANA',
-        'MEIO_EMPREGADO', 'GENERO', 'ORIENTACAO_SEXUAL', 'IDADE_VITIMA',
-        'ESCOLARIDADE_VITIMA', 'RACA_VITIMA'
-    ]
-except FileNotFoundError as e:
-    print(f"ERRO CRÍTICO: Arquivo não encontrado - {e}.")
-    exit()
-except Exception as e:
-    print(f"ERRO ao ler os arquivos CSV. Verifique o separador (deve ser vírgula) e o número de colunas. Erro: {e}")
-    exit()
-
-df_crimes_raw['DATA'] = pd.to_datetime(df_crimes_raw['DATA'], dayfirst=True, errors='coerce')
-df_crimes_raw.dropna(subset=['DATA'], inplace=True)
-df_crimes_graficos = df_crimes_raw.copy()
-df_crimes_graficos['ANO'] = df_crimes_graficos['DATA'].dt.year
-df_crimes_graficos['MES'] = df_crimes_graficos['DATA'].dt.month
+municipios_ais_map = {'Fortaleza': 'AIS 1-10', 'Caucaia': 'AIS 11', 'Maracanaú': 'AIS 12', 'Aquiraz': 'AIS 13', 'Cascavel': 'AIS 13', 'Eusébio': 'AIS 13', 'Pindoretama': 'AIS 13', 'Alcântaras': 'AIS 14', 'Barroquinha': 'AIS 14', 'Camocim': 'AIS 14', 'Cariré': 'AIS 14', 'Carnaubal': 'AIS 14', 'Chaval': 'AIS 14', 'Coreaú': 'AIS 14', 'Croatá': 'AIS 14', 'Forquilha': 'AIS 14', 'Frecheirinha': 'AIS 14', 'Graça': 'AIS 14', 'Granja': 'AIS 14', 'Groaíras': 'AIS 14', 'Guaraciaba do Norte': 'AIS 14', 'Ibiapina': 'AIS 14', 'Martinópole': 'AIS 14', 'Massapê': 'AIS 14', 'Meruoca': 'AIS 14', 'Moraújo': 'AIS 14', 'Mucambo': 'AIS 14', 'Pacujá': 'AIS 14', 'Santana do Acaraú': 'AIS 14', 'São Benedito': 'AIS 14', 'Senador Sá': 'AIS 14', 'Sobral': 'AIS 14', 'Tianguá': 'AIS 14', 'Ubajara': 'AIS 14', 'Uruoca': 'AIS 14', 'Viçosa do Ceará': 'AIS 14', 'Acarape': 'AIS 15', 'Aracoiaba': 'AIS 15', 'Aratuba': 'AIS 15', 'Barreira': 'AIS 15', 'Baturité': 'AIS 15', 'Boa Viagem': 'AIS 15', 'Canindé': 'AIS 15', 'Capistrano': 'AIS 15', 'Caridade': 'AIS 15', 'Guaramiranga': 'AIS 15', 'Itapiúna': 'AIS 15', 'Itatira': 'AIS 15', 'Madalena': 'AIS 15', 'Mulungu': 'AIS 15', 'Ocara': 'AIS 15', 'Pacoti': 'AIS 15', 'Palmácia': 'AIS 15', 'Paramoti': 'AIS 15', 'Redenção': 'AIS 15', 'Ararendá': 'AIS 16', 'Catunda': 'AIS 16', 'Crateús': 'AIS 16', 'Hidrolândia': 'AIS 16', 'Independência': 'AIS 16', 'Ipaporanga': 'AIS 16', 'Ipu': 'AIS 16', 'Ipueiras': 'AIS 16', 'Monsenhor Tabosa': 'AIS 16', 'Nova Russas': 'AIS 16', 'Novo Oriente': 'AIS 16', 'Pires Ferreira': 'AIS 16', 'Poranga': 'AIS 16', 'Reriutaba': 'AIS 16', 'Santa Quitéria': 'AIS 16', 'Tamboril': 'AIS 16', 'Varjota': 'AIS 16', 'Acaraú': 'AIS 17', 'Amontada': 'AIS 17', 'Apuiarés': 'AIS 17', 'Bela Cruz': 'AIS 17', 'Cruz': 'AIS 17', 'General Sampaio': 'AIS 17', 'Irauçuba': 'AIS 17', 'Itapajé': 'AIS 17', 'Itapipoca': 'AIS 17', 'Itarema': 'AIS 17', 'Jijoca de Jericoacoara': 'AIS 17', 'Marco': 'AIS 17', 'Miraíma': 'AIS 17', 'Morrinhos': 'AIS 17', 'Pentecoste': 'AIS 17', 'Tejuçuoca': 'AIS 17', 'Tururu': 'AIS 17', 'Umirim': 'AIS 17', 'Uruburetama': 'AIS 17', 'Alto Santo': 'AIS 18', 'Aracati': 'AIS 18', 'Beberibe': 'AIS 18', 'Ererê': 'AIS 18', 'Fortim': 'AIS 18', 'Icapuí': 'AIS 18', 'Iracema': 'AIS 18', 'Itaiçaba': 'AIS 18', 'Jaguaribe': 'AIS 18', 'Jaguaruana': 'AIS 18', 'Limoeiro do Norte': 'AIS 18', 'Jaguaribara': 'AIS 18', 'Palhano': 'AIS 18', 'Pereiro': 'AIS 18', 'Potiretama': 'AIS 18', 'Quixeré': 'AIS 18', 'Russas': 'AIS 18', 'São João do Jaguaribe': 'AIS 18', 'Tabuleiro do Norte': 'AIS 18', 'Abaiara': 'AIS 19', 'Altaneira': 'AIS 19', 'Antonina do Norte': 'AIS 19', 'Araripe': 'AIS 19', 'Assaré': 'AIS 19', 'Aurora': 'AIS 19', 'Barbalha': 'AIS 19', 'Barro': 'AIS 19', 'Brejo Santo': 'AIS 19', 'Campos Sales': 'AIS 19', 'Caririaçu': 'AIS 19', 'Crato': 'AIS 19', 'Farias Brito': 'AIS 19', 'Jardim': 'AIS 19', 'Jati': 'AIS 19', 'Juazeiro do Norte': 'AIS 19', 'Mauriti': 'AIS 19', 'Milagres': 'AIS 19', 'Missão Velha': 'AIS 19', 'Nova Olinda': 'AIS 19', 'Penaforte': 'AIS 19', 'Porteiras': 'AIS 19', 'Potengi': 'AIS 19', 'Salitre': 'AIS 19', 'Santana do Cariri': 'AIS 19', 'Banabuiú': 'AIS 20', 'Choró': 'AIS 20', 'Deputado Irapuan Pinheiro': 'AIS 20', 'Ibaretama': 'AIS 20', 'Ibicuitinga': 'AIS 20', 'Jaguaretama': 'AIS 20', 'Milhã': 'AIS 20', 'Morada Nova': 'AIS 20', 'Pedra Branca': 'AIS 20', 'Quixadá': 'AIS 20', 'Quixeramobim': 'AIS 20', 'Senador Pompeu': 'AIS 20', 'Solonópole': 'AIS 20', 'Acopiara': 'AIS 21', 'Baixio': 'AIS 21', 'Cariús': 'AIS 21', 'Cedro': 'AIS 21', 'Granjeiro': 'AIS 21', 'Icó': 'AIS 21', 'Iguatu': 'AIS 21', 'Ipaumirim': 'AIS 21', 'Jucás': 'AIS 21', 'Lavras da Mangabeira': 'AIS 21', 'Orós': 'AIS 21', 'Quixelô': 'AIS 21', 'Saboeiro': 'AIS 21', 'Tarrafas': 'AIS 21', 'Umari': 'AIS 21', 'Várzea Alegre': 'AIS 21', 'Aiuaba': 'AIS 22', 'Arneiroz': 'AIS 22', 'Catarina': 'AIS 22', 'Mombaça': 'AIS 22', 'Parambu': 'AIS 22', 'Piquet Carneiro': 'AIS 22', 'Quiterianópolis': 'AIS 22', 'Tauá': 'AIS 22', 'Paracuru': 'AIS 23', 'Paraipaba': 'AIS 23', 'São Gonçalo do Amarante': 'AIS 23', 'São Luís do Curu': 'AIS 23', 'Trairi': 'AIS 23', 'Guaiúba': 'AIS 24', 'Maranguape': 'AIS 24', 'Pacatuba': 'AIS 24', 'Chorozinho': 'AIS 25', 'Horizonte': 'AIS 25', 'Itaitinga': 'AIS 25', 'Pacajus': 'AIS 25'}
 mapeamento_genero = {'MASCULINO': 'Masculino', 'HOMEM TRANS': 'Masculino', 'FEMININO': 'Feminino', 'MULHER TRANS': 'Feminino', 'TRAVESTI': 'Feminino'}
-df_crimes_graficos['GENERO_AGRUPADO'] = df_crimes_graficos['GENERO'].str.upper().str.strip().map(mapeamento_genero)
+
+# Colunas filtráveis padrão do dataset de crimes (as mesmas exibidas na sidebar)
+COLUNAS_FILTRAVEIS_PADRAO = [
+    'NATUREZA', 'MUNICIPIO', 'LOCAL', 'DIA_SEMANA', 'MEIO_EMPREGADO', 
+    'GENERO', 'ORIENTACAO_SEXUAL', 'IDADE_VITIMA', 'ESCOLARIDADE_VITIMA', 'RACA_VITIMA'
+]
+
+def normalizar_colunas_texto(df, limite_cardinalidade=0.5):
+    """
+    Remove espaços das colunas de texto uma única vez, na carga, e converte as de baixa
+    cardinalidade (valores distintos <= 'limite_cardinalidade' * linhas) para Categorical.
+    Assim os filtros comparam códigos inteiros em vez de strings e a memória cai bastante.
+    """
+    for col in df.columns:
+        if not pd.api.types.is_object_dtype(df[col]):
+            continue
+        valores = df[col].where(df[col].isna(), df[col].astype(str).str.strip())
+        if valores.nunique() <= limite_cardinalidade * len(valores):
+            valores = valores.astype('category')
+        df[col] = valores
+    return df
 
 def get_clean_age_df(df_base):
     """Função auxiliar para limpar e preparar dados de idade."""
@@ -55,57 +56,1224 @@ def get_clean_age_df(df_base):
     df_idade = df_idade[(df_idade['IDADE_NUM'] >= 0) & (df_idade['IDADE_NUM'] <= 110)]
     return df_idade
 
-def apply_filters(df, filters): # Deve receber 'df' como primeiro argumento
-    """Aplica uma série de filtros de um objeto JSON a um DataFrame."""
-    df_filtered = df.copy()
+def mascara_checkbox(serie, values):
+    """Máscara booleana das linhas de 'serie' cujo valor (com strip) está em 'values'."""
+    cleaned_values = [str(v).strip() for v in values]
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        # Colunas categóricas já foram limpas na carga: traduz os valores para códigos e compara inteiros
+        codigos = serie.cat.categories.get_indexer(cleaned_values)
+        return np.isin(serie.cat.codes.to_numpy(), codigos[codigos >= 0])
+    return serie.astype(str).str.strip().isin(cleaned_values).to_numpy()
+
+def apply_filters(df, filters, indice=None): # Deve receber 'df' como primeiro argumento
+    """
+    Aplica uma série de filtros de um objeto JSON a um DataFrame.
+    Se receber o 'indice' do dataset (ver construir_indice_bitmap), combina os bitmaps pré-calculados.
+    """
+    if indice is not None:
+        return df[mascara_por_indice(df, filters, indice)]
+
+    # Monta uma única máscara e recorta o DataFrame uma vez só no final
+    mask = np.ones(len(df), dtype=bool)
 
     # Filtro de Data
     start_date = filters['dates'].get('start')
     end_date = filters['dates'].get('end')
-    if start_date and 'DATA' in df_filtered.columns:
-        df_filtered = df_filtered[df_filtered['DATA'] >= pd.to_datetime(start_date)]
-    if end_date and 'DATA' in df_filtered.columns:
-        df_filtered = df_filtered[df_filtered['DATA'] <= pd.to_datetime(end_date)]
+    if start_date and 'DATA' in df.columns:
+        mask &= (df['DATA'] >= pd.to_datetime(start_date)).to_numpy()
+    if end_date and 'DATA' in df.columns:
+        mask &= (df['DATA'] <= pd.to_datetime(end_date)).to_numpy()
 
     # Filtros de Checkbox
     for column, values in filters['checkboxes'].items():
-        if values and column in df_filtered.columns:
-            cleaned_values = [str(v).strip() for v in values]
-            df_filtered = df_filtered[df_filtered[column].astype(str).str.strip().isin(cleaned_values)]
+        if values and column in df.columns:
+            mask &= mascara_checkbox(df[column], values)
     
-    return df_filtered
+    return df[mask]
+
+# Colunas com mais valores distintos que isso não ganham bitmaps (caem na comparação de códigos)
+LIMITE_VALORES_BITMAP = 1024
+
+def construir_indice_bitmap(df):
+    """
+    Índice invertido de um dataset: para cada valor de cada coluna categórica, um bitmap
+    (np.packbits) com as linhas que têm aquele valor, mais um índice ordenado da coluna DATA
+    para responder intervalos de datas com busca binária.
+    """
+    n_linhas = len(df)
+    n_bytes_linha = (n_linhas + 7) // 8
+    linhas = np.arange(n_linhas)
+    bits_linha = (np.uint8(128) >> (linhas & 7).astype(np.uint8))
+
+    bitmaps = {}
+    for col in df.columns:
+        serie = df[col]
+        if not isinstance(serie.dtype, pd.CategoricalDtype) or len(serie.cat.categories) > LIMITE_VALORES_BITMAP:
+            continue
+        codigos = serie.cat.codes.to_numpy()
+        validos = codigos >= 0
+        bits = np.zeros((len(serie.cat.categories), n_bytes_linha), dtype=np.uint8)
+        np.bitwise_or.at(bits, (codigos[validos], linhas[validos] >> 3), bits_linha[validos])
+        bitmaps[col] = {'valores': serie.cat.categories, 'bits': bits}
+
+    indice = {'n_linhas': n_linhas, 'bitmaps': bitmaps, 'ordem_datas': None, 'datas_ordenadas': None}
+    if 'DATA' in df.columns and pd.api.types.is_datetime64_any_dtype(df['DATA']):
+        datas = df['DATA'].to_numpy()
+        ordem = np.argsort(datas, kind='stable')
+        ordem = ordem[~np.isnat(datas[ordem])]
+        indice['ordem_datas'] = ordem
+        indice['datas_ordenadas'] = datas[ordem]
+
+    indice['bytes'] = {col: b['bits'].nbytes for col, b in bitmaps.items()}
+    if indice['ordem_datas'] is not None:
+        indice['bytes']['DATA'] = indice['ordem_datas'].nbytes + indice['datas_ordenadas'].nbytes
+    return indice
+
+def anexar_ao_indice_bitmap(indice, df):
+    """
+    Estende o índice de 'df' sem reconstruí-lo: 'df' são as linhas já indexadas seguidas das novas,
+    com os dicionários categóricos apenas crescidos no fim (ver concatenar_ocorrencias). Os bitmaps
+    antigos são copiados para matrizes mais largas e só as linhas novas são marcadas; as datas novas
+    são intercaladas na ordem existente por busca binária.
+    """
+    n_antigo = indice['n_linhas']
+    n_linhas = len(df)
+    n_bytes_linha = (n_linhas + 7) // 8
+    linhas = np.arange(n_antigo, n_linhas)
+    bits_linha = (np.uint8(128) >> (linhas & 7).astype(np.uint8))
+
+    bitmaps = {}
+    for col, bitmap in indice['bitmaps'].items():
+        serie = df[col]
+        if len(serie.cat.categories) > LIMITE_VALORES_BITMAP:
+            continue
+        bits = np.zeros((len(serie.cat.categories), n_bytes_linha), dtype=np.uint8)
+        bits[:bitmap['bits'].shape[0], :bitmap['bits'].shape[1]] = bitmap['bits']
+        codigos = serie.cat.codes.to_numpy()[n_antigo:]
+        validos = codigos >= 0
+        np.bitwise_or.at(bits, (codigos[validos], linhas[validos] >> 3), bits_linha[validos])
+        bitmaps[col] = {'valores': serie.cat.categories, 'bits': bits}
+
+    novo = {'n_linhas': n_linhas, 'bitmaps': bitmaps, 'ordem_datas': None, 'datas_ordenadas': None}
+    if indice['ordem_datas'] is not None:
+        datas = df['DATA'].to_numpy()[n_antigo:]
+        ordem = np.argsort(datas, kind='stable')
+        ordem = ordem[~np.isnat(datas[ordem])]
+        posicoes = np.searchsorted(indice['datas_ordenadas'], datas[ordem], side='right')
+        novo['ordem_datas'] = np.insert(indice['ordem_datas'], posicoes, ordem + n_antigo)
+        novo['datas_ordenadas'] = np.insert(indice['datas_ordenadas'], posicoes, datas[ordem])
+
+    novo['bytes'] = {col: b['bits'].nbytes for col, b in bitmaps.items()}
+    if novo['ordem_datas'] is not None:
+        novo['bytes']['DATA'] = novo['ordem_datas'].nbytes + novo['datas_ordenadas'].nbytes
+    return novo
+
+def mascara_por_indice(df, filters, indice):
+    """Resolve os filtros com o índice: busca binária nas datas e AND/OR de bitmaps nos checkboxes."""
+    resultado = np.full((indice['n_linhas'] + 7) // 8, 255, dtype=np.uint8)
+
+    start_date = filters['dates'].get('start')
+    end_date = filters['dates'].get('end')
+    if (start_date or end_date) and indice['ordem_datas'] is not None:
+        datas = indice['datas_ordenadas']
+        inicio = np.searchsorted(datas, np.datetime64(pd.to_datetime(start_date)), side='left') if start_date else 0
+        fim = np.searchsorted(datas, np.datetime64(pd.to_datetime(end_date)), side='right') if end_date else len(datas)
+        mascara_datas = np.zeros(indice['n_linhas'], dtype=bool)
+        mascara_datas[indice['ordem_datas'][inicio:fim]] = True
+        resultado &= np.packbits(mascara_datas)
+
+    for column, values in filters['checkboxes'].items():
+        if not values or column not in df.columns:
+            continue
+        bitmap = indice['bitmaps'].get(column)
+        if bitmap is None:
+            resultado &= np.packbits(mascara_checkbox(df[column], values))
+            continue
+        codigos = bitmap['valores'].get_indexer([str(v).strip() for v in values])
+        codigos = codigos[codigos >= 0]
+        if len(codigos) == 0:
+            resultado[:] = 0
+            break
+        resultado &= np.bitwise_or.reduce(bitmap['bits'][codigos], axis=0)
+
+    return np.unpackbits(resultado, count=indice['n_linhas']).astype(bool)
+
+class SelecaoFiltrada:
+    """
+    Linhas selecionadas pelos filtros de um lote de gráficos (ver /api/batch). A máscara e o recorte são calculados
+    na primeira vez que algum gráfico precisa deles e reaproveitados pelos demais, inclusive entre threads.
+    O recorte é compartilhado: quem precisar alterá-lo deve trabalhar numa cópia.
+    """
+    def __init__(self, df_base, filters, indice):
+        self.df_base = df_base
+        self.filters = filters
+        self.indice = indice
+        self._mascara = None
+        self._df = None
+        self._lock = threading.Lock()
+
+    @property
+    def mascara(self):
+        with self._lock:
+            if self._mascara is None:
+                self._mascara = mascara_por_indice(self.df_base, self.filters, self.indice)
+            return self._mascara
+
+    @property
+    def df(self):
+        mascara = self.mascara
+        with self._lock:
+            if self._df is None:
+                self._df = self.df_base[mascara]
+            return self._df
 
 def normalize_text(text_series):
     return text_series.str.upper().str.normalize('NFKD').str.encode('ascii', errors='ignore').str.decode('utf-8')
 
-crimes_agrupados_mun = df_crimes_raw.groupby(['MUNICIPIO', 'NATUREZA']).size().reset_index(name='QUANTIDADE')
-crimes_agrupados_mun['MUNICIPIO_NORM'] = normalize_text(crimes_agrupados_mun['MUNICIPIO'])
-df_populacao['MUNICIPIO_NORM'] = normalize_text(df_populacao['municipio'])
-crimes_com_pop_mun = pd.merge(crimes_agrupados_mun, df_populacao[['MUNICIPIO_NORM', 'populacao']], on='MUNICIPIO_NORM', how='left')
-crimes_com_pop_mun.dropna(subset=['populacao'], inplace=True)
-crimes_com_pop_mun['TAXA_POR_100K'] = (crimes_com_pop_mun['QUANTIDADE'] / crimes_com_pop_mun['populacao']) * 100000
+# Níveis de detalhe das camadas do mapa: até 'zoom_max' o cliente recebe a geometria simplificada com
+# 'tolerancia' (coverage_simplify, que preserva as divisas compartilhadas) e coordenadas com 'casas' decimais.
+# O último nível (zoom_max None) é a resolução original.
+NIVEIS_GEOMETRIA = [
+    {'zoom_max': 7, 'tolerancia': 0.03, 'casas': 3},
+    {'zoom_max': 9, 'tolerancia': 0.01, 'casas': 4},
+    {'zoom_max': 11, 'tolerancia': 0.003, 'casas': 5},
+    {'zoom_max': None, 'tolerancia': 0.0, 'casas': 6},
+]
+# Resolução da grade do formato quantizado (estilo TopoJSON): 2^16 posições por eixo
+PASSOS_QUANTIZACAO = 2 ** 16 - 1
+
+def simplificar_camada(geometrias, tolerancia, casas):
+    """Simplifica uma cobertura de polígonos sem abrir frestas entre vizinhos e arredonda as coordenadas."""
+    import shapely
+    if tolerancia > 0:
+        try:
+            geometrias = shapely.coverage_simplify(geometrias, tolerancia)
+        except Exception:
+            # Camada que não é uma cobertura válida: simplificação por feição, ainda sem criar geometrias inválidas
+            geometrias = shapely.simplify(geometrias, tolerancia, preserve_topology=True)
+    return shapely.transform(geometrias, lambda coordenadas: np.round(coordenadas, casas))
+
+def quantizar_camada(gdf, coluna_id, colunas_propriedades):
+    """
+    Codificação compacta da camada: coordenadas viram inteiros numa grade sobre a caixa envolvente da camada
+    ('transform' com scale/translate, como no TopoJSON) e cada anel guarda só as diferenças entre pontos.
+    """
+    import shapely
+    minx, miny, maxx, maxy = gdf.total_bounds
+    escala = [max(maxx - minx, 1e-12) / PASSOS_QUANTIZACAO, max(maxy - miny, 1e-12) / PASSOS_QUANTIZACAO]
+
+    def anel_em_deltas(anel):
+        grade = np.round((shapely.get_coordinates(anel) - [minx, miny]) / escala).astype(np.int64)
+        return np.diff(grade, axis=0, prepend=[[0, 0]]).tolist()
+
+    def poligono_em_deltas(poligono):
+        return [anel_em_deltas(poligono.exterior)] + [anel_em_deltas(anel) for anel in poligono.interiors]
+
+    features = []
+    for id_feicao, linha in gdf.set_index(coluna_id).iterrows():
+        geometria = linha['geometry']
+        if geometria.geom_type == 'Polygon':
+            coordenadas = poligono_em_deltas(geometria)
+        else:
+            coordenadas = [poligono_em_deltas(parte) for parte in geometria.geoms]
+        features.append({
+            'id': id_feicao,
+            'properties': {col: linha[col] for col in colunas_propriedades},
+            'geometry': {'type': geometria.geom_type, 'coordinates': coordenadas}
+        })
+    return {'type': 'QuantizedFeatureCollection', 'transform': {'scale': escala, 'translate': [minx, miny]}, 'features': features}
+
+def serializar_camada_geometria(gdf, coluna_id, colunas_propriedades):
+    """
+    Serializa as geometrias de uma camada uma única vez por nível de detalhe (ver NIVEIS_GEOMETRIA), em GeoJSON
+    e no formato quantizado, usando 'coluna_id' como id de cada feição.
+    """
+    import shapely
+    niveis = []
+    for nivel in NIVEIS_GEOMETRIA:
+        simplificada = gdf.set_geometry(simplificar_camada(gdf.geometry.values, nivel['tolerancia'], nivel['casas']))
+        geojson = simplificada.set_index(coluna_id)[colunas_propriedades + ['geometry']].to_json().encode('utf-8')
+        quantizado = json.dumps(quantizar_camada(simplificada, coluna_id, colunas_propriedades),
+                                ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        niveis.append({
+            'zoom_max': nivel['zoom_max'],
+            'vertices': int(shapely.get_num_coordinates(simplificada.geometry.values).sum()),
+            'geojson': {'body': geojson, 'etag': hashlib.sha1(geojson).hexdigest()},
+            'quantizado': {'body': quantizado, 'etag': hashlib.sha1(quantizado).hexdigest()}
+        })
+    return {'niveis': niveis}
+
+def nivel_geometria(camada, zoom):
+    """Nível de detalhe adequado ao zoom (sem zoom, a resolução original)."""
+    if zoom is not None:
+        for nivel in camada['niveis']:
+            if nivel['zoom_max'] is not None and zoom <= nivel['zoom_max']:
+                return nivel
+    return camada['niveis'][-1]
+
+def url_geometria(nome_camada, nivel):
+    """URL da geometria de um nível: o zoom_max do nível (e não o zoom exato) mantém a URL estável no cache do navegador."""
+    if nivel['zoom_max'] is None:
+        return f"/api/geometry/{nome_camada}"
+    return f"/api/geometry/{nome_camada}?zoom={nivel['zoom_max']}"
+
+# Dimensões do cubo: só colunas de baixa cardinalidade, para que as células sejam bem menos numerosas que as
+# linhas. Filtros ou agrupamentos por outras colunas (LOCAL, IDADE_VITIMA...) voltam para o índice de bitmaps.
+DIMENSOES_CUBO = ['NATUREZA', 'MUNICIPIO', 'AIS', 'GENERO', 'RACA_VITIMA', 'DIA_SEMANA']
+
+def construir_cubo_contagens(df, dimensoes):
+    """
+    Pré-agrega as contagens de ocorrências por todas as 'dimensoes' + ANO/MES.
+    Cada dimensão é codificada em inteiros (valor limpo com strip, -1 para nulos),
+    então uma consulta filtrada vira uma soma de células em vez de uma varredura das linhas.
+    """
+    codigos = {}
+    categorias = {}
+    for col in dimensoes:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            # Reaproveita o dicionário da coluna categórica (já limpa na carga)
+            codigos[col], categorias[col] = df[col].cat.codes.to_numpy(), df[col].cat.categories
+            continue
+        valores = df[col].where(df[col].isna(), df[col].astype(str).str.strip())
+        codigos[col], categorias[col] = pd.factorize(valores)
+    codigos['ANO'] = df['DATA'].dt.year.to_numpy()
+    codigos['MES'] = df['DATA'].dt.month.to_numpy()
+
+    celulas = pd.DataFrame(codigos).groupby(list(codigos), sort=False).size()
+    tabela = celulas.index.to_frame(index=False)
+    colunas_celulas = {col: tabela[col].to_numpy() for col in tabela.columns}
+    return {
+        'dimensoes': dimensoes,
+        'colunas_dataset': set(df.columns),
+        'categorias': categorias,
+        'celulas': colunas_celulas,
+        'periodo': colunas_celulas['ANO'] * 12 + colunas_celulas['MES'] - 1,
+        'contagens': celulas.to_numpy(),
+        'n_linhas': len(df),
+        # O cubo tem granularidade mensal; só responde a intervalos de data exatos se DATA não tiver horário
+        'datas_sem_hora': bool((df['DATA'] == df['DATA'].dt.normalize()).all())
+    }
 
-gdf_municipios_raw['NM_MUN_NORM'] = normalize_text(gdf_municipios_raw['name'])
+def consultar_cubo(cubo, filters, agrupar_por):
+    """
+    Soma as células do cubo que atendem aos filtros, agrupando por 'agrupar_por'.
+    Retorna None quando os filtros não podem ser respondidos pelo cubo (ex.: datas
+    que não caem em limites de mês ou colunas fora das dimensões); nesse caso o
+    chamador deve voltar para o apply_filters.
+    """
+    # Agrupamentos fora das dimensões (e de ANO/MES) não podem ser respondidos pelo cubo
+    if not all(col in cubo['celulas'] for col in agrupar_por):
+        return None
 
-municipios_com_centroide = gdf_municipios_raw.copy()
-municipios_com_centroide_proj = municipios_com_centroide.to_crs('epsg:31984')
-centroides_proj = municipios_com_centroide_proj['geometry'].centroid
-municipios_com_centroide['centroid'] = centroides_proj.to_crs(gdf_municipios_raw.crs)
+    mascara = np.ones(len(cubo['contagens']), dtype=bool)
+
+    start_date = filters['dates'].get('start')
+    end_date = filters['dates'].get('end')
+    if (start_date or end_date) and not cubo['datas_sem_hora']:
+        return None
+    if start_date:
+        inicio = pd.to_datetime(start_date)
+        if inicio != inicio.normalize() or inicio.day != 1:
+            return None
+        mascara &= cubo['periodo'] >= inicio.year * 12 + inicio.month - 1
+    if end_date:
+        fim = pd.to_datetime(end_date)
+        if fim != fim.normalize() or not fim.is_month_end:
+            return None
+        mascara &= cubo['periodo'] <= fim.year * 12 + fim.month - 1
+
+    for column, values in filters['checkboxes'].items():
+        if not values or column not in cubo['colunas_dataset']:
+            continue
+        if column not in cubo['categorias']:
+            return None
+        cleaned_values = [str(v).strip() for v in values]
+        codigos = cubo['categorias'][column].get_indexer(cleaned_values)
+        mascara &= np.isin(cubo['celulas'][column], codigos[codigos >= 0])
+
+    for col in agrupar_por:
+        if col in cubo['categorias']:
+            # Mesma semântica do groupby: valores nulos não formam grupo
+            mascara &= cubo['celulas'][col] >= 0
+
+    tabela = pd.DataFrame({col: cubo['celulas'][col][mascara] for col in agrupar_por})
+    tabela['QUANTIDADE'] = cubo['contagens'][mascara]
+    resultado = tabela.groupby(agrupar_por)['QUANTIDADE'].sum()
+
+    niveis = [
+        cubo['categorias'][col][resultado.index.get_level_values(col)] if col in cubo['categorias']
+        else resultado.index.get_level_values(col)
+        for col in agrupar_por
+    ]
+    resultado.index = niveis[0].rename(agrupar_por[0]) if len(niveis) == 1 else pd.MultiIndex.from_arrays(niveis, names=agrupar_por)
+    return resultado.sort_index()
+
+def anexar_ao_cubo(cubo, df_lote):
+    """
+    Soma as ocorrências de um lote ao cubo sem revarrer o dataset: valores novos entram no fim do
+    dicionário de cada dimensão (os códigos das células existentes não mudam) e as células
+    repetidas são somadas. Retorna um novo cubo; o original continua válido para quem já o leu.
+    """
+    categorias = {}
+    codigos = {}
+    for col in cubo['dimensoes']:
+        valores = df_lote[col].astype(object)
+        valores = valores.where(valores.isna(), valores.astype(str).str.strip())
+        novos = pd.Index(valores.dropna().unique()).difference(cubo['categorias'][col])
+        categorias[col] = cubo['categorias'][col].append(novos)
+        codigos[col] = categorias[col].get_indexer(valores)
+    codigos['ANO'] = df_lote['DATA'].dt.year.to_numpy()
+    codigos['MES'] = df_lote['DATA'].dt.month.to_numpy()
+
+    antigas = pd.DataFrame(cubo['celulas'])
+    antigas['QUANTIDADE'] = cubo['contagens']
+    novas = pd.DataFrame(codigos)
+    novas['QUANTIDADE'] = 1
+    celulas = pd.concat([antigas, novas], ignore_index=True).groupby(list(codigos), sort=False)['QUANTIDADE'].sum()
+    tabela = celulas.index.to_frame(index=False)
+    colunas_celulas = {col: tabela[col].to_numpy() for col in tabela.columns}
+    return {
+        **cubo,
+        'categorias': categorias,
+        'celulas': colunas_celulas,
+        'periodo': colunas_celulas['ANO'] * 12 + colunas_celulas['MES'] - 1,
+        'contagens': celulas.to_numpy(),
+        'n_linhas': cubo['n_linhas'] + len(df_lote),
+        'datas_sem_hora': cubo['datas_sem_hora'] and bool((df_lote['DATA'] == df_lote['DATA'].dt.normalize()).all())
+    }
+
+# Nomes internos das colunas de crimes.csv, na ordem do arquivo
+COLUNAS_CRIMES = [
+    'AIS', 'NATUREZA', 'MUNICIPIO', 'LOCAL', 'DATA', 'HORA', 'DIA_SEMANA',
+    'MEIO_EMPREGADO', 'GENERO', 'ORIENTACAO_SEXUAL', 'IDADE_VITIMA',
+    'ESCOLARIDADE_VITIMA', 'RACA_VITIMA'
+]
+
+def derivar_colunas_graficos(df):
+    """Acrescenta ANO, MES e GENERO_AGRUPADO usados pelos gráficos."""
+    df['ANO'] = df['DATA'].dt.year
+    df['MES'] = df['DATA'].dt.month
+    df['GENERO_AGRUPADO'] = df['GENERO'].str.upper().str.strip().map(mapeamento_genero)
+    return df
+
+def taxas_por_municipio(crimes_agrupados_mun, df_populacao):
+    """Junta as contagens por município com a população e calcula a taxa por 100 mil habitantes."""
+    crimes_com_pop_mun = pd.merge(crimes_agrupados_mun, df_populacao[['MUNICIPIO_NORM', 'populacao']], on='MUNICIPIO_NORM', how='left')
+    crimes_com_pop_mun.dropna(subset=['populacao'], inplace=True)
+    crimes_com_pop_mun['TAXA_POR_100K'] = (crimes_com_pop_mun['QUANTIDADE'] / crimes_com_pop_mun['populacao']) * 100000
+    return crimes_com_pop_mun
+
+def taxas_por_ais(crimes_agrupados_ais, pop_por_ais):
+    """Mesmo cálculo de taxas_por_municipio, por AIS."""
+    crimes_com_pop_ais = pd.merge(crimes_agrupados_ais, pop_por_ais, left_on='AIS_MAPEADA', right_on='AIS', how='left')
+    crimes_com_pop_ais.dropna(subset=['populacao'], inplace=True)
+    crimes_com_pop_ais['TAXA_POR_100K'] = (crimes_com_pop_ais['QUANTIDADE'] / crimes_com_pop_ais['populacao']) * 100000
+    return crimes_com_pop_ais
+
+def processar_dados_crimes():
+    """
+    Executa o pré-processamento das ocorrências e da população (só pandas) e devolve um
+    dicionário com os artefatos derivados usados pelas rotas.
+    """
+    try:
+        crimes_path = os.path.join(BASE_DIR, 'crimes.csv')
+        populacao_path = os.path.join(BASE_DIR, 'populacao_ce.csv')
+
+        # O tamanho lido marca até onde o arquivo já foi processado (as anexações seguintes só leem o final)
+        with open(crimes_path, 'rb') as f:
+            conteudo_csv = f.read()
+        df_crimes_raw = pd.read_csv(io.BytesIO(conteudo_csv), sep=',')
+        tamanho_csv = len(conteudo_csv)
+        del conteudo_csv
+        df_populacao = pd.read_csv(populacao_path)
+        
+        df_crimes_raw.columns = COLUNAS_CRIMES
+    except FileNotFoundError as e:
+        print(f"ERRO CRÍTICO: Arquivo não encontrado - {e}.")
+        exit()
+    except Exception as e:
+        print(f"ERRO ao ler os arquivos CSV. Verifique o separador (deve ser vírgula) e o número de colunas. Erro: {e}")
+        exit()
+
+    df_crimes_raw['DATA'] = pd.to_datetime(df_crimes_raw['DATA'], dayfirst=True, errors='coerce')
+    df_crimes_raw.dropna(subset=['DATA'], inplace=True)
+    memoria_antes = df_crimes_raw.memory_usage(deep=True).sum()
+    df_crimes_raw = normalizar_colunas_texto(df_crimes_raw)
+    print(f"Tabela de crimes: {memoria_antes / 1e6:.1f} MB -> {df_crimes_raw.memory_usage(deep=True).sum() / 1e6:.1f} MB após a codificação categórica.")
+    df_crimes_graficos = derivar_colunas_graficos(df_crimes_raw.copy())
+
+    crimes_agrupados_mun = df_crimes_raw.groupby(['MUNICIPIO', 'NATUREZA'], observed=True).size().reset_index(name='QUANTIDADE')
+    crimes_agrupados_mun['MUNICIPIO_NORM'] = normalize_text(crimes_agrupados_mun['MUNICIPIO'])
+    df_populacao['MUNICIPIO_NORM'] = normalize_text(df_populacao['municipio'])
+    crimes_com_pop_mun = taxas_por_municipio(crimes_agrupados_mun, df_populacao)
+
+    df_crimes_raw['AIS_MAPEADA'] = df_crimes_raw['MUNICIPIO'].map(municipios_ais_map)
+    df_populacao['AIS'] = df_populacao['municipio'].map(municipios_ais_map)
+    pop_por_ais = df_populacao.groupby('AIS')['populacao'].sum().reset_index()
+    crimes_agrupados_ais = df_crimes_raw.groupby(['AIS_MAPEADA', 'NATUREZA'], observed=True).size().reset_index(name='QUANTIDADE')
+    crimes_com_pop_ais = taxas_por_ais(crimes_agrupados_ais, pop_por_ais)
+
+    return {
+        'df_crimes_raw': df_crimes_raw,
+        'df_crimes_graficos': df_crimes_graficos,
+        'df_populacao': df_populacao,
+        'crimes_agrupados_mun': crimes_agrupados_mun,
+        'crimes_com_pop_mun': crimes_com_pop_mun,
+        'pop_por_ais': pop_por_ais,
+        'crimes_agrupados_ais': crimes_agrupados_ais,
+        'crimes_com_pop_ais': crimes_com_pop_ais,
+        'LISTA_DE_CRIMES': sorted(df_crimes_raw['NATUREZA'].dropna().unique().tolist()),
+        'CUBO_CONTAGENS': construir_cubo_contagens(df_crimes_raw, DIMENSOES_CUBO),
+        # Ano × natureza sem filtros: o gráfico de dispersão de qualquer par de crimes é um recorte de colunas
+        'MATRIZ_ANO_NATUREZA': df_crimes_graficos.groupby(['ANO', 'NATUREZA'], observed=True).size().unstack(fill_value=0),
+        'indice_bitmap': construir_indice_bitmap(df_crimes_raw),
+        'PERFIL_COLUNAS': perfilar_dataframe(df_crimes_raw),
+        'tamanho_csv': tamanho_csv
+    }
+
+def processar_dados_geo():
+    """Lê a malha municipal e deriva centroides, polígonos das AIS e as geometrias serializadas (exige geopandas)."""
+    import geopandas as gpd
+
+    try:
+        gdf_municipios_raw = gpd.read_file(os.path.join(BASE_DIR, 'municipios_ce.geojson'))
+    except Exception as e:
+        print(f"ERRO CRÍTICO: não foi possível ler a malha municipal - {e}.")
+        exit()
+
+    gdf_municipios_raw['NM_MUN_NORM'] = normalize_text(gdf_municipios_raw['name'])
+
+    municipios_com_centroide = gdf_municipios_raw.copy()
+    municipios_com_centroide_proj = municipios_com_centroide.to_crs('epsg:31984')
+    centroides_proj = municipios_com_centroide_proj['geometry'].centroid
+    municipios_com_centroide['centroid'] = centroides_proj.to_crs(gdf_municipios_raw.crs)
+
+    gdf_municipios_raw['AIS'] = gdf_municipios_raw['name'].map(municipios_ais_map)
+    gdf_ais = gdf_municipios_raw.dissolve(by='AIS').reset_index()
+
+    # Centroides e caixas envolventes como arrays NumPy, além da lista já serializada para /api/municipalities
+    nomes = municipios_com_centroide['name'].to_numpy(dtype=object)
+    lat = municipios_com_centroide['centroid'].y.to_numpy()
+    lon = municipios_com_centroide['centroid'].x.to_numpy()
+    bbox = gdf_municipios_raw.bounds[['minx', 'miny', 'maxx', 'maxy']].to_numpy()
+    lista = [
+        {'name': nome, 'lat': float(la), 'lon': float(lo), 'bbox': [float(v) for v in caixa]}
+        for nome, la, lo, caixa in zip(nomes, lat, lon, bbox)
+    ]
+    corpo = json.dumps(lista, ensure_ascii=False).encode('utf-8')
+    # Índice de busca por prefixo: nomes normalizados (sem acento, maiúsculos) em ordem
+    nomes_norm = normalize_text(pd.Series(nomes, dtype=object)).to_numpy(dtype=str)
+    ordem = np.argsort(nomes_norm, kind='stable')
+
+    return {
+        'gdf_municipios_raw': gdf_municipios_raw,
+        'municipios_com_centroide': municipios_com_centroide,
+        'gdf_ais': gdf_ais,
+        'MUNICIPIOS_INDICE': {
+            'nomes': nomes, 'lat': lat, 'lon': lon, 'bbox': bbox,
+            'nomes_norm_ordenados': nomes_norm[ordem], 'ordem': ordem,
+            'body': corpo, 'etag': hashlib.sha1(corpo).hexdigest()
+        },
+        # As geometrias nunca mudam entre requisições: o mapa recebe só os atributos e busca a geometria (com ETag) à parte
+        'GEOMETRIAS_SERIALIZADAS': {
+            'municipality': serializar_camada_geometria(gdf_municipios_raw, 'id', ['name']),
+            'ais': serializar_camada_geometria(gdf_ais.assign(AIS_ID=gdf_ais['AIS']), 'AIS_ID', ['AIS'])
+        }
+    }
+
+# Snapshots em disco dos dados pré-processados, um por parte do estado ('crimes' e 'geo').
+# Mudar a versão invalida os snapshots antigos (ex.: quando o pré-processamento passar a gerar artefatos diferentes).
+SNAPSHOT_VERSAO = 8
+SNAPSHOT_DIR = os.path.join(BASE_DIR, 'cache')
+
+def chave_snapshot(arquivos, bibliotecas):
+    """Hash do conteúdo dos arquivos de entrada + versão do snapshot e das bibliotecas que o serializam."""
+    sha = hashlib.sha256(f"v{SNAPSHOT_VERSAO}|{bibliotecas}".encode('utf-8'))
+    for nome in arquivos:
+        with open(os.path.join(BASE_DIR, nome), 'rb') as f:
+            for bloco in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(bloco)
+    return sha.hexdigest()[:16]
+
+def salvar_snapshot(nome, dados, chave):
+    """Grava o snapshot de forma atômica e remove os snapshots antigos da mesma parte."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    caminho = os.path.join(SNAPSHOT_DIR, f"snapshot_{nome}_v{SNAPSHOT_VERSAO}_{chave}.pkl")
+    temporario = f"{caminho}.{os.getpid()}.tmp"
+    with open(temporario, 'wb') as f:
+        pickle.dump(dados, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporario, caminho)
+    for arquivo in os.listdir(SNAPSHOT_DIR):
+        if arquivo.startswith(f"snapshot_{nome}_") and arquivo.endswith('.pkl') and os.path.join(SNAPSHOT_DIR, arquivo) != caminho:
+            os.remove(os.path.join(SNAPSHOT_DIR, arquivo))
+
+def carregar_snapshot(nome, arquivos, bibliotecas, processar, forcar_reprocessamento=False):
+    """Carrega uma parte do estado do snapshot, se estiver atualizado; senão chama 'processar' e grava um novo."""
+    try:
+        chave = chave_snapshot(arquivos, bibliotecas)
+    except FileNotFoundError as e:
+        print(f"ERRO CRÍTICO: Arquivo não encontrado - {e}.")
+        exit()
+
+    caminho = os.path.join(SNAPSHOT_DIR, f"snapshot_{nome}_v{SNAPSHOT_VERSAO}_{chave}.pkl")
+    if not forcar_reprocessamento and os.path.exists(caminho):
+        try:
+            with open(caminho, 'rb') as f:
+                dados = pickle.load(f)
+            print(f"Dados carregados do snapshot {os.path.basename(caminho)}.")
+            return dados
+        except Exception as e:
+            print(f"Snapshot inválido ({e}); reprocessando os dados.")
+
+    dados = processar()
+    try:
+        salvar_snapshot(nome, dados, chave)
+    except OSError as e:
+        print(f"Aviso: não foi possível gravar o snapshot: {e}")
+    return dados
+
+# Estado global carregado sob demanda: as rotas leves (ex.: /api/dashboards) não pagam a leitura dos
+# dados nem o import do geopandas. Em produção, create_app(preload=True) carrega tudo antes do fork.
+# Estado do dataset padrão: o dicionário de processar_dados_crimes (ocorrências, população, agregados, cubo,
+# índice de bitmaps, perfil...). A carga e cada anexação montam um dicionário novo e o publicam com uma
+# única atribuição: quem capturou ESTADO_CRIMES enxerga sempre uma versão completa e coerente.
+ESTADO_CRIMES = None
+gdf_municipios_raw = None
+municipios_com_centroide = None
+gdf_ais = None
+GEOMETRIAS_SERIALIZADAS = None
+MUNICIPIOS_INDICE = None
+ARVORE_MUNICIPIOS = None
+carregamento_lock = threading.Lock()
+ARQUIVOS_CRIMES = ['crimes.csv', 'populacao_ce.csv']
+
+# Índices dos dashboards customizados, montados sob demanda (o do dataset padrão fica em ESTADO_CRIMES)
+INDICES_BITMAP = {}
+
+def dataset_padrao():
+    """DataFrame de ocorrências da versão publicada do dataset padrão (None antes da carga)."""
+    estado = ESTADO_CRIMES
+    return estado['df_crimes_raw'] if estado is not None else None
+
+def garantir_dados_crimes(forcar_reprocessamento=False):
+    """Carrega (uma única vez) as ocorrências, a população e os agregados derivados."""
+    global ESTADO_CRIMES
+    if ESTADO_CRIMES is not None and not forcar_reprocessamento:
+        sincronizar_crimes_csv()
+        return
+    with carregamento_lock:
+        if ESTADO_CRIMES is not None and not forcar_reprocessamento:
+            return
+        print("Iniciando o carregamento e processamento dos dados...")
+        dados = carregar_snapshot('crimes', ARQUIVOS_CRIMES, f"pandas {pd.__version__}",
+                                  processar_dados_crimes, forcar_reprocessamento)
+        ESTADO_CSV_CRIMES['bytes_lidos'] = dados['tamanho_csv']
+        ESTADO_CSV_CRIMES['verificado_em'] = time.monotonic()
+        # Publicado de uma vez, já completo, para as outras threads
+        ESTADO_CRIMES = dados
+        print(f"Cubo de contagens: {len(dados['CUBO_CONTAGENS']['contagens'])} células para {len(dados['df_crimes_raw'])} ocorrências.")
+        print(f"Índice de bitmaps: {sum(dados['indice_bitmap']['bytes'].values()) / 1e6:.1f} MB.")
+        print("Processamento de dados concluído.")
+
+# Anexação incremental: lotes novos são acrescentados ao fim de crimes.csv (rota /api/crimes/append ou
+# `python app.py append lote.csv`) e cada processo incorpora só os bytes que ainda não leu, atualizando
+# tabelas, agregados e índices sem reprocessar o arquivo. Com vários workers, cada um percebe o
+# crescimento do arquivo em até MULTIDASH_SYNC_SECONDS segundos.
+INTERVALO_SINCRONIZACAO_CRIMES = float(os.environ.get('MULTIDASH_SYNC_SECONDS', '5'))
+TOKEN_ANEXACAO = os.environ.get('MULTIDASH_APPEND_TOKEN')
+# 'bytes_lidos' também é a versão do dataset padrão: é o mesmo valor em todos os workers sincronizados
+ESTADO_CSV_CRIMES = {'bytes_lidos': 0, 'verificado_em': 0.0}
+
+def preparar_lote_crimes(df_lote):
+    """Mesma limpeza da carga completa: nomes internos, DATA convertida e linhas sem data válida descartadas."""
+    df_lote = df_lote.copy()
+    df_lote.columns = COLUNAS_CRIMES
+    df_lote['DATA'] = pd.to_datetime(df_lote['DATA'], dayfirst=True, errors='coerce')
+    df_lote = df_lote.dropna(subset=['DATA'])
+    df_lote['AIS_MAPEADA'] = df_lote['MUNICIPIO'].astype(object).str.strip().map(municipios_ais_map)
+    return df_lote
+
+def concatenar_ocorrencias(df_base, df_lote):
+    """
+    Junta as linhas do lote ao fim de 'df_base' mantendo os tipos. Nas colunas categóricas os valores
+    novos entram no fim do dicionário, então os códigos existentes não mudam (é o que permite estender
+    o cubo e os bitmaps em vez de reconstruí-los).
+    """
+    inicio = int(df_base.index.max()) + 1 if len(df_base) else 0
+    df_lote = df_lote.set_axis(pd.RangeIndex(inicio, inicio + len(df_lote)))
+    colunas = {}
+    for col in df_base.columns:
+        base = df_base[col]
+        lote = df_lote[col] if col in df_lote.columns else pd.Series(np.nan, index=df_lote.index)
+        if isinstance(base.dtype, pd.CategoricalDtype) or pd.api.types.is_object_dtype(base.dtype):
+            lote = lote.astype(object)
+            lote = lote.where(lote.isna(), lote.astype(str).str.strip())
+        elif pd.api.types.is_numeric_dtype(base.dtype) and not pd.api.types.is_numeric_dtype(lote.dtype):
+            lote = pd.to_numeric(lote, errors='coerce')
+        if isinstance(base.dtype, pd.CategoricalDtype):
+            novos = pd.Index(lote.dropna().unique()).difference(base.cat.categories)
+            tipo = pd.CategoricalDtype(base.cat.categories.append(novos))
+            base, lote = base.astype(tipo), lote.astype(tipo)
+        colunas[col] = pd.concat([base, lote])
+    return pd.DataFrame(colunas)
+
+def somar_contagens(tabela, df_lote, chaves):
+    """Soma à 'tabela' (chaves + QUANTIDADE) as contagens do lote agrupadas pelas mesmas chaves."""
+    novas = df_lote.groupby(chaves, observed=True).size().reset_index(name='QUANTIDADE')
+    juntas = pd.concat([tabela[chaves + ['QUANTIDADE']].astype({col: object for col in chaves}),
+                        novas.astype({col: object for col in chaves})], ignore_index=True)
+    return juntas.groupby(chaves, sort=False)['QUANTIDADE'].sum().reset_index()
+
+def anexar_ocorrencias(df_lote):
+    """
+    Incorpora ao estado em memória um lote já preparado (preparar_lote_crimes). Todos os artefatos são
+    calculados num dicionário novo, publicado com uma única atribuição a ESTADO_CRIMES: uma requisição
+    em andamento continua com o estado que capturou, sem misturar versões. Deve ser chamada com
+    carregamento_lock adquirido.
+    """
+    global ESTADO_CRIMES
+    if df_lote.empty:
+        return 0
+    estado = ESTADO_CRIMES
+    n_antigo = len(estado['df_crimes_raw'])
+    novo_raw = concatenar_ocorrencias(estado['df_crimes_raw'], df_lote)
+    lote = novo_raw.iloc[n_antigo:]
+    lote_graficos = derivar_colunas_graficos(lote.drop(columns=['AIS_MAPEADA']))
+
+    novo_agrupados_mun = somar_contagens(estado['crimes_agrupados_mun'], lote, ['MUNICIPIO', 'NATUREZA'])
+    novo_agrupados_mun['MUNICIPIO_NORM'] = normalize_text(novo_agrupados_mun['MUNICIPIO'])
+    novo_agrupados_ais = somar_contagens(estado['crimes_agrupados_ais'], lote, ['AIS_MAPEADA', 'NATUREZA'])
+    matriz_lote = lote_graficos.groupby(['ANO', 'NATUREZA'], observed=True).size().unstack(fill_value=0)
+    matriz_lote.columns = matriz_lote.columns.astype(object)
+    matriz = estado['MATRIZ_ANO_NATUREZA'].set_axis(estado['MATRIZ_ANO_NATUREZA'].columns.astype(object), axis=1)
+
+    novo_estado = {
+        **estado,
+        'df_crimes_raw': novo_raw,
+        'df_crimes_graficos': concatenar_ocorrencias(estado['df_crimes_graficos'], lote_graficos),
+        'crimes_agrupados_mun': novo_agrupados_mun,
+        'crimes_com_pop_mun': taxas_por_municipio(novo_agrupados_mun, estado['df_populacao']),
+        'crimes_agrupados_ais': novo_agrupados_ais,
+        'crimes_com_pop_ais': taxas_por_ais(novo_agrupados_ais, estado['pop_por_ais']),
+        'LISTA_DE_CRIMES': sorted(set(estado['LISTA_DE_CRIMES']) | set(lote['NATUREZA'].dropna().astype(str))),
+        'MATRIZ_ANO_NATUREZA': matriz.add(matriz_lote, fill_value=0).fillna(0).astype('int64'),
+        'CUBO_CONTAGENS': anexar_ao_cubo(estado['CUBO_CONTAGENS'], lote),
+        'indice_bitmap': anexar_ao_indice_bitmap(estado['indice_bitmap'], novo_raw),
+        # O perfil é refeito por inteiro: nas colunas categóricas é um bincount sobre os códigos
+        'PERFIL_COLUNAS': perfilar_dataframe(novo_raw, {col: info['type'] for col, info in estado['PERFIL_COLUNAS']['colunas'].items()}),
+    }
+    ESTADO_CRIMES = novo_estado
+    # Caches montados sob demanda para a versão anterior (também conferem o número de linhas)
+    INDICES_ESPACIAIS.pop(None, None)
+    VALORES_NUMERICOS.pop(None, None)
+    invalidar_respostas(None)
+    return len(df_lote)
+
+def sincronizar_crimes_csv(forcar=False):
+    """
+    Incorpora as linhas acrescentadas a crimes.csv desde a última leitura. O tamanho do arquivo é
+    conferido no máximo a cada INTERVALO_SINCRONIZACAO_CRIMES segundos (ou sempre, com 'forcar').
+    Retorna quantas ocorrências foram anexadas.
+    """
+    agora = time.monotonic()
+    if not forcar and agora - ESTADO_CSV_CRIMES['verificado_em'] < INTERVALO_SINCRONIZACAO_CRIMES:
+        return 0
+    ESTADO_CSV_CRIMES['verificado_em'] = agora
+    crimes_path = os.path.join(BASE_DIR, 'crimes.csv')
+    try:
+        if os.path.getsize(crimes_path) <= ESTADO_CSV_CRIMES['bytes_lidos']:
+            return 0
+    except OSError:
+        return 0
+
+    with carregamento_lock:
+        inicio = ESTADO_CSV_CRIMES['bytes_lidos']
+        with open(crimes_path, 'rb') as f:
+            f.seek(inicio)
+            novos_bytes = f.read()
+        # Só linhas completas: uma gravação ainda em andamento fica para a próxima verificação
+        fim = novos_bytes.rfind(b'\n') + 1
+        if fim == 0:
+            return 0
+        anexadas = 0
+        if novos_bytes[:fim].strip():
+            try:
+                df_lote = pd.read_csv(io.BytesIO(novos_bytes[:fim]), sep=',', header=None, dtype=str)
+                anexadas = anexar_ocorrencias(preparar_lote_crimes(df_lote))
+            except Exception as e:
+                # Linhas ilegíveis são puladas para não derrubar todas as requisições seguintes
+                print(f"ERRO ao anexar as linhas novas de crimes.csv (bytes {inicio}-{inicio + fim}): {e}")
+        ESTADO_CSV_CRIMES['bytes_lidos'] = inicio + fim
+    if anexadas:
+        print(f"{anexadas} ocorrências anexadas de crimes.csv; total de {len(ESTADO_CRIMES['df_crimes_raw'])}.")
+    return anexadas
+
+def salvar_snapshot_crimes():
+    """Grava o estado atual (já com as anexações) como snapshot, para a próxima subida não reprocessar o CSV."""
+    with carregamento_lock:
+        dados = {**ESTADO_CRIMES, 'tamanho_csv': ESTADO_CSV_CRIMES['bytes_lidos']}
+    # Se o arquivo crescer de novo nesse meio-tempo, quem carregar este snapshot lê o restante a partir de 'tamanho_csv'
+    try:
+        salvar_snapshot('crimes', dados, chave_snapshot(ARQUIVOS_CRIMES, f"pandas {pd.__version__}"))
+    except OSError as e:
+        print(f"Aviso: não foi possível gravar o snapshot: {e}")
+
+def anexar_lote_crimes(df_lote):
+    """
+    Valida um lote no formato de crimes.csv (mesmas colunas, na mesma ordem; lido com dtype=str),
+    acrescenta as linhas com data válida ao fim do arquivo, incorpora-as ao estado em memória e
+    atualiza o snapshot. Levanta ValueError se as colunas não baterem.
+    """
+    garantir_dados_crimes()
+    crimes_path = os.path.join(BASE_DIR, 'crimes.csv')
+    cabecalho = pd.read_csv(crimes_path, nrows=0).columns.tolist()
+    colunas = [str(col).strip() for col in df_lote.columns]
+    if colunas != cabecalho and colunas != COLUNAS_CRIMES:
+        raise ValueError(f"O lote deve ter as colunas de crimes.csv, na mesma ordem: {', '.join(cabecalho)}")
+
+    datas = pd.to_datetime(df_lote.iloc[:, COLUNAS_CRIMES.index('DATA')], dayfirst=True, errors='coerce')
+    validas = df_lote[datas.notna()]
+    if len(validas):
+        corpo = validas.to_csv(header=False, index=False, lineterminator='\n').encode('utf-8')
+        # Uma única escrita em modo append: quem lê o final do arquivo nunca vê uma linha pela metade
+        with open(crimes_path, 'ab+') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    corpo = b'\n' + corpo
+            f.write(corpo)
+        sincronizar_crimes_csv(forcar=True)
+        salvar_snapshot_crimes()
+    return {'appended': int(len(validas)), 'rejected': int(len(df_lote) - len(validas)), 'total': int(len(ESTADO_CRIMES['df_crimes_raw']))}
+
+def garantir_dados_geo(forcar_reprocessamento=False):
+    """Carrega (uma única vez) a malha municipal e as camadas derivadas; só aqui o geopandas é importado."""
+    global gdf_municipios_raw, municipios_com_centroide, gdf_ais, GEOMETRIAS_SERIALIZADAS, MUNICIPIOS_INDICE, ARVORE_MUNICIPIOS
+    if GEOMETRIAS_SERIALIZADAS is not None and not forcar_reprocessamento:
+        return
+    with carregamento_lock:
+        if GEOMETRIAS_SERIALIZADAS is not None and not forcar_reprocessamento:
+            return
+        import geopandas as gpd
+        import shapely
+        from shapely.errors import ShapelyDeprecationWarning
+        warnings.filterwarnings("ignore", category=ShapelyDeprecationWarning)
+
+        dados = carregar_snapshot('geo', ['municipios_ce.geojson'], f"geopandas {gpd.__version__}|shapely {shapely.__version__}",
+                                  processar_dados_geo, forcar_reprocessamento)
+        gdf_municipios_raw = dados['gdf_municipios_raw']
+        municipios_com_centroide = dados['municipios_com_centroide']
+        gdf_ais = dados['gdf_ais']
+        MUNICIPIOS_INDICE = dados['MUNICIPIOS_INDICE']
+        # A STRtree é barata de montar (uma folha por município) e não vai para o snapshot
+        ARVORE_MUNICIPIOS = shapely.STRtree(gdf_municipios_raw.geometry.values)
+        GEOMETRIAS_SERIALIZADAS = dados['GEOMETRIAS_SERIALIZADAS']
+
+# Espaço canônico de municípios: a ordem das feições da malha define o id inteiro de cada município, e
+# população e AIS ficam em vetores alinhados a esse id. Os nomes dos três arquivos (ocorrências,
+# populacao_ce.csv e GeoJSON) são casados pelo normalize_text, então diferenças de acento ou
+# maiúsculas não somem silenciosamente no merge.
+ESPACO_MUNICIPIOS = None
+
+def ids_municipios(espaco, nomes):
+    """Id canônico (posição na malha) de cada nome de município; -1 para nomes desconhecidos."""
+    nomes_norm = normalize_text(pd.Series(nomes, dtype=object).astype(str).str.strip())
+    return espaco['nomes_norm'].get_indexer(nomes_norm)
+
+def construir_espaco_municipios(gdf_municipios, gdf_ais, df_populacao):
+    """Vetores alinhados à ordem de 'gdf_municipios': id da feição, população, AIS e população por AIS."""
+    espaco = {
+        'ids_geo': gdf_municipios['id'].to_numpy(),
+        'nomes_norm': pd.Index(normalize_text(gdf_municipios['name'].astype(str).str.strip()))
+    }
+    n_municipios = len(espaco['ids_geo'])
+
+    ids_populacao = ids_municipios(espaco, df_populacao['municipio'])
+    encontrados = ids_populacao >= 0
+    if not encontrados.all():
+        print(f"Aviso: municípios de populacao_ce.csv fora da malha: {', '.join(df_populacao['municipio'][~encontrados].astype(str))}")
+    populacao = np.zeros(n_municipios)
+    np.add.at(populacao, ids_populacao[encontrados], df_populacao['populacao'].to_numpy(dtype=float)[encontrados])
+    espaco['populacao'] = populacao
+    espaco['tem_populacao'] = np.bincount(ids_populacao[encontrados], minlength=n_municipios) > 0
+
+    # AIS de cada município pelo nome normalizado; o código aponta para a ordem das feições de gdf_ais
+    ais_por_nome = pd.Series(list(municipios_ais_map.values()), index=normalize_text(pd.Series(list(municipios_ais_map))))
+    espaco['ais_nomes'] = gdf_ais['AIS'].to_numpy(dtype=object)
+    espaco['ais_codigo'] = pd.Index(espaco['ais_nomes']).get_indexer(ais_por_nome.reindex(espaco['nomes_norm']).to_numpy())
+    com_ais = espaco['ais_codigo'] >= 0
+    espaco['populacao_ais'] = np.bincount(espaco['ais_codigo'][com_ais], weights=populacao[com_ais], minlength=len(espaco['ais_nomes']))
+    return espaco
+
+def obter_espaco_municipios():
+    """Retorna (montando na primeira vez) o espaço canônico de municípios; exige as partes 'crimes' e 'geo'."""
+    global ESPACO_MUNICIPIOS
+    if ESPACO_MUNICIPIOS is None:
+        garantir_dados_crimes()
+        garantir_dados_geo()
+        ESPACO_MUNICIPIOS = construir_espaco_municipios(gdf_municipios_raw, gdf_ais, ESTADO_CRIMES['df_populacao'])
+    return ESPACO_MUNICIPIOS
+
+def contagens_por_municipio(espaco, contagens):
+    """Soma uma Series de contagens indexada por nome de município no vetor do espaço canônico (np.bincount)."""
+    ids = ids_municipios(espaco, contagens.index)
+    validos = ids >= 0
+    return np.bincount(ids[validos], weights=contagens.to_numpy(dtype=float)[validos], minlength=len(espaco['ids_geo']))
+
+def taxas_por_100k(quantidade, populacao):
+    """Taxa por 100 mil habitantes; zero onde a população é zero."""
+    taxa = np.zeros(len(quantidade))
+    validos = populacao > 0
+    taxa[validos] = quantidade[validos] / populacao[validos] * 100000
+    return taxa
+
+def usa_dados(*partes):
+    """Decorador das rotas que leem o estado global: garante que as partes ('crimes', 'geo') estejam carregadas."""
+    def decorador(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if 'crimes' in partes:
+                garantir_dados_crimes()
+            if 'geo' in partes:
+                garantir_dados_geo()
+            return func(*args, **kwargs)
+        return wrapper
+    return decorador
+
+def obter_indice_bitmap(dashboard_id, df):
+    """Retorna (construindo na primeira vez) o índice de bitmaps do dataset carregado."""
+    # O do dataset padrão faz parte do estado publicado, junto com o DataFrame a que corresponde
+    estado = ESTADO_CRIMES
+    if estado is not None and df is estado['df_crimes_raw']:
+        return estado['indice_bitmap']
+    indice = INDICES_BITMAP.get(dashboard_id) if dashboard_id is not None else None
+    if indice is None or indice['n_linhas'] != len(df):
+        indice = construir_indice_bitmap(df)
+        # Uma requisição que ainda usa o DataFrame padrão anterior a uma anexação não guarda o índice
+        if dashboard_id is not None:
+            INDICES_BITMAP[dashboard_id] = indice
+    return indice
+
+# Índices espaciais por dataset (None = dataset padrão): pontos válidos ordenados por longitude
+INDICES_ESPACIAIS = {}
+
+def construir_indice_espacial(df):
+    """Coordenadas válidas ordenadas por longitude; um viewport vira duas buscas binárias + filtro na latitude."""
+    lat = pd.to_numeric(df['LATITUDE'], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(df['LONGITUDE'], errors='coerce').to_numpy(dtype=float)
+    validos = np.flatnonzero(~np.isnan(lat) & ~np.isnan(lon))
+    ordem = validos[np.argsort(lon[validos], kind='stable')]
+    return {'n_linhas': len(df), 'ordem': ordem, 'lat': lat[ordem], 'lon': lon[ordem]}
+
+def obter_indice_espacial(dashboard_id, df):
+    """Retorna (construindo na primeira vez) o índice espacial do dataset carregado."""
+    atual = dataset_padrao()
+    chave = None if df is atual else dashboard_id
+    indice = INDICES_ESPACIAIS.get(chave)
+    if indice is None or indice['n_linhas'] != len(df):
+        indice = construir_indice_espacial(df)
+        # Uma requisição que ainda usa o DataFrame anterior a uma anexação não sobrescreve o índice do atual
+        if chave is not None or df is atual:
+            INDICES_ESPACIAIS[chave] = indice
+    return indice
+
+# Tamanho alvo de cada célula do mapa de calor na tela e teto de células por eixo
+TAMANHO_CELULA_HEATMAP_PX = 8
+MAX_CELULAS_HEATMAP_EIXO = 512
+
+def agregar_heatmap(indice_espacial, mascara_filtros, bbox, zoom):
+    """
+    Soma os pontos filtrados dentro do 'bbox' (oeste, sul, leste, norte) em uma grade cujo passo equivale a
+    TAMANHO_CELULA_HEATMAP_PX pixels no 'zoom' do mapa: o tamanho da resposta depende da tela, não do número
+    de ocorrências. Retorna as células não vazias como [lat, lon, peso] (centro da célula).
+    """
+    oeste, sul, leste, norte = bbox
+    inicio = np.searchsorted(indice_espacial['lon'], oeste, side='left')
+    fim = np.searchsorted(indice_espacial['lon'], leste, side='right')
+    lat = indice_espacial['lat'][inicio:fim]
+    lon = indice_espacial['lon'][inicio:fim]
+    dentro = (lat >= sul) & (lat <= norte) & mascara_filtros[indice_espacial['ordem'][inicio:fim]]
+    lat, lon = lat[dentro], lon[dentro]
+
+    # Graus por pixel na projeção Web Mercator (tiles de 256 px); na latitude o passo encolhe com o cosseno
+    passo_lon = 360.0 / (256 * 2 ** zoom) * TAMANHO_CELULA_HEATMAP_PX
+    passo_lat = passo_lon * np.cos(np.radians((sul + norte) / 2))
+    n_lon = int(min(max(np.ceil((leste - oeste) / passo_lon), 1), MAX_CELULAS_HEATMAP_EIXO))
+    n_lat = int(min(max(np.ceil((norte - sul) / passo_lat), 1), MAX_CELULAS_HEATMAP_EIXO))
+
+    pesos, bordas_lat, bordas_lon = np.histogram2d(lat, lon, bins=[n_lat, n_lon], range=[[sul, norte], [oeste, leste]])
+    linhas, colunas = np.nonzero(pesos)
+    centros_lat = (bordas_lat[:-1] + bordas_lat[1:]) / 2
+    centros_lon = (bordas_lon[:-1] + bordas_lon[1:]) / 2
+    return {
+        'cells': np.column_stack([centros_lat[linhas], centros_lon[colunas], pesos[linhas, colunas]]).round(5).tolist(),
+        'grid': [n_lat, n_lon],
+        'max': float(pesos.max()) if len(linhas) else 0,
+        'total': int(len(lat))
+    }
+
+# Histogramas: colunas já convertidas para float64 (NaN onde não houver número), por dataset e coluna
+VALORES_NUMERICOS = {}
+MAX_FAIXAS_HISTOGRAMA = 200
+METODOS_FAIXAS = ('auto', 'fd', 'sturges', 'quantile')
+
+def valores_numericos(df, coluna):
+    """Converte a coluna para float64; nas categóricas só o dicionário passa pelo pd.to_numeric."""
+    serie = df[coluna]
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        categorias = pd.to_numeric(pd.Series(serie.cat.categories), errors='coerce').to_numpy(dtype=float)
+        codigos = serie.cat.codes.to_numpy()
+        return np.where(codigos >= 0, categorias[codigos], np.nan)
+    return pd.to_numeric(serie, errors='coerce').to_numpy(dtype=float)
+
+def obter_valores_numericos(dashboard_id, df, coluna):
+    """Retorna (convertendo na primeira vez) a coluna como float64, guardada com a chave do INDICES_ESPACIAIS."""
+    atual = dataset_padrao()
+    chave = None if df is atual else dashboard_id
+    entrada = VALORES_NUMERICOS.get(chave)
+    if entrada is None or entrada['n_linhas'] != len(df):
+        entrada = {'n_linhas': len(df), 'colunas': {}}
+        if chave is not None or df is atual:
+            VALORES_NUMERICOS[chave] = entrada
+    if coluna not in entrada['colunas']:
+        entrada['colunas'][coluna] = valores_numericos(df, coluna)
+    return entrada['colunas'][coluna]
+
+def calcular_bordas_histograma(valores, bins='auto', n_faixas=10):
+    """
+    Bordas das faixas para 'valores' (sem NaN). 'fd' (Freedman–Diaconis) e 'sturges' escolhem a largura,
+    'auto' usa a menor das duas (como o NumPy), 'quantile' gera 'n_faixas' faixas com a mesma quantidade
+    de valores, um inteiro fixa o número de faixas e uma lista define as bordas. Em dados inteiros as
+    larguras escolhidas automaticamente são arredondadas para inteiros (faixas como 0-9, 10-19...).
+    """
+    if isinstance(bins, (list, tuple)):
+        bordas = np.unique(np.asarray(bins, dtype=float))
+        if len(bordas) < 2:
+            raise ValueError("Informe ao menos duas bordas para as faixas do histograma.")
+        return bordas
+    minimo, maximo = float(valores.min()), float(valores.max())
+    if bins == 'quantile':
+        n_faixas = min(max(int(n_faixas), 1), MAX_FAIXAS_HISTOGRAMA)
+        bordas = np.unique(np.quantile(valores, np.linspace(0, 1, n_faixas + 1)))
+        return bordas if len(bordas) > 1 else np.array([minimo - 0.5, maximo + 0.5])
+    if minimo == maximo:
+        return np.array([minimo - 0.5, maximo + 0.5])
+
+    amplitude = maximo - minimo
+    if isinstance(bins, int) and not isinstance(bins, bool):
+        largura = amplitude / min(max(bins, 1), MAX_FAIXAS_HISTOGRAMA)
+    elif bins in METODOS_FAIXAS:
+        # Larguras calculadas direto (np.histogram_bin_edges alocaria todas as bordas antes do teto)
+        largura_sturges = amplitude / (np.log2(len(valores)) + 1)
+        q1, q3 = np.percentile(valores, [25, 75])
+        largura_fd = 2 * (q3 - q1) / len(valores) ** (1 / 3)
+        if bins == 'sturges' or largura_fd == 0:
+            largura = largura_sturges
+        else:
+            largura = largura_fd if bins == 'fd' else min(largura_fd, largura_sturges)
+        largura = max(largura, amplitude / MAX_FAIXAS_HISTOGRAMA)
+    else:
+        raise ValueError(f"Método de faixas '{bins}' não suportado.")
+
+    if isinstance(bins, str) and np.all(valores == np.round(valores)):
+        largura = max(np.ceil(largura), 1)
+        inicio = np.floor(minimo)
+        # A última borda fica acima do máximo: todas as faixas são fechadas à esquerda e abertas à direita
+        return inicio + largura * np.arange(int((maximo - inicio) // largura) + 2)
+    return np.linspace(minimo, maximo, int(np.ceil(amplitude / largura)) + 1)
+
+def rotulos_faixas(bordas, inteiros=False, incluir_ultima_borda=False):
+    """
+    Rótulos das faixas: '0-9' para dados e bordas inteiros, '[a, b)' nos demais casos. Como no np.histogram,
+    a última faixa é fechada; 'incluir_ultima_borda' indica que algum valor caiu exatamente nela.
+    """
+    if inteiros:
+        separador = ' a ' if bordas[0] < 0 else '-'
+        rotulos = []
+        for i, (a, b) in enumerate(zip(bordas[:-1].astype(int), bordas[1:].astype(int))):
+            fim = b if i == len(bordas) - 2 and incluir_ultima_borda else b - 1
+            rotulos.append(f"{a}{separador}{fim}" if fim > a else str(a))
+        return rotulos
+    rotulos = [f"[{a:.4g}, {b:.4g})" for a, b in zip(bordas[:-1], bordas[1:])]
+    rotulos[-1] = rotulos[-1][:-1] + ']'
+    return rotulos
+
+def calcular_histograma(valores, bins='auto', n_faixas=10):
+    """Contagens por faixa dos valores finitos; faixas de mesma largura usam o caminho rápido do np.histogram."""
+    valores = valores[np.isfinite(valores)]
+    if len(valores) == 0:
+        return None
+    bordas = calcular_bordas_histograma(valores, bins, n_faixas)
+    larguras = np.diff(bordas)
+    if np.allclose(larguras, larguras[0]):
+        contagens, _ = np.histogram(valores, bins=len(larguras), range=(bordas[0], bordas[-1]))
+    else:
+        contagens, _ = np.histogram(valores, bins=bordas)
+    inteiros = bool(np.all(bordas == np.round(bordas)) and np.all(valores == np.round(valores)))
+    rotulos = rotulos_faixas(bordas, inteiros, bool(valores.max() >= bordas[-1]))
+    return {'edges': bordas.tolist(), 'labels': rotulos, 'data': contagens.tolist()}
+
+def contar_ocorrencias(df_base, filters, agrupar_por, usar_cubo=False, indice=None, selecao=None):
+    """
+    Conta as ocorrências filtradas agrupadas por 'agrupar_por', usando o cubo do dataset padrão quando possível.
+    Com uma 'selecao' (SelecaoFiltrada), reaproveita o recorte já calculado em vez de filtrar de novo.
+    """
+    estado = ESTADO_CRIMES
+    # O cubo só vale para o DataFrame do mesmo estado (uma anexação pode ter publicado outro)
+    if usar_cubo and estado is not None and estado['df_crimes_raw'] is df_base:
+        contagens = consultar_cubo(estado['CUBO_CONTAGENS'], filters, agrupar_por)
+        if contagens is not None:
+            return contagens
+
+    df_filtered = selecao.df if selecao is not None else apply_filters(df_base, filters, indice)
+    # ANO/MES derivados da data entram como chaves do groupby, sem alterar o recorte (que pode ser compartilhado)
+    chaves = [col if col in df_filtered.columns else coluna_agrupamento(df_filtered, col) for col in agrupar_por]
+    return df_filtered.groupby(chaves, observed=True).size()
+
+# Colunas de agrupamento que, ausentes do dataset, são derivadas da coluna DATA
+COLUNAS_DERIVADAS_DATA = {'ANO': lambda datas: datas.dt.year, 'MES': lambda datas: datas.dt.month}
+
+def coluna_agrupamento(df, coluna):
+    """A coluna 'coluna' de 'df' ou, para ANO/MES ausentes, a derivada da DATA (sem alterar o DataFrame)."""
+    if coluna not in df.columns and coluna in COLUNAS_DERIVADAS_DATA and 'DATA' in df.columns:
+        return COLUNAS_DERIVADAS_DATA[coluna](df['DATA']).rename(coluna)
+    return df[coluna]
+
+# Motor de agregação dos gráficos genéricos (barras, pizza e série temporal)
+MEDIDAS_AGREGACAO = {'count': 'Contagem', 'sum': 'Soma', 'mean': 'Média', 'median': 'Mediana', 'nunique': 'Valores distintos'}
+ROTULO_OUTROS = 'Outros'
+
+def codificar_coluna(serie):
+    """Códigos inteiros (-1 = nulo) e valores distintos em ordem; as categóricas reaproveitam os próprios códigos."""
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        return serie.cat.codes.to_numpy(), serie.cat.categories
+    codigos, valores = pd.factorize(serie, sort=True)
+    return codigos, valores
+
+def agregar_por_codigo(codigos, n, medida, valores=None, pesos=None):
+    """
+    Medida de cada um dos 'n' grupos dados por 'codigos' (0..n-1). 'pesos' são contagens pré-agregadas
+    (só para 'count'); 'valores' é a coluna medida, já sem nulos. Grupos vazios ficam com 0 ou NaN.
+    """
+    if medida == 'count':
+        return np.bincount(codigos, weights=pesos, minlength=n)
+    if medida == 'sum':
+        return np.bincount(codigos, weights=valores, minlength=n)
+    if medida == 'mean':
+        contagem = np.bincount(codigos, minlength=n)
+        soma = np.bincount(codigos, weights=valores, minlength=n)
+        return np.divide(soma, contagem, out=np.full(n, np.nan), where=contagem > 0)
+    grupos = pd.Series(valores).groupby(codigos)
+    if medida == 'median':
+        return grupos.median().reindex(np.arange(n)).to_numpy(dtype=float)
+    return grupos.nunique().reindex(np.arange(n), fill_value=0).to_numpy(dtype=float)
+
+def maiores_k(totais, k):
+    """
+    Posições dos k maiores totais em ordem decrescente: argpartition acha o k-ésimo maior e só os escolhidos
+    são ordenados. Empates ficam com as menores posições, como no nlargest.
+    """
+    totais = np.nan_to_num(totais, nan=-np.inf)
+    if k == 0:
+        return np.arange(0)
+    if k < len(totais):
+        corte = totais[np.argpartition(-totais, k - 1)[k - 1]]
+        acima = np.flatnonzero(totais > corte)
+        candidatos = np.concatenate([acima, np.flatnonzero(totais == corte)[:k - len(acima)]])
+        candidatos.sort()
+    else:
+        candidatos = np.arange(len(totais))
+    return candidatos[np.argsort(-totais[candidatos], kind='stable')]
+
+def eixo_top_k(codigos, rotulos, k, outros, medida, valores=None, pesos=None, ordem_natural=False):
+    """
+    Reduz um eixo aos k valores de maior medida (ou a todos, na ordem natural, com k None) e devolve o mapa
+    código original -> posição no eixo reduzido (-1 = descartado) e os rótulos do eixo.
+    Com 'outros', os valores fora do top-k caem num último grupo 'Outros' em vez de serem descartados.
+    Com 'ordem_natural', um eixo que cabe inteiro no top-k mantém a ordem natural em vez da ordem pela medida.
+    """
+    n = len(rotulos)
+    validos = codigos >= 0
+    presentes = np.bincount(codigos[validos], minlength=n) > 0
+    if k is None or (ordem_natural and presentes.sum() <= k):
+        escolhidos = np.flatnonzero(presentes)
+    else:
+        totais = agregar_por_codigo(codigos[validos], n, medida, None if valores is None else valores[validos], None if pesos is None else pesos[validos])
+        totais[~presentes] = np.nan
+        escolhidos = maiores_k(totais, min(k, int(presentes.sum())))
+    mapa = np.full(n + 1, -1)  # a última posição recebe os códigos nulos (-1)
+    mapa[escolhidos] = np.arange(len(escolhidos))
+    nomes = [str(r) for r in rotulos[escolhidos]]
+    if outros and len(escolhidos) < presentes.sum():
+        mapa[:n][presentes & (mapa[:n] < 0)] = len(escolhidos)
+        nomes.append(ROTULO_OUTROS)
+    return mapa, nomes
+
+def agregar_grafico(df_base, filters, coluna, segmento=None, medida='count', coluna_valor=None, top=None, top_segmento=None,
+                    outros=False, usar_cubo=False, indice=None, selecao=None, df_linhas=None, ordem_natural=False):
+    """
+    Agrega as linhas filtradas por 'coluna' (e, opcionalmente, por 'segmento') com a 'medida' de MEDIDAS_AGREGACAO
+    sobre 'coluna_valor'. Cada eixo é reduzido ao seu top-k sobre os códigos inteiros das colunas, e só a matriz
+    top × top é montada (nunca o cruzamento completo de colunas de alta cardinalidade como LOCAL).
+    As contagens do dataset padrão saem do cubo; 'df_linhas' substitui o recorte filtrado quando o chamador já
+    preparou as linhas; 'ordem_natural' segue para eixo_top_k. Devolve {'labels', 'segments' (ou None), 'data'}.
+    """
+    if medida not in MEDIDAS_AGREGACAO:
+        raise ValueError(f"Medida '{medida}' não suportada. Use uma de: {', '.join(MEDIDAS_AGREGACAO)}.")
+    colunas = [coluna] + ([segmento] if segmento else [])
+    valores = pesos = None
+    if medida == 'count':
+        if df_linhas is None:
+            contagens = contar_ocorrencias(df_base, filters, colunas, usar_cubo, indice, selecao)
+        else:
+            contagens = df_linhas.groupby([coluna_agrupamento(df_linhas, col) for col in colunas], observed=True).size()
+        chaves = [contagens.index.get_level_values(i) for i in range(len(colunas))]
+        pesos = contagens.to_numpy(dtype=float)
+    else:
+        if not coluna_valor or coluna_valor not in df_base.columns:
+            raise ValueError(f"Coluna de valor '{coluna_valor}' não encontrada.")
+        if df_linhas is not None:
+            df_filtered = df_linhas
+        else:
+            df_filtered = selecao.df if selecao is not None else apply_filters(df_base, filters, indice)
+        if medida == 'nunique':
+            codigos_valor = codificar_coluna(df_filtered[coluna_valor])[0]
+            valores = np.where(codigos_valor >= 0, codigos_valor, np.nan)
+        else:
+            valores = pd.to_numeric(df_filtered[coluna_valor], errors='coerce').to_numpy(dtype=float)
+        # Linhas sem valor não entram em nenhuma medida
+        com_valor = ~np.isnan(valores)
+        chaves = [coluna_agrupamento(df_filtered, col)[com_valor] for col in colunas]
+        valores = valores[com_valor]
+
+    codigos_a, rotulos_a = codificar_coluna(pd.Series(chaves[0]))
+    mapa_a, labels = eixo_top_k(codigos_a, rotulos_a, top, outros, medida, valores, pesos, ordem_natural)
+    linha = mapa_a[codigos_a]
+
+    if not segmento:
+        validos = linha >= 0
+        dados = agregar_por_codigo(linha[validos], len(labels), medida, None if valores is None else valores[validos], None if pesos is None else pesos[validos])
+        return {'labels': labels, 'segments': None, 'data': dados}
+
+    # Os segmentos são escolhidos entre as linhas das categorias principais que ficaram no gráfico
+    codigos_b, rotulos_b = codificar_coluna(pd.Series(chaves[1]))
+    no_grafico = (linha >= 0) & (codigos_b >= 0)
+    mapa_b, segments = eixo_top_k(
+        np.where(no_grafico, codigos_b, -1), rotulos_b, top_segmento, outros, medida, valores, pesos, ordem_natural)
+    coluna_b = mapa_b[codigos_b]
+    validos = (linha >= 0) & (coluna_b >= 0)
+    celulas = linha[validos] * len(segments) + coluna_b[validos]
+    dados = agregar_por_codigo(celulas, len(labels) * len(segments), medida,
+                               None if valores is None else valores[validos], None if pesos is None else pesos[validos])
+    return {'labels': labels, 'segments': segments, 'data': dados.reshape(len(labels), len(segments))}
+
+def valores_json(dados, medida):
+    """Lista JSON dos valores agregados: inteiros nas contagens e None onde a medida não existe (grupo vazio)."""
+    if medida in ('count', 'nunique'):
+        return np.rint(dados).astype(int).tolist()
+    return [None if np.isnan(v) else round(float(v), 4) for v in dados]
 
-municipios_ais_map = {'Fortaleza': 'AIS 1-10', 'Caucaia': 'AIS 11', 'Maracanaú': 'AIS 12', 'Aquiraz': 'AIS 13', 'Cascavel': 'AIS 13', 'Eusébio': 'AIS 13', 'Pindoretama': 'AIS 13', 'Alcântaras': 'AIS 14', 'Barroquinha': 'AIS 14', 'Camocim': 'AIS 14', 'Cariré': 'AIS 14', 'Carnaubal': 'AIS 14', 'Chaval': 'AIS 14', 'Coreaú': 'AIS 14', 'Croatá': 'AIS 14', 'Forquilha': 'AIS 14', 'Frecheirinha': 'AIS 14', 'Graça': 'AIS 14', 'Granja': 'AIS 14', 'Groaíras': 'AIS 14', 'Guaraciaba do Norte': 'AIS 14', 'Ibiapina': 'AIS 14', 'Martinópole': 'AIS 14', 'Massapê': 'AIS 14', 'Meruoca': 'AIS 14', 'Moraújo': 'AIS 14', 'Mucambo': 'AIS 14', 'Pacujá': 'AIS 14', 'Santana do Acaraú': 'AIS 14', 'São Benedito': 'AIS 14', 'Senador Sá': 'AIS 14', 'Sobral': 'AIS 14', 'Tianguá': 'AIS 14', 'Ubajara': 'AIS 14', 'Uruoca': 'AIS 14', 'Viçosa do Ceará': 'AIS 14', 'Acarape': 'AIS 15', 'Aracoiaba': 'AIS 15', 'Aratuba': 'AIS 15', 'Barreira': 'AIS 15', 'Baturité': 'AIS 15', 'Boa Viagem': 'AIS 15', 'Canindé': 'AIS 15', 'Capistrano': 'AIS 15', 'Caridade': 'AIS 15', 'Guaramiranga': 'AIS 15', 'Itapiúna': 'AIS 15', 'Itatira': 'AIS 15', 'Madalena': 'AIS 15', 'Mulungu': 'AIS 15', 'Ocara': 'AIS 15', 'Pacoti': 'AIS 15', 'Palmácia': 'AIS 15', 'Paramoti': 'AIS 15', 'Redenção': 'AIS 15', 'Ararendá': 'AIS 16', 'Catunda': 'AIS 16', 'Crateús': 'AIS 16', 'Hidrolândia': 'AIS 16', 'Independência': 'AIS 16', 'Ipaporanga': 'AIS 16', 'Ipu': 'AIS 16', 'Ipueiras': 'AIS 16', 'Monsenhor Tabosa': 'AIS 16', 'Nova Russas': 'AIS 16', 'Novo Oriente': 'AIS 16', 'Pires Ferreira': 'AIS 16', 'Poranga': 'AIS 16', 'Reriutaba': 'AIS 16', 'Santa Quitéria': 'AIS 16', 'Tamboril': 'AIS 16', 'Varjota': 'AIS 16', 'Acaraú': 'AIS 17', 'Amontada': 'AIS 17', 'Apuiarés': 'AIS 17', 'Bela Cruz': 'AIS 17', 'Cruz': 'AIS 17', 'General Sampaio': 'AIS 17', 'Irauçuba': 'AIS 17', 'Itapajé': 'AIS 17', 'Itapipoca': 'AIS 17', 'Itarema': 'AIS 17', 'Jijoca de Jericoacoara': 'AIS 17', 'Marco': 'AIS 17', 'Miraíma': 'AIS 17', 'Morrinhos': 'AIS 17', 'Pentecoste': 'AIS 17', 'Tejuçuoca': 'AIS 17', 'Tururu': 'AIS 17', 'Umirim': 'AIS 17', 'Uruburetama': 'AIS 17', 'Alto Santo': 'AIS 18', 'Aracati': 'AIS 18', 'Beberibe': 'AIS 18', 'Ererê': 'AIS 18', 'Fortim': 'AIS 18', 'Icapuí': 'AIS 18', 'Iracema': 'AIS 18', 'Itaiçaba': 'AIS 18', 'Jaguaribe': 'AIS 18', 'Jaguaruana': 'AIS 18', 'Limoeiro do Norte': 'AIS 18', 'Jaguaribara': 'AIS 18', 'Palhano': 'AIS 18', 'Pereiro': 'AIS 18', 'Potiretama': 'AIS 18', 'Quixeré': 'AIS 18', 'Russas': 'AIS 18', 'São João do Jaguaribe': 'AIS 18', 'Tabuleiro do Norte': 'AIS 18', 'Abaiara': 'AIS 19', 'Altaneira': 'AIS 19', 'Antonina do Norte': 'AIS 19', 'Araripe': 'AIS 19', 'Assaré': 'AIS 19', 'Aurora': 'AIS 19', 'Barbalha': 'AIS 19', 'Barro': 'AIS 19', 'Brejo Santo': 'AIS 19', 'Campos Sales': 'AIS 19', 'Caririaçu': 'AIS 19', 'Crato': 'AIS 19', 'Farias Brito': 'AIS 19', 'Jardim': 'AIS 19', 'Jati': 'AIS 19', 'Juazeiro do Norte': 'AIS 19', 'Mauriti': 'AIS 19', 'Milagres': 'AIS 19', 'Missão Velha': 'AIS 19', 'Nova Olinda': 'AIS 19', 'Penaforte': 'AIS 19', 'Porteiras': 'AIS 19', 'Potengi': 'AIS 19', 'Salitre': 'AIS 19', 'Santana do Cariri': 'AIS 19', 'Banabuiú': 'AIS 20', 'Choró': 'AIS 20', 'Deputado Irapuan Pinheiro': 'AIS 20', 'Ibaretama': 'AIS 20', 'Ibicuitinga': 'AIS 20', 'Jaguaretama': 'AIS 20', 'Milhã': 'AIS 20', 'Morada Nova': 'AIS 20', 'Pedra Branca': 'AIS 20', 'Quixadá': 'AIS 20', 'Quixeramobim': 'AIS 20', 'Senador Pompeu': 'AIS 20', 'Solonópole': 'AIS 20', 'Acopiara': 'AIS 21', 'Baixio': 'AIS 21', 'Cariús': 'AIS 21', 'Cedro': 'AIS 21', 'Granjeiro': 'AIS 21', 'Icó': 'AIS 21', 'Iguatu': 'AIS 21', 'Ipaumirim': 'AIS 21', 'Jucás': 'AIS 21', 'Lavras da Mangabeira': 'AIS 21', 'Orós': 'AIS 21', 'Quixelô': 'AIS 21', 'Saboeiro': 'AIS 21', 'Tarrafas': 'AIS 21', 'Umari': 'AIS 21', 'Várzea Alegre': 'AIS 21', 'Aiuaba': 'AIS 22', 'Arneiroz': 'AIS 22', 'Catarina': 'AIS 22', 'Mombaça': 'AIS 22', 'Parambu': 'AIS 22', 'Piquet Carneiro': 'AIS 22', 'Quiterianópolis': 'AIS 22', 'Tauá': 'AIS 22', 'Paracuru': 'AIS 23', 'Paraipaba': 'AIS 23', 'São Gonçalo do Amarante': 'AIS 23', 'São Luís do Curu': 'AIS 23', 'Trairi': 'AIS 23', 'Guaiúba': 'AIS 24', 'Maranguape': 'AIS 24', 'Pacatuba': 'AIS 24', 'Chorozinho': 'AIS 25', 'Horizonte': 'AIS 25', 'Itaitinga': 'AIS 25', 'Pacajus': 'AIS 25'}
-gdf_municipios_raw['AIS'] = gdf_municipios_raw['name'].map(municipios_ais_map)
-gdf_ais = gdf_municipios_raw.dissolve(by='AIS').reset_index()
-df_crimes_raw['AIS_MAPEADA'] = df_crimes_raw['MUNICIPIO'].map(municipios_ais_map)
-df_populacao['AIS'] = df_populacao['municipio'].map(municipios_ais_map)
-pop_por_ais = df_populacao.groupby('AIS')['populacao'].sum().reset_index()
-crimes_agrupados_ais = df_crimes_raw.groupby(['AIS_MAPEADA', 'NATUREZA']).size().reset_index(name='QUANTIDADE')
-crimes_com_pop_ais = pd.merge(crimes_agrupados_ais, pop_por_ais, left_on='AIS_MAPEADA', right_on='AIS', how='left')
-crimes_com_pop_ais.dropna(subset=['populacao'], inplace=True)
-crimes_com_pop_ais['TAXA_POR_100K'] = (crimes_com_pop_ais['QUANTIDADE'] / crimes_com_pop_ais['populacao']) * 100000
-
-LISTA_DE_CRIMES = sorted(df_crimes_raw['NATUREZA'].dropna().unique().tolist())
-
-print("Processamento de dados concluído. Aplicação pronta.")
 def projetar_ano_incompleto(df_historico, ano_incompleto, ultimo_mes_registrado, colunas_grupo, anos_para_media=5):
     """
     Projeta o total para um ano incompleto com base na média dos meses faltantes 
@@ -140,153 +1308,845 @@ def projetar_ano_incompleto(df_historico, ano_incompleto, ultimo_mes_registrado,
     
     return df_projetado[colunas_grupo + ['TOTAL']]
 
-@app.route('/')
+# Tendências em lote: janelas (em anos) sobre as quais a reta de cada grupo é ajustada
+JANELAS_TENDENCIA = [1, 5, 10]
+
+def prever_tendencias(contagens, colunas_grupo, anos_para_media=5, janelas=JANELAS_TENDENCIA):
+    """
+    Versão vetorizada de projetar_ano_incompleto + regressão linear para todos os grupos de uma vez.
+    'contagens' é uma Series indexada por colunas_grupo + ['ANO', 'MES']. Monta a matriz grupo × ano × mês,
+    completa o último ano (se incompleto) com a média dos meses faltantes nos 'anos_para_media' anos
+    anteriores e, para cada janela w de 'janelas', ajusta por mínimos quadrados em forma fechada uma reta aos
+    totais de ano_atual - w até ano_atual (w + 1 pontos, para que a janela de 1 ano também tenha inclinação):
+    uma multiplicação de matriz por janela no lugar de um ajuste por grupo.
+    """
+    indice = contagens.index
+    chaves = indice.droplevel(['ANO', 'MES'])
+    codigos, grupos = pd.factorize(chaves)
+    anos = indice.get_level_values('ANO').to_numpy(dtype=int)
+    meses = indice.get_level_values('MES').to_numpy(dtype=int)
+    ano_min, ano_atual = anos.min(), anos.max()
+    lista_anos = np.arange(ano_min, ano_atual + 1)
+
+    por_mes = np.zeros((len(grupos), len(lista_anos), 12))
+    np.add.at(por_mes, (codigos, anos - ano_min, meses - 1), contagens.to_numpy(dtype=float))
+    anual = por_mes.sum(axis=2)
+
+    # Mesma regra do projetar_ano_incompleto: cada grupo com registros no ano corrente recebe a média do
+    # total dos meses faltantes nos anos anteriores em que ele teve ocorrências nesse período
+    ultimo_mes = int(meses[anos == ano_atual].max())
+    if ultimo_mes < 12 and len(lista_anos) > 1:
+        faltante = por_mes[:, max(len(lista_anos) - 1 - anos_para_media, 0):-1, ultimo_mes:].sum(axis=2)
+        anos_com_registro = (faltante > 0).sum(axis=1)
+        projetar = (anos_com_registro > 0) & (por_mes[:, -1, :].sum(axis=1) > 0)
+        anual[projetar, -1] += faltante[projetar].sum(axis=1) / anos_com_registro[projetar]
+
+    tendencias = {}
+    for janela in janelas:
+        # Com menos anos no histórico, a janela usa todos os que existem
+        x = lista_anos[-(janela + 1):].astype(float)
+        y = anual[:, -(janela + 1):]
+        x_centrado = x - x.mean()
+        denominador = x_centrado @ x_centrado
+        inclinacao = (y - y.mean(axis=1, keepdims=True)) @ x_centrado / denominador if denominador > 0 else np.zeros(len(grupos))
+        tendencias[janela] = {
+            'anos': int(len(x) - 1),
+            'inclinacao': inclinacao,
+            'proximo_ano': np.maximum(y.mean(axis=1) + inclinacao * (ano_atual + 1 - x.mean()), 0)
+        }
+
+    return {
+        'grupos': grupos,
+        'anos': lista_anos,
+        'anual': anual,
+        'ano_atual': int(ano_atual),
+        'ultimo_mes': ultimo_mes,
+        'projecao_ano_atual': anual[:, -1],
+        'tendencias': tendencias
+    }
+
+@bp.route('/')
+@usa_dados('crimes')
 def index():
-    return render_template('index.html', crimes=LISTA_DE_CRIMES)
+    niveis_geometria = [nivel['zoom_max'] for nivel in NIVEIS_GEOMETRIA if nivel['zoom_max'] is not None]
+    return render_template('index.html', crimes=ESTADO_CRIMES['LISTA_DE_CRIMES'], niveis_geometria=niveis_geometria)
+
+# Cache LRU dos datasets customizados já processados, limitado pelo total de bytes em memória. Os datasets
+# no formato colunar são mapeados do disco (números, datas e códigos dos textos): os workers do nó dividem as
+# mesmas páginas pelo page cache e cada processo guarda só o DataFrame e os dicionários, que é o que se conta.
+DATASET_CACHE_MAX_BYTES = int(os.environ.get('MULTIDASH_DATASET_CACHE_MB', '512')) * 1024 * 1024
+cache_datasets = OrderedDict()
+cache_datasets_lock = threading.Lock()
+ESTATISTICAS_CACHE_DATASETS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def assinatura_arquivos(*caminhos):
+    """(mtime, tamanho) de cada arquivo: muda sempre que um deles for reescrito."""
+    assinatura = []
+    for caminho in caminhos:
+        info = os.stat(caminho)
+        assinatura.append((info.st_mtime_ns, info.st_size))
+    return tuple(assinatura)
+
+def invalidar_dataset(dashboard_id):
+    """Remove do cache o dataset de um dashboard (e o índice de filtros e as respostas calculadas sobre ele)."""
+    with cache_datasets_lock:
+        cache_datasets.pop(dashboard_id, None)
+    INDICES_BITMAP.pop(dashboard_id, None)
+    INDICES_ESPACIAIS.pop(dashboard_id, None)
+    VALORES_NUMERICOS.pop(dashboard_id, None)
+    PERFIS_COLUNAS.pop(dashboard_id, None)
+    invalidar_respostas(dashboard_id)
+
+def buscar_dataset_em_cache(dashboard_id, metadata_path):
+    """Retorna o DataFrame em cache se os arquivos do dashboard não mudaram desde a leitura."""
+    with cache_datasets_lock:
+        entrada = cache_datasets.get(dashboard_id)
+    if entrada is None:
+        return None
+    try:
+        assinatura = assinatura_arquivos(metadata_path, entrada['caminho_dados'])
+    except OSError:
+        assinatura = None
+    if assinatura != entrada['assinatura']:
+        invalidar_dataset(dashboard_id)
+        return None
+    with cache_datasets_lock:
+        cache_datasets.move_to_end(dashboard_id)
+        ESTATISTICAS_CACHE_DATASETS['hits'] += 1
+    return entrada['df']
+
+def bytes_privados_dataset(df):
+    """
+    Bytes que o DataFrame ocupa só neste processo: colunas (ou códigos de Categorical) apoiadas em np.memmap
+    ficam no page cache do sistema, compartilhadas entre os workers, e não entram na conta.
+    """
+    total = 0
+    for _, serie in df.items():
+        categorica = isinstance(serie.dtype, pd.CategoricalDtype)
+        valores = serie.array.codes if categorica else serie.to_numpy()
+        if isinstance(valores, np.memmap) or isinstance(valores.base, np.memmap):
+            total += int(serie.cat.categories.memory_usage(deep=True)) if categorica else 0
+        else:
+            total += int(serie.memory_usage(index=False, deep=True))
+    return total
+
+def guardar_dataset_em_cache(dashboard_id, metadata_path, caminho_dados, df):
+    """Guarda o DataFrame processado e descarta os menos usados até caber no limite de bytes."""
+    entrada = {
+        'df': df,
+        'caminho_dados': caminho_dados,
+        'assinatura': assinatura_arquivos(metadata_path, caminho_dados),
+        'bytes': bytes_privados_dataset(df)
+    }
+    with cache_datasets_lock:
+        cache_datasets[dashboard_id] = entrada
+        total = sum(e['bytes'] for e in cache_datasets.values())
+        while total > DATASET_CACHE_MAX_BYTES and len(cache_datasets) > 1:
+            id_removido, removida = cache_datasets.popitem(last=False)
+            INDICES_BITMAP.pop(id_removido, None)
+            INDICES_ESPACIAIS.pop(id_removido, None)
+            VALORES_NUMERICOS.pop(id_removido, None)
+            total -= removida['bytes']
+            ESTATISTICAS_CACHE_DATASETS['evictions'] += 1
+
+# Cache das respostas dos endpoints analíticos: o resultado só depende da rota, do dashboard e do payload,
+# então a mesma combinação de filtros devolve os bytes já serializados. O armazenamento é plugável
+# (MULTIDASH_CACHE_BACKEND): 'memoria' (por processo), 'shm' (arquivos em memória compartilhada, visíveis
+# para todos os workers do nó) ou 'redis' (servidor local compatível com Redis).
+RESPOSTAS_CACHE_BACKEND = os.environ.get('MULTIDASH_CACHE_BACKEND', 'memoria')
+RESPOSTAS_CACHE_MAX_BYTES = int(os.environ.get('MULTIDASH_RESPONSE_CACHE_MB', '64')) * 1024 * 1024
+RESPOSTAS_CACHE_TTL = int(os.environ.get('MULTIDASH_RESPONSE_CACHE_TTL', '300'))
+RESPOSTAS_CACHE_DIR = os.environ.get('MULTIDASH_CACHE_DIR', '/dev/shm/multidash' if os.path.isdir('/dev/shm') else os.path.join(BASE_DIR, 'cache', 'respostas'))
+REDIS_URL = os.environ.get('MULTIDASH_REDIS_URL', 'redis://localhost:6379/0')
+# Contadores do processo atual (cada worker conta os próprios acertos, mesmo com backend compartilhado)
+ESTATISTICAS_CACHE_RESPOSTAS = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+estatisticas_respostas_lock = threading.Lock()
+
+def contar_evento_cache(evento, quantidade=1):
+    with estatisticas_respostas_lock:
+        ESTATISTICAS_CACHE_RESPOSTAS[evento] += quantidade
+
+class CacheRespostasMemoria:
+    """LRU limitado por bytes, com TTL, dentro do processo."""
+    nome = 'memoria'
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entradas = OrderedDict()
+        # Total de bytes mantido a cada inserção e remoção (somar as entradas a cada escrita seria O(n))
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def obter(self, dashboard_id, chave):
+        with self.lock:
+            entrada = self.entradas.get((dashboard_id, chave))
+            if entrada is None:
+                return None
+            if time.monotonic() - entrada['criado_em'] > self.ttl:
+                del self.entradas[(dashboard_id, chave)]
+                self.bytes -= len(entrada['corpo'])
+                contar_evento_cache('expirations')
+                return None
+            self.entradas.move_to_end((dashboard_id, chave))
+            return entrada['corpo']
+
+    def guardar(self, dashboard_id, chave, corpo):
+        with self.lock:
+            anterior = self.entradas.pop((dashboard_id, chave), None)
+            if anterior is not None:
+                self.bytes -= len(anterior['corpo'])
+            self.entradas[(dashboard_id, chave)] = {'corpo': corpo, 'criado_em': time.monotonic()}
+            self.bytes += len(corpo)
+            while self.bytes > self.max_bytes and len(self.entradas) > 1:
+                _, removida = self.entradas.popitem(last=False)
+                self.bytes -= len(removida['corpo'])
+                contar_evento_cache('evictions')
+
+    def invalidar(self, dashboard_id):
+        with self.lock:
+            for chave in [c for c in self.entradas if c[0] == dashboard_id]:
+                self.bytes -= len(self.entradas.pop(chave)['corpo'])
+
+    def estatisticas(self):
+        with self.lock:
+            return {'entradas': len(self.entradas), 'bytes': self.bytes}
+
+class CacheRespostasArquivos:
+    """
+    Um arquivo por resposta em um diretório de memória compartilhada (tmpfs em /dev/shm), visível para
+    todos os workers forkados do nó. Cada dashboard tem seu subdiretório, o que torna a invalidação um rmtree.
+    """
+    nome = 'shm'
+    # Intervalo (s) para recontar o diretório: o total local não vê o que os outros workers gravaram
+    intervalo_varredura = 30
+
+    def __init__(self, diretorio, max_bytes, ttl):
+        self.diretorio = diretorio
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(diretorio, exist_ok=True)
+        # Estimativa dos bytes no diretório: somada a cada gravação e corrigida nas varreduras
+        self.bytes_estimados = None
+        self.ultima_varredura = 0.0
+        self.lock = threading.Lock()
+
+    def caminho_dashboard(self, dashboard_id):
+        # O id vem da query string: vira hash para nunca sair do diretório do cache
+        return os.path.join(self.diretorio, hashlib.sha1(str(dashboard_id).encode('utf-8')).hexdigest()[:16])
+
+    def obter(self, dashboard_id, chave):
+        caminho = os.path.join(self.caminho_dashboard(dashboard_id), f"{chave}.json")
+        try:
+            if time.time() - os.stat(caminho).st_mtime > self.ttl:
+                os.remove(caminho)
+                contar_evento_cache('expirations')
+                return None
+            with open(caminho, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def guardar(self, dashboard_id, chave, corpo):
+        pasta = self.caminho_dashboard(dashboard_id)
+        os.makedirs(pasta, exist_ok=True)
+        caminho = os.path.join(pasta, f"{chave}.json")
+        try:
+            tamanho_anterior = os.stat(caminho).st_size
+        except FileNotFoundError:
+            tamanho_anterior = 0
+        descritor, temporario = tempfile.mkstemp(dir=pasta, suffix='.tmp')
+        with os.fdopen(descritor, 'wb') as f:
+            f.write(corpo)
+        os.replace(temporario, caminho)
+        with self.lock:
+            # Só varre o diretório quando a estimativa passa do limite ou quando a última varredura ficou velha
+            if self.bytes_estimados is not None:
+                self.bytes_estimados += len(corpo) - tamanho_anterior
+            varrer = (self.bytes_estimados is None or self.bytes_estimados > self.max_bytes
+                      or time.monotonic() - self.ultima_varredura > self.intervalo_varredura)
+        if varrer:
+            self.limitar_tamanho()
+
+    def arquivos(self):
+        for raiz, _, nomes in os.walk(self.diretorio):
+            for nome in nomes:
+                if nome.endswith('.json'):
+                    caminho = os.path.join(raiz, nome)
+                    try:
+                        info = os.stat(caminho)
+                    except FileNotFoundError:
+                        continue
+                    yield caminho, info
+
+    def limitar_tamanho(self):
+        """Remove as respostas menos recentemente gravadas até caber no limite (pode rodar em qualquer worker)."""
+        arquivos = sorted(self.arquivos(), key=lambda a: a[1].st_mtime)
+        total = sum(info.st_size for _, info in arquivos)
+        for caminho, info in arquivos[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+            total -= info.st_size
+            contar_evento_cache('evictions')
+        with self.lock:
+            self.bytes_estimados = total
+            self.ultima_varredura = time.monotonic()
+
+    def invalidar(self, dashboard_id):
+        shutil.rmtree(self.caminho_dashboard(dashboard_id), ignore_errors=True)
+        with self.lock:
+            # O tamanho do que foi removido não é conhecido: a próxima gravação recontará o diretório
+            self.bytes_estimados = None
+
+    def estatisticas(self):
+        arquivos = list(self.arquivos())
+        return {'entradas': len(arquivos), 'bytes': sum(info.st_size for _, info in arquivos), 'diretorio': self.diretorio}
+
+class CacheRespostasRedis:
+    """
+    Respostas em um servidor compatível com Redis (SETEX para o TTL). O limite de bytes fica a cargo do
+    'maxmemory' com política LRU do próprio servidor; um conjunto por dashboard permite a invalidação.
+    """
+    nome = 'redis'
+    prefixo = 'multidash:resposta:'
+
+    def __init__(self, url, ttl):
+        import redis  # Dependência opcional: só é exigida com MULTIDASH_CACHE_BACKEND=redis
+        self.cliente = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def obter(self, dashboard_id, chave):
+        return self.cliente.get(f"{self.prefixo}{dashboard_id}:{chave}")
+
+    def guardar(self, dashboard_id, chave, corpo):
+        nome = f"{self.prefixo}{dashboard_id}:{chave}"
+        pipe = self.cliente.pipeline()
+        pipe.setex(nome, self.ttl, corpo)
+        pipe.sadd(f"{self.prefixo}{dashboard_id}", nome)
+        pipe.expire(f"{self.prefixo}{dashboard_id}", self.ttl)
+        pipe.execute()
+
+    def invalidar(self, dashboard_id):
+        conjunto = f"{self.prefixo}{dashboard_id}"
+        nomes = list(self.cliente.smembers(conjunto))
+        if nomes:
+            self.cliente.delete(*nomes)
+        self.cliente.delete(conjunto)
+
+    def estatisticas(self):
+        return {'entradas': sum(1 for nome in self.cliente.scan_iter(f"{self.prefixo}*:*"))}
+
+def criar_cache_respostas(backend):
+    """Instancia o backend configurado; se ele não estiver disponível, cai para o cache em memória."""
+    try:
+        if backend == 'shm':
+            return CacheRespostasArquivos(RESPOSTAS_CACHE_DIR, RESPOSTAS_CACHE_MAX_BYTES, RESPOSTAS_CACHE_TTL)
+        if backend == 'redis':
+            cache = CacheRespostasRedis(REDIS_URL, RESPOSTAS_CACHE_TTL)
+            cache.cliente.ping()
+            return cache
+    except Exception as e:
+        print(f"Aviso: backend de cache '{backend}' indisponível ({e}); usando cache em memória.")
+    return CacheRespostasMemoria(RESPOSTAS_CACHE_MAX_BYTES, RESPOSTAS_CACHE_TTL)
 
-def get_dataframe(dashboard_id=None):
+cache_respostas = criar_cache_respostas(RESPOSTAS_CACHE_BACKEND)
+
+def normalizar_payload(payload):
+    """
+    Forma canônica do JSON da requisição: chaves ordenadas e valores de checkbox limpos e ordenados
+    (a ordem em que o usuário marcou as opções não muda o resultado). Checkboxes vazios são descartados.
+    """
+    if isinstance(payload, dict):
+        normalizado = {}
+        for chave, valor in payload.items():
+            if chave == 'checkboxes' and isinstance(valor, dict):
+                valor = {col: sorted({str(v).strip() for v in valores}) for col, valores in valor.items() if valores}
+            normalizado[chave] = normalizar_payload(valor)
+        return normalizado
+    if isinstance(payload, list):
+        return [normalizar_payload(v) for v in payload]
+    return payload
+
+def invalidar_respostas(dashboard_id):
+    """Descarta as respostas em cache de um dashboard (None = dataset padrão)."""
+    try:
+        cache_respostas.invalidar(dashboard_id)
+    except Exception as e:
+        print(f"Aviso: falha ao invalidar o cache de respostas do dashboard {dashboard_id}: {e}")
+
+def cache_resposta(func):
+    """Decorador das rotas analíticas: guarda a resposta 200 serializada no backend de cache configurado."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        payload = json.dumps(normalizar_payload(request.get_json(silent=True)), sort_keys=True, ensure_ascii=False)
+        dashboard_id = request.args.get('dashboard_id') or None
+        # Parâmetros da URL (ex.: zoom/bbox do mapa de calor) também definem a resposta
+        parametros = sorted(request.args.items(multi=True))
+        versao = ''
+        if dashboard_id is None:
+            # A versão do dataset padrão entra na chave: respostas calculadas antes de uma anexação não são servidas depois
+            garantir_dados_crimes()
+            versao = ESTADO_CSV_CRIMES['bytes_lidos']
+        chave = hashlib.sha1(f"{request.path}|{parametros}|{payload}|{versao}".encode('utf-8')).hexdigest()
+
+        try:
+            corpo = cache_respostas.obter(dashboard_id, chave)
+        except Exception as e:
+            # Cache fora do ar não pode derrubar a rota: só calcula de novo
+            print(f"Aviso: falha ao consultar o cache de respostas: {e}")
+            corpo = None
+        if corpo is not None:
+            contar_evento_cache('hits')
+            response = current_app.response_class(corpo, mimetype='application/json')
+            response.headers['X-Cache'] = 'HIT'
+            return response
+        contar_evento_cache('misses')
+
+        response = current_app.make_response(func(*args, **kwargs))
+        if response.status_code == 200 and response.mimetype == 'application/json' and not response.is_streamed:
+            try:
+                cache_respostas.guardar(dashboard_id, chave, response.get_data())
+            except Exception as e:
+                print(f"Aviso: falha ao gravar no cache de respostas: {e}")
+        response.headers['X-Cache'] = 'MISS'
+        return response
+    return wrapper
+
+def ler_metadados_dashboard(dashboard_id):
+    """Lê o JSON de metadados de um dashboard (None se não existir)."""
+    metadata_path = os.path.join(BASE_DIR, 'dashboards', f"{dashboard_id}.json")
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def ler_csv_dashboard(csv_path):
+    """Lê o CSV de um dashboard, convertendo a coluna 'DATA' e normalizando as colunas de texto."""
+    df_custom = pd.read_csv(csv_path)
+    
+    # --- MUDANÇA CRUCIAL AQUI ---
+    # Tenta converter a coluna 'DATA' apenas se ela existir no CSV
+    if 'DATA' in df_custom.columns:
+        df_custom['DATA'] = pd.to_datetime(df_custom['DATA'], dayfirst=True, errors='coerce')
+    
+    return normalizar_colunas_texto(df_custom)
+
+# Ingestão em blocos: memória limitada a um bloco de linhas (mais o dicionário das colunas de texto)
+TAMANHO_BLOCO_INGESTAO = int(os.environ.get('MULTIDASH_CHUNK_ROWS', '100000'))
+AMOSTRA_LINHAS_ANALISE = 10000
+
+def dtype_codigos_texto(categorias):
+    """Tipo inteiro dos códigos que o pandas usa num Categorical com essas categorias (int8 até int64)."""
+    return pd.Categorical.from_codes(np.empty(0, dtype=np.int8), dtype=pd.CategoricalDtype(categorias)).codes.dtype
+
+def codificar_bloco_texto(dicionario, serie):
+    """Códigos int32 de um bloco de texto, traduzidos para o dicionário global da coluna (que cresce aqui)."""
+    texto = serie.where(serie.isna(), serie.str.strip())
+    codigos, unicos = pd.factorize(texto)
+    mapa = np.array([dicionario.setdefault(v, len(dicionario)) for v in unicos] + [-1], dtype=np.int32)
+    return mapa[codigos]
+
+def converter_csv_para_colunar(csv_path, destino, tamanho_bloco=None):
+    """
+    Converte um CSV para o formato colunar lendo-o em blocos: um arquivo binário por coluna
+    (datas como datetime64, números, textos como códigos + dicionário) e um manifest.json.
+    Os tipos são decididos por uma amostra do início do arquivo; os blocos seguintes são
+    convertidos para o mesmo tipo. Uma coluna numérica na amostra que traga texto mais adiante é
+    regravada como texto (relida do CSV), sem perder valores, e tem o tipo detectado de novo.
+    Retorna (caminho do manifesto, tipos detectados).
+    """
+    tamanho_bloco = tamanho_bloco or TAMANHO_BLOCO_INGESTAO
+    amostra = pd.read_csv(csv_path, nrows=AMOSTRA_LINHAS_ANALISE)
+    if 'DATA' in amostra.columns:
+        amostra['DATA'] = pd.to_datetime(amostra['DATA'], dayfirst=True, errors='coerce')
+    column_types = [{'name': col, 'type': detectar_tipo_coluna(amostra[col])} for col in amostra.columns]
+
+    colunas = []
+    for i, col in enumerate(amostra.columns):
+        if col == 'DATA':
+            tipo = 'data'
+        elif pd.api.types.is_numeric_dtype(amostra[col]):
+            tipo = 'numerico'
+        else:
+            tipo = 'texto'
+        colunas.append({'nome': col, 'arquivo': f"col_{i}.bin", 'tipo': tipo, 'nulos': 0,
+                        'invalidos': 0, 'inteiro': True, 'booleano': True, 'dicionario': {}})
+
+    # Colunas de texto (e a DATA) são lidas como string em todos os blocos, para não variar o tipo entre blocos
+    dtype_leitura = {info['nome']: str for info in colunas if info['tipo'] != 'numerico'}
+
+    os.makedirs(destino, exist_ok=True)
+    arquivos = {info['nome']: open(os.path.join(destino, info['arquivo']), 'wb') for info in colunas}
+    n_linhas = 0
+    try:
+        for bloco in pd.read_csv(csv_path, chunksize=tamanho_bloco, dtype=dtype_leitura):
+            for info in colunas:
+                serie = bloco[info['nome']]
+                info['nulos'] += int(serie.isna().sum())
+                if info['tipo'] == 'data':
+                    valores = pd.to_datetime(serie, dayfirst=True, errors='coerce').to_numpy(dtype='datetime64[ns]')
+                elif info['tipo'] == 'numerico':
+                    numeros = pd.to_numeric(serie, errors='coerce')
+                    info['invalidos'] += int((numeros.isna() & serie.notna()).sum())
+                    info['inteiro'] &= pd.api.types.is_integer_dtype(numeros)
+                    info['booleano'] &= pd.api.types.is_bool_dtype(numeros)
+                    valores = numeros.to_numpy(dtype=np.float64)
+                else:
+                    valores = codificar_bloco_texto(info['dicionario'], serie)
+                valores.tofile(arquivos[info['nome']])
+            n_linhas += len(bloco)
+    finally:
+        for arquivo in arquivos.values():
+            arquivo.close()
+
+    # Texto depois da amostra numa coluna numérica: o to_numeric teria virado NaN, então a coluna vira texto
+    rebaixadas = [info for info in colunas if info['tipo'] == 'numerico' and info['invalidos']]
+    for info in rebaixadas:
+        print(f"Aviso: a coluna '{info['nome']}' tem {info['invalidos']} valores não numéricos depois da amostra; gravada como texto.")
+        info.update({'tipo': 'texto', 'invalidos': 0})
+        with open(os.path.join(destino, info['arquivo']), 'wb') as arquivo:
+            for bloco in pd.read_csv(csv_path, chunksize=tamanho_bloco, usecols=[info['nome']], dtype=str):
+                codificar_bloco_texto(info['dicionario'], bloco[info['nome']]).tofile(arquivo)
+
+    for info in colunas:
+        caminho = os.path.join(destino, info['arquivo'])
+        if info['tipo'] == 'data':
+            info['dtype'] = np.dtype('datetime64[ns]').str
+        elif info['tipo'] == 'numerico':
+            # Os blocos foram gravados como float64; volta para inteiro/booleano se todos os blocos eram assim
+            dtype_final = np.bool_ if info['booleano'] else np.int64 if info['inteiro'] else np.float64
+            if dtype_final is not np.float64 and n_linhas > 0:
+                convertido = np.fromfile(caminho, dtype=np.float64).astype(dtype_final)
+                convertido.tofile(caminho)
+            info['dtype'] = np.dtype(dtype_final).str
+        else:
+            info['categorias'] = list(info['dicionario'])
+            info['categorico'] = len(info['categorias']) <= 0.5 * n_linhas
+            # Códigos no mesmo tipo que o pandas usa para esse dicionário: a carga não precisa copiá-los
+            dtype_final = dtype_codigos_texto(info['categorias'])
+            if dtype_final != np.int32 and n_linhas > 0:
+                np.fromfile(caminho, dtype=np.int32).astype(dtype_final).tofile(caminho)
+            info['dtype'] = dtype_final.str
+        for chave in ('inteiro', 'booleano', 'dicionario'):
+            info.pop(chave)
+
+    manifest_path = os.path.join(destino, 'manifest.json')
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump({'versao': 1, 'n_linhas': n_linhas, 'colunas': colunas}, f, ensure_ascii=False)
+
+    # O tipo das colunas regravadas é detectado de novo sobre a coluna inteira
+    if rebaixadas:
+        df_rebaixadas = carregar_dataset_colunar(manifest_path, [info['nome'] for info in rebaixadas])
+        for tipo in column_types:
+            if tipo['name'] in df_rebaixadas.columns:
+                tipo['type'] = detectar_tipo_coluna(df_rebaixadas[tipo['name']])
+    return manifest_path, column_types
+
+def localizar_municipios(lat, lon):
+    """
+    Para cada ponto, o índice (em gdf_municipios_raw) do município que o contém, ou -1 se nenhum.
+    Usa consultas em lote na STRtree dos polígonos, em blocos, em vez de um 'contains' por linha.
+    """
+    import shapely
+    garantir_dados_geo()
+    resultado = np.full(len(lat), -1, dtype=np.int32)
+    posicoes = np.flatnonzero(~np.isnan(lat) & ~np.isnan(lon))
+    for inicio in range(0, len(posicoes), TAMANHO_BLOCO_INGESTAO):
+        bloco = posicoes[inicio:inicio + TAMANHO_BLOCO_INGESTAO]
+        entrada, poligono = ARVORE_MUNICIPIOS.query(shapely.points(lon[bloco], lat[bloco]), predicate='intersects')
+        # Ponto exatamente na divisa de dois municípios: fica com o de menor índice
+        escolhido = np.full(len(bloco), np.iinfo(np.int32).max, dtype=np.int64)
+        np.minimum.at(escolhido, entrada, poligono)
+        encontrados = escolhido != np.iinfo(np.int32).max
+        resultado[bloco[encontrados]] = escolhido[encontrados]
+    return resultado
+
+def gravar_coluna_texto_colunar(manifest, destino, nome, serie):
+    """Grava (ou substitui) uma coluna de texto no formato colunar: códigos inteiros + dicionário no manifesto."""
+    codigos, categorias = pd.factorize(serie)
+    existente = next((info for info in manifest['colunas'] if info['nome'] == nome), None)
+    info = existente or {'nome': nome, 'arquivo': f"col_{len(manifest['colunas'])}.bin", 'tipo': 'texto', 'invalidos': 0}
+    caminho = os.path.join(destino, info['arquivo'])
+    dtype = dtype_codigos_texto(categorias)
+    codigos.astype(dtype).tofile(f"{caminho}.tmp")
+    os.replace(f"{caminho}.tmp", caminho)
+    info.update({
+        'tipo': 'texto', 'dtype': dtype.str, 'nulos': int((codigos < 0).sum()),
+        'categorias': categorias.tolist(), 'categorico': len(categorias) <= 0.5 * len(serie)
+    })
+    if existente is None:
+        manifest['colunas'].append(info)
+
+def atribuir_regioes_colunar(manifest_path):
+    """
+    Etapa de ingestão dos datasets com LATITUDE/LONGITUDE: cada linha recebe o MUNICIPIO que contém o ponto e a
+    AIS desse município, gravados como colunas do formato colunar (valores já presentes no arquivo têm prioridade).
+    Retorna os nomes das colunas criadas.
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    tipos = {info['nome']: info['tipo'] for info in manifest['colunas']}
+    if 'LATITUDE' not in tipos or 'LONGITUDE' not in tipos or manifest['n_linhas'] == 0:
+        return []
+
+    # Colunas numéricas já existentes (ex.: AIS como número) não são sobrescritas
+    alvos = [col for col in ('MUNICIPIO', 'AIS') if tipos.get(col, 'texto') == 'texto']
+    if not alvos:
+        return []
+    df = carregar_dataset_colunar(manifest_path, ['LATITUDE', 'LONGITUDE'] + [col for col in alvos if col in tipos])
+    lat = pd.to_numeric(df['LATITUDE'], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(df['LONGITUDE'], errors='coerce').to_numpy(dtype=float)
+
+    posicoes = localizar_municipios(lat, lon)
+    nomes = gdf_municipios_raw['name'].to_numpy(dtype=object)
+    municipio = pd.Series(np.where(posicoes >= 0, nomes[np.maximum(posicoes, 0)], None), dtype=object)
+    calculadas = {'MUNICIPIO': municipio, 'AIS': municipio.map(municipios_ais_map)}
+
+    destino = os.path.dirname(manifest_path)
+    for col in alvos:
+        valores = calculadas[col]
+        if col in df.columns:
+            originais = df[col].astype(object)
+            valores = originais.where(originais.notna(), valores)
+        gravar_coluna_texto_colunar(manifest, destino, col, valores)
+
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    return [col for col in alvos if col not in tipos]
+
+def carregar_dataset_colunar(manifest_path, columns=None):
+    """
+    Carrega um dataset colunar mapeando os arquivos em memória (np.memmap), de modo que
+    vários processos compartilhem as mesmas páginas. 'columns' restringe as colunas lidas.
+    Textos viram Categorical sobre os próprios códigos mapeados (o dicionário decodifica sob demanda);
+    só manifestos antigos, com códigos int32 para dicionários pequenos, ainda geram uma cópia.
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    destino = os.path.dirname(manifest_path)
+    n_linhas = manifest['n_linhas']
+
+    dados = {}
+    for info in manifest['colunas']:
+        if columns is not None and info['nome'] not in columns:
+            continue
+        dtype = np.dtype(info['dtype'])
+        if n_linhas == 0:
+            valores = np.empty(0, dtype=dtype)
+        else:
+            valores = np.memmap(os.path.join(destino, info['arquivo']), dtype=dtype, mode='r', shape=(n_linhas,))
+        if info['tipo'] == 'texto':
+            valores = pd.Categorical.from_codes(valores, dtype=pd.CategoricalDtype(info['categorias']), validate=False)
+        dados[info['nome']] = valores
+    return pd.DataFrame(dados, copy=False)
+
+def get_dataframe(dashboard_id=None, columns=None):
     if dashboard_id:
         dashboards_dir = os.path.join(BASE_DIR, 'dashboards')
         metadata_path = os.path.join(dashboards_dir, f"{dashboard_id}.json")
         if os.path.exists(metadata_path):
+            df_cache = buscar_dataset_em_cache(dashboard_id, metadata_path)
+            if df_cache is not None:
+                return df_cache
+
             with open(metadata_path, 'r', encoding='utf-8') as f:
                 metadata = json.load(f)
-            csv_path = metadata.get("csv_path")
-            if csv_path and os.path.exists(csv_path):
-                df_custom = pd.read_csv(csv_path)
-                
-                # --- MUDANÇA CRUCIAL AQUI ---
-                # Tenta converter a coluna 'DATA' apenas se ela existir no CSV
-                if 'DATA' in df_custom.columns:
-                    df_custom['DATA'] = pd.to_datetime(df_custom['DATA'], dayfirst=True, errors='coerce')
-                
+
+            # Preferência pelo formato colunar gerado no upload; dashboards antigos ainda leem o CSV
+            data_path = metadata.get("data_path")
+            if data_path and os.path.exists(data_path):
+                if columns is not None:
+                    # Projeção de colunas: leitura parcial, sem passar pelo cache
+                    return carregar_dataset_colunar(data_path, columns)
+                caminho_dados = data_path
+                leitor = carregar_dataset_colunar
+            else:
+                caminho_dados = metadata.get("csv_path")
+                leitor = ler_csv_dashboard
+
+            if caminho_dados and os.path.exists(caminho_dados):
+                with cache_datasets_lock:
+                    ESTATISTICAS_CACHE_DATASETS['misses'] += 1
+                # O dataset pode ter mudado: o índice de filtros antigo não vale mais
+                INDICES_BITMAP.pop(dashboard_id, None)
+                INDICES_ESPACIAIS.pop(dashboard_id, None)
+                VALORES_NUMERICOS.pop(dashboard_id, None)
+                df_custom = leitor(caminho_dados)
+                guardar_dataset_em_cache(dashboard_id, metadata_path, caminho_dados, df_custom)
                 return df_custom
     
     # Fallback para o dataframe padrão
-    return df_crimes_raw
+    garantir_dados_crimes()
+    return ESTADO_CRIMES['df_crimes_raw']
 
-@app.route('/api/schema')
+@bp.route('/api/schema')
+@cache_resposta
 def get_schema():
     dashboard_id = request.args.get('dashboard_id')
-    df = get_dataframe(dashboard_id)
     
     # Define as colunas padrão
-    filterable_columns = [
-        'NATUREZA', 'MUNICIPIO', 'LOCAL', 'DIA_SEMANA', 'MEIO_EMPREGADO', 
-        'GENERO', 'ORIENTACAO_SEXUAL', 'IDADE_VITIMA', 'ESCOLARIDADE_VITIMA', 'RACA_VITIMA'
-    ]
+    filterable_columns = COLUNAS_FILTRAVEIS_PADRAO
     
     # Se for um dashboard customizado, usa as colunas salvas nos metadados
     if dashboard_id:
-        dashboards_dir = os.path.join(BASE_DIR, 'dashboards')
-        metadata_path = os.path.join(dashboards_dir, f"{dashboard_id}.json")
-        if os.path.exists(metadata_path):
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
+        metadata = ler_metadados_dashboard(dashboard_id)
+        if metadata:
             filterable_columns = metadata.get("filterable_columns", filterable_columns)
 
+    # Os valores distintos já estão ordenados no perfil; só colunas fora dele (ex.: alta cardinalidade) varrem o dataset
+    perfil = obter_perfil_colunas(dashboard_id)
     schema = {}
     for col in filterable_columns:
-        if col in df.columns:
-            unique_values = df[col].dropna().unique().tolist()
-            try:
-                schema[col] = sorted(unique_values)
-            except TypeError:
-                schema[col] = unique_values
+        info = perfil['colunas'].get(col)
+        if info is None:
+            continue
+        if info['values'] is not None:
+            schema[col] = info['values']
+            continue
+        unique_values = get_dataframe(dashboard_id, columns=[col] if dashboard_id else None)[col].dropna().unique().tolist()
+        try:
+            schema[col] = sorted(unique_values)
+        except TypeError:
+            schema[col] = unique_values
                 
     return jsonify(schema)
 
-@app.route('/api/map_data/<string:view_type>', methods=['POST'])
+def calcular_mapa(view_type, df_base, filters, dashboard_id, indice, args, selecao=None):
+    """
+    Dados de uma visualização do mapa ('municipality', 'ais' ou 'heatmap'); 'args' traz os parâmetros de
+    consulta (zoom, bbox). Devolve (resposta, status) para a rota do mapa e para o /api/batch.
+    """
+    # No dataset padrão, as contagens saem do cubo pré-agregado
+    usar_cubo = not dashboard_id
+    if view_type == 'municipality':
+        # O nível de detalhe da geometria acompanha o zoom do mapa (?zoom=)
+        nivel = nivel_geometria(GEOMETRIAS_SERIALIZADAS['municipality'], args.get('zoom', type=float))
+        crime_counts = contar_ocorrencias(df_base, filters, ['MUNICIPIO'], usar_cubo, indice, selecao)
+        espaco = obter_espaco_municipios()
+        if crime_counts.empty:
+            # Retorna os atributos vazios; o frontend usa a geometria já em cache
+            return {
+                'attributes': {},
+                'geometry_url': url_geometria('municipality', nivel),
+                'geometry_etag': nivel['geojson']['etag'],
+                'max_taxa': 0, 
+                'taxa_media_estado': 0, 
+                'total_municipios': int(espaco['tem_populacao'].sum())
+            }, 200
+
+        quantidade = contagens_por_municipio(espaco, crime_counts)
+        populacao = espaco['populacao']
+        taxa = taxas_por_100k(quantidade, populacao)
+
+        # Ranking pela taxa (decrescente) entre os municípios que constam no arquivo de população
+        com_populacao = np.flatnonzero(espaco['tem_populacao'])
+        ranking = np.zeros(len(taxa), dtype=int)
+        ranking[com_populacao[np.argsort(-taxa[com_populacao], kind='stable')]] = np.arange(1, len(com_populacao) + 1)
+
+        # Calcula a média apenas para municípios com população > 0 para evitar distorções
+        taxa_media_estado = taxa[populacao > 0].mean() if (populacao > 0).any() else 0
+
+        # Só os atributos, indexados pelo id de cada feição, sem tocar nas geometrias
+        atributos = {
+            str(id_geo): {'QUANTIDADE': int(q), 'populacao': int(p), 'TAXA_POR_100K': float(t), 'ranking': int(r)}
+            for id_geo, q, p, t, r in zip(espaco['ids_geo'], quantidade, populacao, taxa, ranking)
+        }
+
+        return {
+            'attributes': atributos,
+            'geometry_url': url_geometria('municipality', nivel),
+            'geometry_etag': nivel['geojson']['etag'],
+            'max_taxa': float(taxa.max()) if len(taxa) else 0,
+            'taxa_media_estado': float(taxa_media_estado),
+            'total_municipios': int(len(com_populacao))
+        }, 200
+
+    elif view_type == 'ais':
+        nivel = nivel_geometria(GEOMETRIAS_SERIALIZADAS['ais'], args.get('zoom', type=float))
+        crime_counts = contar_ocorrencias(df_base, filters, ['MUNICIPIO'], usar_cubo, indice, selecao)
+        if crime_counts.empty:
+            return {'attributes': {}, 'geometry_url': url_geometria('ais', nivel), 'geometry_etag': nivel['geojson']['etag'], 'max_taxa': 0}, 200
+
+        # Município -> AIS pelo vetor de códigos do espaço canônico: a soma por AIS é um bincount
+        espaco = obter_espaco_municipios()
+        quantidade_municipios = contagens_por_municipio(espaco, crime_counts)
+        com_ais = espaco['ais_codigo'] >= 0
+        quantidade = np.bincount(espaco['ais_codigo'][com_ais], weights=quantidade_municipios[com_ais], minlength=len(espaco['ais_nomes']))
+        populacao = espaco['populacao_ais']
+        taxa = taxas_por_100k(quantidade, populacao)
+
+        atributos = {
+            nome: {'QUANTIDADE': int(q), 'populacao': int(p), 'TAXA_POR_100K': float(t)}
+            for nome, q, p, t in zip(espaco['ais_nomes'], quantidade, populacao, taxa)
+        }
+        
+        return {
+            'attributes': atributos,
+            'geometry_url': url_geometria('ais', nivel),
+            'geometry_etag': nivel['geojson']['etag'],
+            'max_taxa': float(taxa.max()) if len(taxa) else 0
+        }, 200
+
+    elif view_type == 'heatmap':
+        # Verifica se as colunas de latitude/longitude existem no dataframe carregado
+        if 'LATITUDE' not in df_base.columns or 'LONGITUDE' not in df_base.columns:
+            return [], 200 # Retorna vazio se não houver dados de geolocalização
+
+        # Com zoom/bbox, agrega no servidor em uma grade do tamanho da tela
+        if 'zoom' in args or 'bbox' in args:
+            indice_espacial = obter_indice_espacial(dashboard_id, df_base)
+            try:
+                zoom = float(args.get('zoom', 7))
+            except ValueError:
+                zoom = float('nan')
+            if not np.isfinite(zoom):
+                return {"error": "zoom deve ser um número finito."}, 400
+            zoom = min(max(zoom, 0.0), 22.0)
+            if args.get('bbox'):
+                try:
+                    bbox = [float(v) for v in args['bbox'].split(',')]
+                except ValueError:
+                    bbox = []
+                if len(bbox) != 4 or not np.all(np.isfinite(bbox)) or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+                    return {"error": "bbox deve ser 'oeste,sul,leste,norte'."}, 400
+            elif len(indice_espacial['lon']):
+                bbox = [indice_espacial['lon'][0], indice_espacial['lat'].min(), indice_espacial['lon'][-1], indice_espacial['lat'].max()]
+            else:
+                return {'cells': [], 'grid': [0, 0], 'max': 0, 'total': 0}, 200
+            mascara = selecao.mascara if selecao is not None else mascara_por_indice(df_base, filters, indice)
+            return agregar_heatmap(indice_espacial, mascara, bbox, zoom), 200
+
+        df_filtered = selecao.df if selecao is not None else apply_filters(df_base, filters, indice)
+
+        df_com_local = df_filtered.dropna(subset=['LATITUDE', 'LONGITUDE'])
+        if df_com_local.empty:
+            return [], 200
+        
+        points = df_com_local[['LATITUDE', 'LONGITUDE']].values.tolist()
+        return points, 200
+
+    return {"error": "Tipo de visualização inválido"}, 400
+
+@bp.route('/api/map_data/<string:view_type>', methods=['POST'])
+@cache_resposta
+@usa_dados('crimes', 'geo')
 def get_map_data(view_type):
     # 1. IDENTIFICA O DASHBOARD E CARREGA O DATAFRAME CORRETO
     dashboard_id = request.args.get('dashboard_id')
-    df_crimes_raw = get_dataframe(dashboard_id) # Usa a função auxiliar que criamos
+    df_base = get_dataframe(dashboard_id) # Usa a função auxiliar que criamos
 
     # 2. APLICA OS FILTROS DA SIDEBAR
     filters = request.get_json()
-    df_filtered = apply_filters(df_crimes_raw, filters) # Sua função de filtro existente
+    indice = obter_indice_bitmap(dashboard_id, df_base)
 
-    # 3. LÓGICA DE VISUALIZAÇÃO (seu código original, agora usando os dataframes corretos)
+    # 3. LÓGICA DE VISUALIZAÇÃO (ver calcular_mapa)
     try:
-        if view_type == 'municipality':
-            if df_filtered.empty:
-                # Retorna o mapa vazio, mas com as geometrias
-                empty_gdf = gdf_municipios_raw.copy()
-                empty_gdf['QUANTIDADE'] = 0
-                empty_gdf['TAXA_POR_100K'] = 0
-                empty_gdf['ranking'] = 0
-                return jsonify({
-                    'geojson': json.loads(empty_gdf.to_json()), 
-                    'max_taxa': 0, 
-                    'taxa_media_estado': 0, 
-                    'total_municipios': len(df_populacao)
-                })
-
-            crime_counts = df_filtered.groupby('MUNICIPIO').size().reset_index(name='QUANTIDADE')
-            merged_df = pd.merge(df_populacao, crime_counts, left_on='municipio', right_on='MUNICIPIO', how='left').drop(columns=['MUNICIPIO'])
-            merged_df['QUANTIDADE'] = merged_df['QUANTIDADE'].fillna(0).astype(int)
-            
-            merged_df['TAXA_POR_100K'] = 0.0
-            mask_pop_valida = merged_df['populacao'] > 0
-            merged_df.loc[mask_pop_valida, 'TAXA_POR_100K'] = (merged_df.loc[mask_pop_valida, 'QUANTIDADE'] / merged_df.loc[mask_pop_valida, 'populacao']) * 100000
-            
-            merged_df_sorted = merged_df.sort_values(by='TAXA_POR_100K', ascending=False).reset_index(drop=True)
-            merged_df_sorted['ranking'] = merged_df_sorted.index + 1
-            
-            # Calcula a média apenas para municípios com população > 0 para evitar distorções
-            taxa_media_estado = merged_df_sorted[merged_df_sorted['populacao'] > 0]['TAXA_POR_100K'].mean()
-            
-            merged_df = pd.merge(merged_df, merged_df_sorted[['municipio', 'ranking']], on='municipio', how='left')
-            
-            # Usa o gdf_municipios_raw que deve estar carregado globalmente
-            geo_df_merged = gdf_municipios_raw.merge(merged_df, left_on='name', right_on='municipio', how='left').fillna(0)
-            max_taxa = geo_df_merged['TAXA_POR_100K'].max()
-
-            return jsonify({
-                'geojson': json.loads(geo_df_merged.to_json()),
-                'max_taxa': max_taxa if pd.notna(max_taxa) else 0,
-                'taxa_media_estado': taxa_media_estado if pd.notna(taxa_media_estado) else 0,
-                'total_municipios': len(merged_df)
-            })
-
-        elif view_type == 'ais':
-            if df_filtered.empty:
-                empty_gdf = gdf_ais.copy()
-                empty_gdf['QUANTIDADE'] = 0
-                empty_gdf['TAXA_POR_100K'] = 0
-                return jsonify({'geojson': json.loads(empty_gdf.to_json()), 'max_taxa': 0})
-
-            # Certifique-se que o 'municipios_ais_map' está disponível
-            df_filtered['AIS_MAPEADA'] = df_filtered['MUNICIPIO'].map(municipios_ais_map)
-            crimes_agregados_ais = df_filtered.groupby('AIS_MAPEADA').size().reset_index(name='QUANTIDADE')
-            
-            # Certifique-se que o 'pop_por_ais' está disponível
-            crimes_com_pop_ais = pd.merge(crimes_agregados_ais, pop_por_ais, left_on='AIS_MAPEADA', right_on='AIS', how='left')
-            crimes_com_pop_ais.dropna(subset=['populacao'], inplace=True)
-            
-            crimes_com_pop_ais['TAXA_POR_100K'] = 0.0
-            mask_pop_valida_ais = crimes_com_pop_ais['populacao'] > 0
-            crimes_com_pop_ais.loc[mask_pop_valida_ais, 'TAXA_POR_100K'] = (crimes_com_pop_ais.loc[mask_pop_valida_ais, 'QUANTIDADE'] / crimes_com_pop_ais.loc[mask_pop_valida_ais, 'populacao']) * 100000
-
-            # Certifique-se que o 'gdf_ais' está disponível
-            mapa_completo = gdf_ais.merge(crimes_com_pop_ais, left_on='AIS', right_on='AIS_MAPEADA', how='left').fillna(0)
-            max_taxa = mapa_completo['TAXA_POR_100K'].max()
-            
-            return jsonify({'geojson': json.loads(mapa_completo.to_json()), 'max_taxa': max_taxa if pd.notna(max_taxa) else 0})
-
-        elif view_type == 'heatmap':
-            # Verifica se as colunas de latitude/longitude existem no dataframe carregado
-            if 'LATITUDE' not in df_filtered.columns or 'LONGITUDE' not in df_filtered.columns:
-                return jsonify([]) # Retorna vazio se não houver dados de geolocalização
-
-            df_com_local = df_filtered.dropna(subset=['LATITUDE', 'LONGITUDE'])
-            if df_com_local.empty:
-                return jsonify([])
-            
-            points = df_com_local[['LATITUDE', 'LONGITUDE']].values.tolist()
-            return jsonify(points)
-
-        return jsonify({"error": "Tipo de visualização inválido"}), 400
+        resposta, status = calcular_mapa(view_type, df_base, filters, dashboard_id, indice, request.args)
+        return jsonify(resposta), status
 
     except Exception as e:
         # Log detalhado do erro no servidor para depuração
@@ -295,7 +2155,231 @@ def get_map_data(view_type):
         print(traceback.format_exc())
         return jsonify({"error": f"Erro interno no servidor: {str(e)}"}), 500
 
-@app.route('/api/correlation_data')
+@bp.route('/api/geometry/<string:layer>')
+@usa_dados('geo')
+def get_geometry(layer):
+    """
+    Entrega a geometria pré-serializada de uma camada, com ETag para cache no navegador.
+    ?zoom= escolhe o nível de detalhe; ?format=quantized devolve a codificação quantizada.
+    """
+    camada = GEOMETRIAS_SERIALIZADAS.get(layer)
+    if camada is None:
+        return jsonify({"error": f"Camada '{layer}' não encontrada."}), 404
+    formato = request.args.get('format', 'geojson')
+    if formato not in ('geojson', 'quantized'):
+        return jsonify({"error": "Formato inválido: use 'geojson' ou 'quantized'."}), 400
+
+    nivel = nivel_geometria(camada, request.args.get('zoom', type=float))
+    geometria = nivel['quantizado'] if formato == 'quantized' else nivel['geojson']
+    response = current_app.response_class(geometria['body'], mimetype='application/json')
+    response.set_etag(geometria['etag'])
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
+
+# --- Vector tiles (MVT) das camadas do mapa ---
+# A geometria nunca muda em tempo de execução: cada tile é gerado uma vez, gravado em disco e servido
+# com cache "para sempre"; as estatísticas por filtro continuam vindo do map_data (tabela de atributos).
+EXTENSAO_TILE = 4096
+BUFFER_TILE = 64
+TILES_DIR = os.path.join(BASE_DIR, 'cache', 'tiles')
+LIMITE_MERCATOR = 20037508.342789244
+# Acima deste zoom o nível mais detalhado da geometria já não muda: o cliente amplia as tiles desse zoom
+MAX_ZOOM_TILE = 16
+# Só as tiles até este zoom vão para o disco: com o recorte pela extensão da camada, o estado inteiro dá
+# alguns milhares de arquivos. As de zoom maior são geradas a cada pedido e ficam só no cache HTTP
+MAX_ZOOM_TILE_DISCO = int(os.environ.get('MULTIDASH_TILE_CACHE_MAX_ZOOM', '12'))
+# Colunas de cada camada nas tiles: id numérico da feição (quando existir) e propriedades
+CAMADAS_TILE = {
+    'municipality': {'id': 'id', 'propriedades': ['id', 'name']},
+    'ais': {'id': None, 'propriedades': ['AIS']},
+}
+camadas_mercator = {}
+camadas_mercator_lock = threading.Lock()
+
+def varint_protobuf(valor):
+    """Inteiro sem sinal no formato varint do protobuf."""
+    saida = bytearray()
+    while True:
+        byte = valor & 0x7F
+        valor >>= 7
+        if valor:
+            saida.append(byte | 0x80)
+        else:
+            saida.append(byte)
+            return bytes(saida)
+
+def campo_protobuf(numero, tipo, conteudo):
+    """Chave do campo + conteúdo: tipo 0 (varint) recebe um int, tipo 2 (length-delimited) recebe bytes."""
+    if tipo == 0:
+        return varint_protobuf(numero << 3) + varint_protobuf(conteudo)
+    return varint_protobuf(numero << 3 | 2) + varint_protobuf(len(conteudo)) + conteudo
+
+def zigzag(valor):
+    return (valor << 1) ^ (valor >> 31)
+
+def comandos_poligono(aneis, cursor):
+    """
+    Codifica os anéis de um polígono (em coordenadas da tile, y para baixo) como comandos MVT, com deltas a partir
+    do 'cursor' (a posição onde a feição parou). O anel externo precisa ter área positiva e os internos área
+    negativa; anéis que degeneram após o arredondamento são descartados. Retorna (comandos, novo cursor).
+    """
+    comandos = []
+    for i, anel in enumerate(aneis):
+        pontos = anel[:-1] if len(anel) > 1 and (anel[0] == anel[-1]).all() else anel
+        # Remove pontos repetidos consecutivos (acontece ao arredondar para a grade da tile)
+        if len(pontos):
+            pontos = pontos[np.r_[True, (np.diff(pontos, axis=0) != 0).any(axis=1)]]
+        if len(pontos) < 3:
+            if i == 0:
+                return [], cursor
+            continue
+        area = np.sum(pontos[:, 0] * np.roll(pontos[:, 1], -1) - np.roll(pontos[:, 0], -1) * pontos[:, 1])
+        if area == 0:
+            if i == 0:
+                return [], cursor
+            continue
+        if (area > 0) != (i == 0):
+            pontos = pontos[::-1]
+        deltas = np.diff(np.vstack([cursor, pontos]), axis=0)
+        comandos.append(1 | (1 << 3))  # MoveTo, 1 ponto
+        comandos.extend([zigzag(int(deltas[0, 0])), zigzag(int(deltas[0, 1]))])
+        comandos.append(2 | ((len(pontos) - 1) << 3))  # LineTo, n-1 pontos
+        for dx, dy in deltas[1:]:
+            comandos.extend([zigzag(int(dx)), zigzag(int(dy))])
+        comandos.append(7 | (1 << 3))  # ClosePath
+        cursor = tuple(pontos[-1])
+    return comandos, cursor
+
+def camada_mercator(nome_camada, indice_nivel):
+    """Geometrias da camada no nível de detalhe pedido, projetadas em Web Mercator, com a STRtree para recortar tiles."""
+    import shapely
+    chave = (nome_camada, indice_nivel)
+    with camadas_mercator_lock:
+        if chave not in camadas_mercator:
+            gdf = gdf_municipios_raw if nome_camada == 'municipality' else gdf_ais
+            nivel = NIVEIS_GEOMETRIA[indice_nivel]
+            projetada = gdf.set_geometry(simplificar_camada(gdf.geometry.values, nivel['tolerancia'], nivel['casas'])).to_crs('epsg:3857')
+            camadas_mercator[chave] = {
+                'gdf': projetada, 'arvore': shapely.STRtree(projetada.geometry.values), 'limites': projetada.total_bounds
+            }
+        return camadas_mercator[chave]
+
+def caixa_tile(z, x, y):
+    """Origem (canto superior esquerdo), lado e caixa com buffer de uma tile, em Web Mercator."""
+    tamanho = 2 * LIMITE_MERCATOR / 2 ** z
+    minx = -LIMITE_MERCATOR + x * tamanho
+    maxy = LIMITE_MERCATOR - y * tamanho
+    buffer = tamanho * BUFFER_TILE / EXTENSAO_TILE
+    return minx, maxy, tamanho, (minx - buffer, maxy - tamanho - buffer, minx + tamanho + buffer, maxy + buffer)
+
+def tile_na_camada(nome_camada, z, x, y):
+    """Indica se a tile (com o buffer) cruza a extensão da camada; fora dela a tile é sempre vazia."""
+    limites = camada_mercator(nome_camada, len(NIVEIS_GEOMETRIA) - 1)['limites']
+    caixa = caixa_tile(z, x, y)[3]
+    return caixa[0] <= limites[2] and caixa[2] >= limites[0] and caixa[1] <= limites[3] and caixa[3] >= limites[1]
+
+def gerar_tile(nome_camada, z, x, y):
+    """Gera a tile MVT (bytes) de uma camada: recorte com buffer, grade de EXTENSAO_TILE e comandos de polígono."""
+    import shapely
+    config = CAMADAS_TILE[nome_camada]
+    indice_nivel = NIVEIS_GEOMETRIA.index(nivel_geometria({'niveis': NIVEIS_GEOMETRIA}, z))
+    camada = camada_mercator(nome_camada, indice_nivel)
+
+    minx, maxy, tamanho, caixa = caixa_tile(z, x, y)
+
+    posicoes = np.sort(camada['arvore'].query(shapely.box(*caixa), predicate='intersects'))
+    if len(posicoes) == 0:
+        return b''
+    gdf = camada['gdf'].iloc[posicoes]
+    recortadas = shapely.clip_by_rect(gdf.geometry.values, *caixa)
+
+    chaves, valores, features = [], [], []
+    for posicao, (_, linha), geometria in zip(posicoes, gdf.iterrows(), recortadas):
+        if geometria.is_empty:
+            continue
+        partes = geometria.geoms if geometria.geom_type in ('MultiPolygon', 'GeometryCollection') else [geometria]
+        comandos = []
+        cursor = (0, 0)
+        for parte in partes:
+            if parte.geom_type != 'Polygon':
+                continue
+            aneis = [parte.exterior] + list(parte.interiors)
+            aneis = [
+                np.round((shapely.get_coordinates(anel) - [minx, maxy]) * [1, -1] * EXTENSAO_TILE / tamanho).astype(np.int64)
+                for anel in aneis
+            ]
+            comandos_parte, cursor = comandos_poligono(aneis, cursor)
+            comandos.extend(comandos_parte)
+        if not comandos:
+            continue
+
+        tags = []
+        for propriedade in config['propriedades']:
+            if propriedade not in chaves:
+                chaves.append(propriedade)
+            valor = str(linha[propriedade])
+            if valor not in valores:
+                valores.append(valor)
+            tags.extend([chaves.index(propriedade), valores.index(valor)])
+        id_feicao = int(linha[config['id']]) if config['id'] else int(posicao)
+
+        geometria_bytes = b''.join(varint_protobuf(c) for c in comandos)
+        tags_bytes = b''.join(varint_protobuf(t) for t in tags)
+        features.append(
+            campo_protobuf(1, 0, id_feicao) + campo_protobuf(2, 2, tags_bytes)
+            + campo_protobuf(3, 0, 3) + campo_protobuf(4, 2, geometria_bytes)  # tipo 3 = POLYGON
+        )
+
+    if not features:
+        return b''
+    camada_bytes = (
+        campo_protobuf(15, 0, 2) + campo_protobuf(1, 2, nome_camada.encode('utf-8'))
+        + b''.join(campo_protobuf(2, 2, f) for f in features)
+        + b''.join(campo_protobuf(3, 2, c.encode('utf-8')) for c in chaves)
+        + b''.join(campo_protobuf(4, 2, campo_protobuf(1, 2, v.encode('utf-8'))) for v in valores)
+        + campo_protobuf(5, 0, EXTENSAO_TILE)
+    )
+    return campo_protobuf(3, 2, camada_bytes)
+
+@bp.route('/tiles/<string:layer>/<int:z>/<int:x>/<int:y>.pbf')
+@usa_dados('geo')
+def get_tile(layer, z, x, y):
+    """Tile MVT de uma camada do mapa, gerada sob demanda e guardada em disco."""
+    if layer not in CAMADAS_TILE:
+        return jsonify({"error": f"Camada '{layer}' não encontrada."}), 404
+    if not (0 <= z <= MAX_ZOOM_TILE and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({"error": f"Coordenadas de tile inválidas (zoom de 0 a {MAX_ZOOM_TILE})."}), 400
+
+    # O diretório leva a versão da geometria: se o GeoJSON de origem mudar, as tiles antigas deixam de ser usadas
+    versao = GEOMETRIAS_SERIALIZADAS[layer]['niveis'][-1]['geojson']['etag'][:12]
+    caminho = os.path.join(TILES_DIR, versao, layer, str(z), str(x), f"{y}.pbf")
+    if not tile_na_camada(layer, z, x, y):
+        # Fora da extensão da camada a tile é vazia: não vale gravar uma por coordenada pedida
+        corpo = b''
+    elif z > MAX_ZOOM_TILE_DISCO:
+        corpo = gerar_tile(layer, z, x, y)
+    elif os.path.exists(caminho):
+        with open(caminho, 'rb') as f:
+            corpo = f.read()
+    else:
+        corpo = gerar_tile(layer, z, x, y)
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        # Nome temporário único por escrita: threads do mesmo processo podem gerar a mesma tile ao mesmo tempo
+        descritor, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho), suffix='.tmp')
+        with os.fdopen(descritor, 'wb') as f:
+            f.write(corpo)
+        os.replace(temporario, caminho)
+
+    response = current_app.response_class(corpo, mimetype='application/vnd.mapbox-vector-tile')
+    response.set_etag(hashlib.sha1(corpo).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+@bp.route('/api/correlation_data')
+@usa_dados('crimes')
 def get_correlation_data():
     crime1 = request.args.get('crime1')
     crime2 = request.args.get('crime2')
@@ -303,40 +2387,115 @@ def get_correlation_data():
     if not crime1 or not crime2:
         return jsonify({"error": "Dois crimes devem ser fornecidos"}), 400
 
-    df_filtered = df_crimes_graficos[df_crimes_graficos['NATUREZA'].isin([crime1, crime2])]
+    # Recorte das duas colunas da matriz pré-calculada; anos sem nenhum dos dois crimes ficam de fora
+    pares = ESTADO_CRIMES['MATRIZ_ANO_NATUREZA'].reindex(columns=pd.unique(np.array([crime1, crime2])), fill_value=0)
+    x = pares[crime1].to_numpy()
+    y = pares[crime2].to_numpy()
+    presentes = (x > 0) | (y > 0)
 
-    if df_filtered.empty:
-        return jsonify([])
-
-    yearly_counts = df_filtered.groupby(['ANO', 'NATUREZA']).size().unstack(fill_value=0)
-
-    if crime1 not in yearly_counts.columns:
-        yearly_counts[crime1] = 0
-    if crime2 not in yearly_counts.columns:
-        yearly_counts[crime2] = 0
-        
-    scatter_data = []
-    for year, row in yearly_counts.iterrows():
-        scatter_data.append({
-            'x': int(row[crime1]), 
-            'y': int(row[crime2]),
-            'year': int(year) 
-        })
-        
+    scatter_data = [
+        {'x': int(vx), 'y': int(vy), 'year': int(year)}
+        for year, vx, vy in zip(pares.index[presentes], x[presentes], y[presentes])
+    ]
     return jsonify(scatter_data)
 
-@app.route('/api/municipalities')
+def matriz_correlacao(tabela, metodo='pearson'):
+    """
+    Correlação entre todas as colunas de 'tabela' (períodos × categorias) em uma única passada vetorizada.
+    Spearman é o Pearson sobre os postos (empates recebem o posto médio). Colunas constantes dão NaN.
+    """
+    valores = tabela.to_numpy(dtype=float)
+    if metodo == 'spearman':
+        valores = tabela.rank(method='average').to_numpy(dtype=float)
+    centrados = valores - valores.mean(axis=0)
+    covariancia = centrados.T @ centrados
+    desvios = np.sqrt(np.diag(covariancia))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlacao = covariancia / np.outer(desvios, desvios)
+    correlacao[np.outer(desvios, desvios) == 0] = np.nan
+    return np.clip(correlacao, -1.0, 1.0)
+
+@bp.route('/api/correlation_matrix', methods=['POST'])
+@cache_resposta
+def get_correlation_matrix():
+    """
+    Matriz de correlação (Pearson ou Spearman) das séries de contagem de todos os valores de uma coluna
+    (por padrão, NATUREZA), respeitando os filtros. Corpo: {"method", "granularity": "year" | "month",
+    "column", "filters"}.
+    """
+    config = request.get_json() or {}
+    metodo = config.get('method', 'pearson')
+    mensal = config.get('granularity', 'year') == 'month'
+    coluna = config.get('column', 'NATUREZA')
+    filters = config.get('filters') or {'dates': {}, 'checkboxes': {}}
+    if metodo not in ('pearson', 'spearman'):
+        return jsonify({"error": "Método inválido: use 'pearson' ou 'spearman'."}), 400
+
+    dashboard_id = request.args.get('dashboard_id')
+    df_base = get_dataframe(dashboard_id)
+    if coluna not in df_base.columns or 'DATA' not in df_base.columns:
+        return jsonify({"error": f"Coluna '{coluna}' ou DATA não encontrada."}), 400
+
+    periodo = ['ANO', 'MES'] if mensal else ['ANO']
+    indice = obter_indice_bitmap(dashboard_id, df_base)
+    contagens = contar_ocorrencias(df_base, filters, periodo + [coluna], not dashboard_id, indice)
+    if contagens.empty:
+        return jsonify({'labels': [], 'matrix': [], 'periods': 0, 'method': metodo})
+
+    # Períodos × categorias, com zeros nos períodos do intervalo em que a categoria não aparece
+    tabela = contagens.unstack(coluna, fill_value=0)
+    if mensal:
+        tabela.index = pd.PeriodIndex.from_fields(
+            year=tabela.index.get_level_values('ANO').to_numpy(), month=tabela.index.get_level_values('MES').to_numpy(), freq='M')
+        periodos = pd.period_range(tabela.index.min(), tabela.index.max(), freq='M')
+    else:
+        periodos = pd.RangeIndex(start=int(tabela.index.min()), stop=int(tabela.index.max()) + 1)
+    tabela = tabela.reindex(periodos, fill_value=0)
+
+    correlacao = matriz_correlacao(tabela, metodo)
+    return jsonify({
+        'labels': [str(c) for c in tabela.columns],
+        # NaN (série constante) vira null no JSON
+        'matrix': [[None if np.isnan(v) else round(float(v), 6) for v in linha] for linha in correlacao],
+        'periods': len(tabela),
+        'method': metodo
+    })
+
+@bp.route('/api/municipalities')
+@usa_dados('geo')
 def get_municipalities():
-    municipalities_list = []
-    for index, row in municipios_com_centroide.iterrows():
-        municipalities_list.append({
-            'name': row['name'],
-            'lat': row['centroid'].y,
-            'lon': row['centroid'].x
-        })
-    return jsonify(municipalities_list)
+    """Lista de municípios com centroide e caixa envolvente, servida já serializada e com ETag."""
+    response = current_app.response_class(MUNICIPIOS_INDICE['body'], mimetype='application/json')
+    response.set_etag(MUNICIPIOS_INDICE['etag'])
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
+
+@bp.route('/api/municipalities/search')
+@usa_dados('geo')
+def search_municipalities():
+    """Busca por prefixo do nome (sem diferenciar acentos e maiúsculas) para o autocomplete."""
+    termo = normalize_text(pd.Series([request.args.get('q', '').strip()], dtype=object))[0]
+    limite = min(request.args.get('limit', 10, type=int), 50)
+    if not termo:
+        return jsonify([])
 
-@app.route('/api/analyze_csv', methods=['POST'])
+    nomes_ordenados = MUNICIPIOS_INDICE['nomes_norm_ordenados']
+    inicio = np.searchsorted(nomes_ordenados, termo, side='left')
+    fim = np.searchsorted(nomes_ordenados, termo + '\uffff', side='left')
+    posicoes = MUNICIPIOS_INDICE['ordem'][inicio:min(fim, inicio + limite)]
+
+    return jsonify([
+        {
+            'name': MUNICIPIOS_INDICE['nomes'][i],
+            'lat': float(MUNICIPIOS_INDICE['lat'][i]),
+            'lon': float(MUNICIPIOS_INDICE['lon'][i]),
+            'bbox': MUNICIPIOS_INDICE['bbox'][i].tolist()
+        }
+        for i in posicoes
+    ])
+
+@bp.route('/api/analyze_csv', methods=['POST'])
 def analyze_csv():
     # Verifica se o arquivo foi enviado na requisição
     if 'file' not in request.files:
@@ -351,8 +2510,8 @@ def analyze_csv():
     # Verifica se o arquivo é um CSV
     if file and file.filename.endswith('.csv'):
         try:
-            # Lê o CSV diretamente do objeto de arquivo em memória
-            df = pd.read_csv(file)
+            # Lê só o cabeçalho e uma amostra limitada: basta para listar as colunas
+            df = pd.read_csv(file, nrows=AMOSTRA_LINHAS_ANALISE)
             
             # Pega a lista de nomes das colunas
             column_names = df.columns.tolist()
@@ -366,42 +2525,134 @@ def analyze_csv():
     
     return jsonify({"error": "Formato de arquivo inválido. Por favor, envie um .csv"}), 400
 
-@app.route('/api/history/municipio/<nome_municipio>', methods=['POST'])
+def matriz_historico(df_base, filters, municipios, mensal=False, usar_cubo=False, indice=None, selecao=None):
+    """
+    Matriz período × município com as contagens filtradas, a partir de uma única passada de filtros e um groupby.
+    'municipios' é uma lista de nomes ou None (todos os que têm ocorrências). Períodos sem registro ficam com zero.
+    """
+    periodo = ['ANO', 'MES'] if mensal else ['ANO']
+    contagens = contar_ocorrencias(df_base, filters, ['MUNICIPIO'] + periodo, usar_cubo, indice, selecao)
+    if contagens.empty:
+        return pd.DataFrame(columns=municipios or [])
+
+    tabela = contagens.unstack('MUNICIPIO', fill_value=0)
+    if mensal:
+        tabela.index = pd.PeriodIndex.from_fields(
+            year=tabela.index.get_level_values('ANO').to_numpy(), month=tabela.index.get_level_values('MES').to_numpy(), freq='M')
+        periodos = pd.period_range(tabela.index.min(), tabela.index.max(), freq='M')
+    else:
+        periodos = pd.RangeIndex(start=int(tabela.index.min()), stop=int(tabela.index.max()) + 1)
+    colunas = municipios if municipios is not None else tabela.columns.tolist()
+    return tabela.reindex(index=periodos, columns=colunas, fill_value=0).astype(int)
+
+@bp.route('/api/history/municipio/<nome_municipio>', methods=['POST'])
+@cache_resposta
 def get_history_for_municipio(nome_municipio):
     dashboard_id = request.args.get('dashboard_id')
     df_base = get_dataframe(dashboard_id)
     
     filters = request.get_json()
     
-    # APLICAÇÃO CORRETA DOS FILTROS
-    df_filtered = apply_filters(df_base, filters)
-    
-    # Garante que a coluna de agrupamento exista
-    if 'ANO' not in df_filtered.columns and 'DATA' in df_filtered.columns:
-        df_filtered['ANO'] = df_filtered['DATA'].dt.year
-    elif 'ANO' not in df_filtered.columns:
-         return jsonify({'labels': [], 'data': []}) # Não pode agrupar sem ano
-
-    # Filtra para o município específico
-    df_hist = df_filtered[df_filtered['MUNICIPIO'] == nome_municipio]
-    
-    if df_hist.empty:
+    # Não pode agrupar sem ano
+    if 'ANO' not in df_base.columns and 'DATA' not in df_base.columns:
+        return jsonify({'labels': [], 'data': []})
+
+    # Conta por município e ano de uma vez (no dataset padrão, direto do cubo)
+    indice = obter_indice_bitmap(dashboard_id, df_base)
+    tabela = matriz_historico(df_base, filters, None, False, not dashboard_id, indice)
+    if nome_municipio not in tabela.columns:
         return jsonify({'labels': [], 'data': []})
 
-    history_counts = df_hist.groupby('ANO').size()
-    
-    start_year = int(df_filtered['ANO'].min())
-    end_year = int(df_filtered['ANO'].max())
-    full_year_range = pd.RangeIndex(start=start_year, stop=end_year + 1, name='year')
-    
-    history_counts = history_counts.reindex(full_year_range, fill_value=0)
-    
     return jsonify({
-        'labels': history_counts.index.tolist(),
-        'data': history_counts.values.tolist()
+        'labels': tabela.index.tolist(),
+        'data': tabela[nome_municipio].tolist()
     }) 
 
-@app.route('/api/create_dashboard', methods=['POST'])
+def calcular_historico_municipios(config, df_base, dashboard_id, indice, selecao=None):
+    """Histórico de vários municípios (ver get_history_for_municipios). Devolve (resposta, status)."""
+    municipios = config.get('municipalities', 'all')
+    mensal = config.get('granularity', 'year') == 'month'
+    filters = config.get('filters') or {'dates': {}, 'checkboxes': {}}
+    if municipios != 'all' and (not isinstance(municipios, list) or not all(isinstance(m, str) for m in municipios)):
+        return {"error": "'municipalities' deve ser uma lista de nomes ou \"all\"."}, 400
+
+    # Não pode agrupar sem município e sem ano (nem sem mês, no modo mensal)
+    colunas = df_base.columns
+    if 'MUNICIPIO' not in colunas or ('ANO' not in colunas and 'DATA' not in colunas) or (mensal and 'MES' not in colunas and 'DATA' not in colunas):
+        return {'labels': [], 'series': {}}, 200
+
+    tabela = matriz_historico(df_base, filters, None if municipios == 'all' else municipios, mensal, not dashboard_id, indice, selecao)
+
+    return {
+        'labels': [str(p) if mensal else int(p) for p in tabela.index],
+        'series': {str(m): tabela[m].tolist() for m in tabela.columns}
+    }, 200
+
+@bp.route('/api/history/municipios', methods=['POST'])
+@cache_resposta
+def get_history_for_municipios():
+    """
+    Histórico de vários municípios de uma vez. Corpo: {"municipalities": [...] ou "all",
+    "granularity": "year" | "month", "filters": {...}}.
+    """
+    dashboard_id = request.args.get('dashboard_id')
+    df_base = get_dataframe(dashboard_id)
+    indice = obter_indice_bitmap(dashboard_id, df_base)
+    resposta, status = calcular_historico_municipios(request.get_json() or {}, df_base, dashboard_id, indice)
+    return jsonify(resposta), status
+
+@bp.route('/api/forecast', methods=['POST'])
+@cache_resposta
+def get_forecast():
+    """
+    Tabela de tendências de todos os grupos (por padrão município × natureza) para um conjunto de filtros:
+    projeção do ano corrente e, para cada janela de anos, a inclinação (ocorrências/ano) e o valor da reta
+    no ano seguinte. Corpo: {"group_by": [...], "filters": {...}, "windows": [1, 5, 10], "average_years": 5}.
+    O resultado fica no cache de respostas, cuja chave inclui a versão dos dados.
+    """
+    config = request.get_json() or {}
+    colunas_grupo = config.get('group_by', ['MUNICIPIO', 'NATUREZA'])
+    filters = config.get('filters') or {'dates': {}, 'checkboxes': {}}
+    try:
+        janelas = [int(j) for j in config.get('windows', JANELAS_TENDENCIA)]
+        anos_para_media = int(config.get('average_years', 5))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'windows' e 'average_years' devem ser inteiros."}), 400
+    if not isinstance(colunas_grupo, list) or not colunas_grupo or not janelas or min(janelas + [anos_para_media]) < 1:
+        return jsonify({"error": "'group_by' deve ser uma lista de colunas e as janelas/anos devem ser positivos."}), 400
+
+    dashboard_id = request.args.get('dashboard_id')
+    df_base = get_dataframe(dashboard_id)
+    faltando = [col for col in colunas_grupo if col not in df_base.columns]
+    if faltando:
+        return jsonify({"error": f"Colunas não encontradas: {', '.join(map(str, faltando))}."}), 400
+    if 'DATA' not in df_base.columns and not {'ANO', 'MES'} <= set(df_base.columns):
+        return jsonify({"error": "O dataset não tem datas para projetar."}), 400
+
+    indice = obter_indice_bitmap(dashboard_id, df_base)
+    contagens = contar_ocorrencias(df_base, filters, colunas_grupo + ['ANO', 'MES'], not dashboard_id, indice)
+    if contagens.empty:
+        return jsonify({'group_by': colunas_grupo, 'windows': janelas, 'years': [], 'keys': {col: [] for col in colunas_grupo},
+                        'projection': [], 'trends': {str(j): {'years': 0, 'slope': [], 'next_year': []} for j in janelas}})
+
+    resultado = prever_tendencias(contagens, colunas_grupo, anos_para_media, janelas)
+    grupos = resultado['grupos']
+    chaves = {col: [str(v) for v in (grupos.get_level_values(i) if isinstance(grupos, pd.MultiIndex) else grupos)] for i, col in enumerate(colunas_grupo)}
+    return jsonify({
+        'group_by': colunas_grupo,
+        'current_year': resultado['ano_atual'],
+        'last_month': resultado['ultimo_mes'],
+        'years': resultado['anos'].tolist(),
+        'windows': janelas,
+        'keys': chaves,
+        'projection': resultado['projecao_ano_atual'].round(2).tolist(),
+        'trends': {
+            str(j): {'years': t['anos'], 'slope': t['inclinacao'].round(4).tolist(), 'next_year': t['proximo_ano'].round(2).tolist()}
+            for j, t in resultado['tendencias'].items()
+        }
+    })
+
+@bp.route('/api/create_dashboard', methods=['POST'])
 def create_dashboard():
     # --- 1. Recebe os dados do formulário ---
     # Dados de texto (nome, descrição, colunas)
@@ -431,7 +2682,24 @@ def create_dashboard():
     file_path = os.path.join(uploads_dir, safe_filename)
     file.save(file_path)
 
-    # --- 3. Cria e salva o arquivo de metadados (.json) ---
+    # --- 3. Converte o CSV uma única vez para o formato colunar, em blocos (datas já convertidas) ---
+    destino_colunar = os.path.splitext(file_path)[0] + '.cols'
+    try:
+        data_path, column_types = converter_csv_para_colunar(file_path, destino_colunar)
+        # Linhas geolocalizadas ganham MUNICIPIO/AIS pelo ponto, para aparecerem no mapa coroplético
+        for col in atribuir_regioes_colunar(data_path):
+            column_types.append({'name': col, 'type': 'categorical'})
+        # Perfil das colunas calculado uma única vez, no upload, para /api/schema e /api/columns
+        perfil = perfilar_dataset_colunar(data_path, {c['name']: c['type'] for c in column_types})
+        profile_path = os.path.join(destino_colunar, 'perfil.json')
+        with open(profile_path, 'w', encoding='utf-8') as f:
+            json.dump(perfil, f, ensure_ascii=False)
+    except Exception as e:
+        os.remove(file_path)
+        shutil.rmtree(destino_colunar, ignore_errors=True)
+        return jsonify({"error": f"Erro ao processar o arquivo CSV: {str(e)}"}), 400
+
+    # --- 4. Cria e salva o arquivo de metadados (.json) ---
     selected_columns = json.loads(selected_columns_json)
     
     dashboard_id = f"dash_{timestamp}" # ID único para o dashboard
@@ -441,6 +2709,9 @@ def create_dashboard():
         "name": dashboard_name,
         "description": dashboard_desc,
         "csv_path": file_path, # Caminho absoluto para o CSV
+        "data_path": data_path, # Manifesto do formato colunar
+        "profile_path": profile_path, # Perfil das colunas (tipos, valores distintos, nulos, mínimo/máximo)
+        "column_types": column_types,
         "filterable_columns": selected_columns
     }
     
@@ -452,14 +2723,22 @@ def create_dashboard():
     with open(metadata_path, 'w', encoding='utf-8') as f:
         json.dump(metadata, f, ensure_ascii=False, indent=4)
 
-    # --- 4. Retorna uma resposta de sucesso ---
+    # Um reenvio com o mesmo id não pode reaproveitar o dataset antigo em cache
+    invalidar_dataset(dashboard_id)
+
+    # --- 5. Retorna uma resposta de sucesso ---
     return jsonify({
         "message": "Dashboard criado com sucesso!",
         "dashboard_id": dashboard_id,
         "dashboard_info": metadata
     }), 201 # 201 Created
 
-@app.route('/api/dashboards/<string:dashboard_id>', methods=['DELETE'])
+@bp.app_errorhandler(413)
+def upload_muito_grande(e):
+    limite_mb = current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({"error": f"Arquivo maior que o limite de {limite_mb} MB."}), 413
+
+@bp.route('/api/dashboards/<string:dashboard_id>', methods=['DELETE'])
 def delete_dashboard(dashboard_id):
     # O resto da sua função continua igual...
     dashboards_dir = os.path.join(BASE_DIR, 'dashboards')
@@ -477,20 +2756,26 @@ def delete_dashboard(dashboard_id):
         
         csv_path = metadata.get("csv_path")
 
-        # 3. Exclui o arquivo CSV, se o caminho existir
+        # 3. Exclui o arquivo CSV e a versão colunar, se existirem
         if csv_path and os.path.exists(csv_path):
             os.remove(csv_path)
+        data_path = metadata.get("data_path")
+        if data_path and os.path.exists(data_path):
+            shutil.rmtree(os.path.dirname(data_path))
         
         # 4. Exclui o arquivo de metadados .json
         os.remove(metadata_path)
 
+        # 5. Descarta o dataset em cache e o índice de filtros do dashboard
+        invalidar_dataset(dashboard_id)
+
         return jsonify({"message": f"Dashboard '{metadata.get('name')}' excluído com sucesso."})
 
     except Exception as e:
         print(f"Erro ao excluir o dashboard {dashboard_id}: {e}")
         return jsonify({"error": f"Erro interno ao excluir o dashboard: {str(e)}"}), 500
 
-@app.route('/api/dashboards', methods=['GET'])
+@bp.route('/api/dashboards', methods=['GET'])
 def list_dashboards():
     dashboards_dir = os.path.join(BASE_DIR, 'dashboards')
     
@@ -518,128 +2803,290 @@ def list_dashboards():
     
     return jsonify(sorted_dashboards)
 
-@app.route('/api/year_range')
+@bp.route('/api/crimes/append', methods=['POST'])
+def append_crimes():
+    """
+    Anexa um lote de ocorrências (CSV no formato de crimes.csv, campo 'file') ao dataset padrão, sem
+    reiniciar o servidor. Exige MULTIDASH_APPEND_TOKEN definido e o mesmo valor no cabeçalho X-Append-Token;
+    sem token configurado a rota fica fechada (a anexação pela linha de comando continua disponível).
+    """
+    token = request.headers.get('X-Append-Token', '')
+    if not TOKEN_ANEXACAO or not hmac.compare_digest(token.encode('utf-8'), TOKEN_ANEXACAO.encode('utf-8')):
+        return jsonify({"error": "Token de anexação inválido"}), 403
+    if 'file' not in request.files:
+        return jsonify({"error": "Nenhum arquivo enviado"}), 400
+    try:
+        df_lote = pd.read_csv(request.files['file'], dtype=str)
+    except Exception as e:
+        return jsonify({"error": f"Erro ao processar o arquivo CSV: {str(e)}"}), 400
+    try:
+        resumo = anexar_lote_crimes(df_lote)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(resumo)
+
+@bp.route('/api/year_range')
+@usa_dados('crimes')
 def get_year_range():
     """Retorna o ano mínimo e máximo presentes no dataset."""
-    min_year = int(df_crimes_graficos['ANO'].min())
-    max_year = int(df_crimes_graficos['ANO'].max())
+    df_graficos = ESTADO_CRIMES['df_crimes_graficos']
+    min_year = int(df_graficos['ANO'].min())
+    max_year = int(df_graficos['ANO'].max())
     return jsonify({'min_year': min_year, 'max_year': max_year})
 
-@app.route('/api/columns')
-def get_columns():
-    dashboard_id = request.args.get('dashboard_id')
-    df = get_dataframe(dashboard_id)
-    
-    columns_with_types = []
-    for col_name in df.columns:
-        col_type = 'categorical'  # Começa com o padrão
-        try:
-            series = df[col_name].dropna()
-            if series.empty:
-                columns_with_types.append({'name': col_name, 'type': 'categorical'})
-                continue
-
-            # --- NOVA LÓGICA DE DETECÇÃO ---
-
-            # 1. Tenta converter para numérico
-            numeric_series = pd.to_numeric(series, errors='coerce')
-            # Se mais de 80% dos valores não nulos forem numéricos, consideramos 'numeric'
-            if numeric_series.notna().sum() / len(series) > 0.8:
-                if not pd.api.types.is_bool_dtype(series):
-                    col_type = 'numeric'
-                # Se for numérico, não precisa testar para data, então pulamos para o próximo loop
-                columns_with_types.append({'name': col_name, 'type': col_type})
-                continue
-
-            # 2. Se não for numérico, tenta converter para datetime
-            datetime_series = pd.to_datetime(series, errors='coerce')
-            if datetime_series.notna().sum() / len(series) > 0.8:
-                # Se a maioria puder ser convertida para data...
-                # ...verifica se tem mais de um dia único para ser 'date'
-                if datetime_series.dt.normalize().nunique() > 1:
-                    col_type = 'date'
-                # Se não, permanece 'categorical' (é uma coluna de horas)
-            
-            # 3. Se nada funcionar, o padrão 'categorical' é usado
-
-        except Exception:
-            # Em caso de qualquer erro, mantém o tipo como 'categorical'
-            pass
-        
-        columns_with_types.append({'name': col_name, 'type': col_type})
+@bp.route('/api/index_stats')
+@usa_dados('crimes')
+def get_index_stats():
+    """Memória ocupada pelos índices de filtros de cada dataset já indexado."""
+    stats = {}
+    indices = {'padrao': ESTADO_CRIMES['indice_bitmap'], **INDICES_BITMAP}
+    for chave, indice in indices.items():
+        stats[chave] = {
+            'linhas': indice['n_linhas'],
+            'bytes_por_coluna': indice['bytes'],
+            'bytes_total': sum(indice['bytes'].values())
+        }
+    return jsonify(stats)
+
+@bp.route('/api/cache_stats')
+def get_cache_stats():
+    """Contadores de acerto/erro e ocupação do cache de datasets customizados e do cache de respostas."""
+    with cache_datasets_lock:
+        stats = dict(ESTATISTICAS_CACHE_DATASETS)
+        stats['entradas'] = len(cache_datasets)
+        stats['bytes'] = sum(e['bytes'] for e in cache_datasets.values())
+    stats['max_bytes'] = DATASET_CACHE_MAX_BYTES
+
+    with estatisticas_respostas_lock:
+        stats_respostas = dict(ESTATISTICAS_CACHE_RESPOSTAS)
+    try:
+        stats_respostas.update(cache_respostas.estatisticas())
+    except Exception as e:
+        stats_respostas['erro'] = str(e)
+    stats_respostas['backend'] = cache_respostas.nome
+    consultas = stats_respostas['hits'] + stats_respostas['misses']
+    stats_respostas['hit_rate'] = stats_respostas['hits'] / consultas if consultas else 0.0
+    stats_respostas['max_bytes'] = RESPOSTAS_CACHE_MAX_BYTES
+    stats_respostas['ttl_segundos'] = RESPOSTAS_CACHE_TTL
+    return jsonify({'datasets': stats, 'respostas': stats_respostas})
+
+def detectar_tipo_coluna(series):
+    """Classifica uma coluna como 'numeric', 'date' ou 'categorical' a partir dos seus valores."""
+    col_type = 'categorical'  # Começa com o padrão
+    try:
+        series = series.dropna()
+        if series.empty:
+            return 'categorical'
+
+        # Colunas já convertidas na carga (ex.: DATA) não devem cair na conversão numérica
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return 'date' if series.dt.normalize().nunique() > 1 else 'categorical'
+
+        # --- NOVA LÓGICA DE DETECÇÃO ---
+
+        # 1. Tenta converter para numérico
+        numeric_series = pd.to_numeric(series, errors='coerce')
+        # Se mais de 80% dos valores não nulos forem numéricos, consideramos 'numeric'
+        if numeric_series.notna().sum() / len(series) > 0.8:
+            if not pd.api.types.is_bool_dtype(series):
+                col_type = 'numeric'
+            # Se for numérico, não precisa testar para data
+            return col_type
+
+        # 2. Se não for numérico, tenta converter para datetime
+        datetime_series = pd.to_datetime(series, errors='coerce')
+        if datetime_series.notna().sum() / len(series) > 0.8:
+            # Se a maioria puder ser convertida para data...
+            # ...verifica se tem mais de um dia único para ser 'date'
+            if datetime_series.dt.normalize().nunique() > 1:
+                col_type = 'date'
+            # Se não, permanece 'categorical' (é uma coluna de horas)
         
-    return jsonify(columns_with_types)
-
-@app.route('/api/generic_chart', methods=['POST'])
-def get_generic_chart_data():
-    # 1. Pega a configuração do gráfico e os filtros do corpo da requisição
-    config = request.get_json()
-    chart_type = config.get('chartType')
-    column_map = config.get('columnMap')
-    filters = config.get('filters')
-    dashboard_id = request.args.get('dashboard_id')
+        # 3. Se nada funcionar, o padrão 'categorical' é usado
 
-    # 2. Carrega o dataframe correto e aplica os filtros da sidebar
-    df_base = get_dataframe(dashboard_id)
-    df_filtered = apply_filters(df_base, filters)
+    except Exception:
+        # Em caso de qualquer erro, mantém o tipo como 'categorical'
+        pass
 
-    try:
-        # 3. Lógica para cada tipo de gráfico
-        if chart_type == 'bar':
-            category_col = column_map.get('category_axis')
-            segment_by_col = column_map.get('segment_by') # Pega a coluna opcional
-
-            if not category_col or category_col not in df_filtered.columns:
-                raise ValueError(f"Coluna de categoria '{category_col}' não encontrada.")
-
-            # CASO 1: Gráfico de Barras Simples (sem segmentação)
-            if not segment_by_col:
-                data_counts = df_filtered[category_col].value_counts().nlargest(20)
-                labels = [str(l) for l in data_counts.index.tolist()]
-                data = data_counts.values.tolist()
-                return jsonify({
-                    'labels': labels,
-                    'datasets': [{'label': f'Contagem de {category_col}', 'data': data}]
-                })
-
-            # CASO 2: Gráfico de Barras Agrupado (com segmentação)
-            else:
-                if segment_by_col not in df_filtered.columns:
-                    raise ValueError(f"Coluna de segmentação '{segment_by_col}' não encontrada.")
-                
-                df_temp = df_filtered.dropna(subset=[category_col, segment_by_col])
+    return col_type
 
-                top_main_categories = df_temp[category_col].value_counts().nlargest(15).index
-                df_temp = df_temp[df_temp[category_col].isin(top_main_categories)]
+# Perfis de colunas: calculados uma vez por dataset (na carga do padrão, no upload dos customizados)
+# e usados por /api/schema e /api/columns no lugar de varrer a tabela a cada requisição
+MAX_VALORES_PERFIL = 10000
+PERFIS_COLUNAS = {}
 
-                data_grouped = df_temp.groupby([category_col, segment_by_col]).size().unstack(fill_value=0)
-                
-                labels = [str(l) for l in data_grouped.index.tolist()]
-                datasets = []
-                
-                top_segment_categories = data_grouped.sum().nlargest(7).index
+def perfilar_coluna(serie, tipo=None):
+    """
+    Tipo (detectado numa amostra de AMOSTRA_LINHAS_ANALISE linhas, se não for informado), cardinalidade,
+    proporção de nulos, mínimo/máximo e os valores distintos ordenados com suas contagens (até
+    MAX_VALORES_PERFIL; datas não guardam a lista).
+    """
+    n_linhas = len(serie)
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        # Contagem direta sobre os códigos, sem hash dos valores
+        codigos = serie.cat.codes.to_numpy()
+        contagens = np.bincount(codigos[codigos >= 0], minlength=len(serie.cat.categories))
+        presentes = contagens > 0
+        valores, contagens = serie.cat.categories[presentes], contagens[presentes]
+        nulos = int((codigos < 0).sum())
+    else:
+        contagens_valores = serie.value_counts(dropna=True, sort=False)
+        valores, contagens = contagens_valores.index, contagens_valores.to_numpy()
+        nulos = int(n_linhas - contagens.sum())
+    try:
+        ordem = valores.argsort()
+        valores, contagens = valores[ordem], contagens[ordem]
+    except TypeError:
+        pass
+
+    if tipo is None:
+        amostra = serie if n_linhas <= AMOSTRA_LINHAS_ANALISE else serie.sample(AMOSTRA_LINHAS_ANALISE, random_state=0)
+        tipo = detectar_tipo_coluna(amostra)
+
+    minimo = maximo = None
+    if len(valores) and pd.api.types.is_datetime64_any_dtype(serie):
+        minimo, maximo = valores.min().isoformat(), valores.max().isoformat()
+    elif len(valores) and tipo == 'numeric':
+        numeros = pd.to_numeric(pd.Series(valores), errors='coerce').dropna()
+        if len(numeros):
+            minimo, maximo = numeros.min().item(), numeros.max().item()
+
+    guarda_valores = len(valores) <= MAX_VALORES_PERFIL and not pd.api.types.is_datetime64_any_dtype(serie)
+    return {
+        'type': tipo,
+        'cardinality': int(len(valores)),
+        'null_ratio': nulos / n_linhas if n_linhas else 0.0,
+        'min': minimo,
+        'max': maximo,
+        'values': valores.tolist() if guarda_valores else None,
+        'counts': contagens.tolist() if guarda_valores else None
+    }
 
-                for cat in top_segment_categories:
-                    datasets.append({
-                        'label': str(cat),
-                        'data': data_grouped[cat].tolist()
-                    })
-                
-                return jsonify({'labels': labels, 'datasets': datasets})
-            
-        elif chart_type == 'timeseries':
-            time_col = column_map.get('time_axis')
-            category_col = column_map.get('category_axis')
+def perfilar_dataframe(df, tipos=None):
+    """Perfil de todas as colunas de um DataFrame; 'tipos' ({nome: tipo}) dispensa a detecção."""
+    tipos = tipos or {}
+    return {'n_linhas': len(df), 'colunas': {col: perfilar_coluna(df[col], tipos.get(col)) for col in df.columns}}
+
+def perfilar_dataset_colunar(manifest_path, tipos=None):
+    """Perfil de um dataset colunar lendo uma coluna por vez (a memória fica limitada à maior coluna)."""
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    tipos = tipos or {}
+    colunas = {}
+    for info in manifest['colunas']:
+        serie = carregar_dataset_colunar(manifest_path, [info['nome']])[info['nome']]
+        colunas[info['nome']] = perfilar_coluna(serie, tipos.get(info['nome']))
+    return {'n_linhas': manifest['n_linhas'], 'colunas': colunas}
+
+def obter_perfil_colunas(dashboard_id=None):
+    """Perfil do dataset de um dashboard (o do dataset padrão se não houver dashboard com esse id)."""
+    metadata = ler_metadados_dashboard(dashboard_id) if dashboard_id else None
+    if metadata is None:
+        garantir_dados_crimes()
+        return ESTADO_CRIMES['PERFIL_COLUNAS']
+    perfil = PERFIS_COLUNAS.get(dashboard_id)
+    if perfil is None:
+        caminho = metadata.get('profile_path')
+        if caminho and os.path.exists(caminho):
+            with open(caminho, 'r', encoding='utf-8') as f:
+                perfil = json.load(f)
+        else:
+            # Dashboards criados antes dos perfis: calcula uma vez e guarda em memória
+            tipos = {c['name']: c['type'] for c in metadata.get('column_types') or []}
+            perfil = perfilar_dataframe(get_dataframe(dashboard_id), tipos)
+        PERFIS_COLUNAS[dashboard_id] = perfil
+    return perfil
 
-            if not time_col or time_col not in df_filtered.columns:
-                raise ValueError(f"Coluna de tempo '{time_col}' não encontrada.")
-            if not category_col or category_col not in df_filtered.columns:
-                raise ValueError(f"Coluna de categoria '{category_col}' não encontrada.")
+@bp.route('/api/columns')
+def get_columns():
+    """Colunas do dataset com o tipo detectado; com ?details=1 inclui cardinalidade, nulos e mínimo/máximo."""
+    dashboard_id = request.args.get('dashboard_id')
+    perfil = obter_perfil_colunas(dashboard_id)
+    if request.args.get('details') == '1':
+        campos = ('type', 'cardinality', 'null_ratio', 'min', 'max')
+        return jsonify([{'name': nome, **{campo: info[campo] for campo in campos}} for nome, info in perfil['colunas'].items()])
+    return jsonify([{'name': nome, 'type': info['type']} for nome, info in perfil['colunas'].items()])
 
-            df_temp = df_filtered.copy()
+def calcular_grafico_generico(config, df_base, dashboard_id, indice, selecao=None):
+    """
+    Dados de um gráfico genérico ('bar', 'timeseries', 'pie' ou 'histogram') a partir da configuração
+    {chartType, columnMap, filters, ...}. Devolve (resposta, status) para o /api/generic_chart e para o /api/batch.
+    """
+    chart_type = config.get('chartType')
+    column_map = config.get('columnMap') or {}
+    filters = config.get('filters')
+    # As contagens do dataset padrão saem do cubo pré-agregado
+    usar_cubo = not dashboard_id
+
+    # Barras, pizza e série temporal passam pelo agregar_grafico: medida ('aggregation') sobre a coluna
+    # 'value_axis', top-k de cada eixo ('top_k', 'segment_top_k') e, com 'other', o grupo 'Outros'
+    medida = config.get('aggregation', 'count')
+    value_col = column_map.get('value_axis')
+    outros = bool(config.get('other', False))
+    if chart_type in ('bar', 'timeseries', 'pie'):
+        if medida not in MEDIDAS_AGREGACAO:
+            return {"error": f"Agregação '{medida}' não suportada. Use uma de: {', '.join(MEDIDAS_AGREGACAO)}."}, 400
+        try:
+            top_k = config.get('top_k')
+            top_k = int(top_k) if top_k is not None else None
+            segment_top_k = config.get('segment_top_k')
+            segment_top_k = int(segment_top_k) if segment_top_k is not None else None
+        except (TypeError, ValueError):
+            return {"error": "'top_k' e 'segment_top_k' devem ser inteiros."}, 400
+        if (top_k is not None and top_k < 1) or (segment_top_k is not None and segment_top_k < 1):
+            return {"error": "'top_k' e 'segment_top_k' devem ser positivos."}, 400
+        nome_medida = MEDIDAS_AGREGACAO[medida] if medida == 'count' else f'{MEDIDAS_AGREGACAO[medida]} de {value_col}'
+
+    if chart_type == 'bar':
+        category_col = column_map.get('category_axis')
+        segment_by_col = column_map.get('segment_by') # Pega a coluna opcional
+
+        if not category_col or category_col not in df_base.columns:
+            raise ValueError(f"Coluna de categoria '{category_col}' não encontrada.")
+
+        # CASO 1: Gráfico de Barras Simples (sem segmentação)
+        if not segment_by_col:
+            agregado = agregar_grafico(df_base, filters, category_col, None, medida, value_col, top_k or 20, None, outros, usar_cubo, indice, selecao)
+            return {
+                'labels': agregado['labels'],
+                'datasets': [{'label': f'{nome_medida} de {category_col}' if medida == 'count' else f'{nome_medida} por {category_col}',
+                              'data': valores_json(agregado['data'], medida)}]
+            }, 200
+
+        # CASO 2: Gráfico de Barras Agrupado (com segmentação)
+        else:
+            if segment_by_col not in df_base.columns:
+                raise ValueError(f"Coluna de segmentação '{segment_by_col}' não encontrada.")
+
+            # Só a matriz top-15 × top-7 é montada; os nulos em qualquer uma das duas colunas ficam de fora
+            agregado = agregar_grafico(df_base, filters, category_col, segment_by_col, medida, value_col,
+                                       top_k or 15, segment_top_k or 7, outros, usar_cubo, indice, selecao)
+            datasets = [
+                {'label': segmento, 'data': valores_json(agregado['data'][:, j], medida)}
+                for j, segmento in enumerate(agregado['segments'])
+            ]
+            return {'labels': agregado['labels'], 'datasets': datasets}, 200
+        
+    elif chart_type == 'timeseries':
+        time_col = column_map.get('time_axis')
+        category_col = column_map.get('category_axis')
+
+        if not time_col or time_col not in df_base.columns:
+            raise ValueError(f"Coluna de tempo '{time_col}' não encontrada.")
+        if not category_col or category_col not in df_base.columns:
+            raise ValueError(f"Coluna de categoria '{category_col}' não encontrada.")
+
+        if time_col == 'DATA' and pd.api.types.is_datetime64_any_dtype(df_base[time_col]):
+            # Coluna de data já convertida: agrupa direto por ano. Séries que cabem no top-k ficam na ordem natural
+            agregado = agregar_grafico(df_base, filters, 'ANO', category_col, medida, value_col, None, top_k or 10, outros, usar_cubo, indice, selecao,
+                                       ordem_natural=True)
+        else:
+            # O recorte de um lote é compartilhado: as colunas derivadas vão numa cópia
+            colunas_temp = list(dict.fromkeys([c for c in [time_col, category_col, value_col] if c in df_base.columns]))
+            df_temp = selecao.df[colunas_temp].copy() if selecao is not None else apply_filters(df_base, filters, indice)
             grouping_col = time_col
             
-            if pd.api.types.is_datetime64_any_dtype(df_temp[time_col]) or df_temp[time_col].dtype == 'object':
+            if pd.api.types.is_datetime64_any_dtype(df_temp[time_col]) or df_temp[time_col].dtype == 'object' or isinstance(df_temp[time_col].dtype, pd.CategoricalDtype):
                 df_temp[time_col] = pd.to_datetime(df_temp[time_col], errors='coerce')
                 if pd.api.types.is_datetime64_any_dtype(df_temp[time_col]):
                     grouping_col = 'ANO'
@@ -648,74 +3095,88 @@ def get_generic_chart_data():
             df_temp.dropna(subset=[grouping_col], inplace=True)
             df_temp[grouping_col] = pd.to_numeric(df_temp[grouping_col], errors='coerce').astype(int)
 
-            data_grouped = df_temp.groupby([grouping_col, category_col]).size().unstack(fill_value=0)
-            
-            if len(data_grouped.columns) <= 10:
-                categories_to_show = data_grouped.columns
-            else:
-                categories_to_show = data_grouped.sum().nlargest(10).index
-
-            data_grouped = data_grouped[categories_to_show]
-
-            labels = [str(int(ano)) for ano in data_grouped.index]
-            datasets = []
-
-            for cat in data_grouped.columns:
-                datasets.append({'label': str(cat), 'data': data_grouped[cat].tolist(), 'fill': False, 'tension': 0.1})
-            
-            return jsonify({'labels': labels, 'datasets': datasets})
-
-        elif chart_type == 'pie':
-            category_col = column_map.get('category_axis')
-            if not category_col or category_col not in df_filtered.columns:
-                raise ValueError(f"Coluna de categoria '{category_col}' não encontrada.")
-
-            data_counts = df_filtered[category_col].value_counts().nlargest(10)
-            
-            labels = data_counts.index.tolist()
-            data = data_counts.values.tolist()
-            
-            return jsonify({
-                'labels': labels,
-                'datasets': [{'label': f'Proporção de {category_col}', 'data': data}]
-            })
-        elif chart_type == 'histogram':
-            numeric_col = column_map.get('numeric_axis')
-            if not numeric_col or numeric_col not in df_filtered.columns:
+            agregado = agregar_grafico(df_base, filters, grouping_col, category_col, medida, value_col, None, top_k or 10, outros,
+                                       df_linhas=df_temp, ordem_natural=True)
+
+        labels = [str(int(float(ano))) for ano in agregado['labels']]
+        datasets = [
+            {'label': categoria, 'data': valores_json(agregado['data'][:, j], medida), 'fill': False, 'tension': 0.1}
+            for j, categoria in enumerate(agregado['segments'])
+        ]
+        return {'labels': labels, 'datasets': datasets}, 200
+
+    elif chart_type == 'pie':
+        category_col = column_map.get('category_axis')
+        if not category_col or category_col not in df_base.columns:
+            raise ValueError(f"Coluna de categoria '{category_col}' não encontrada.")
+
+        agregado = agregar_grafico(df_base, filters, category_col, None, medida, value_col, top_k or 10, None, outros, usar_cubo, indice, selecao)
+        return {
+            'labels': agregado['labels'],
+            'datasets': [{'label': f'Proporção de {category_col}' if medida == 'count' else f'{nome_medida} por {category_col}',
+                          'data': valores_json(agregado['data'], medida)}]
+        }, 200
+    elif chart_type == 'histogram':
+        # 'numeric_axis' pode ser uma lista: várias colunas com um único passe de filtros (small multiples)
+        numeric_cols = column_map.get('numeric_axis')
+        multiplas = isinstance(numeric_cols, list)
+        numeric_cols = numeric_cols if multiplas else [numeric_cols]
+        for numeric_col in numeric_cols:
+            if not numeric_col or numeric_col not in df_base.columns:
                 raise ValueError(f"Coluna numérica '{numeric_col}' não encontrada.")
+        bins = config.get('bins', 'auto')
+        n_faixas = config.get('bin_count', 10)
+        # Opções de faixas vêm do cliente: valores inválidos são erro de requisição, não do servidor
+        if isinstance(n_faixas, bool) or not isinstance(n_faixas, int) or n_faixas < 1:
+            return {"error": "'bin_count' deve ser um inteiro positivo."}, 400
+        if isinstance(bins, list):
+            if not 2 <= len(bins) <= MAX_FAIXAS_HISTOGRAMA + 1 or not all(
+                    isinstance(borda, (int, float)) and not isinstance(borda, bool) and np.isfinite(borda) for borda in bins):
+                return {"error": f"'bins' como lista deve ter de 2 a {MAX_FAIXAS_HISTOGRAMA + 1} bordas numéricas finitas."}, 400
+        elif isinstance(bins, bool) or not isinstance(bins, (int, str)) or (isinstance(bins, int) and bins < 1):
+            return {"error": "'bins' deve ser um método, um inteiro positivo ou uma lista de bordas."}, 400
+        elif isinstance(bins, str) and bins not in METODOS_FAIXAS:
+            return {"error": f"Método de faixas '{bins}' não suportado. Use um de: {', '.join(METODOS_FAIXAS)}."}, 400
+
+        mascara = selecao.mascara if selecao is not None else mascara_por_indice(df_base, filters, indice)
+        histogramas = []
+        for numeric_col in numeric_cols:
+            histograma = calcular_histograma(obter_valores_numericos(dashboard_id, df_base, numeric_col)[mascara], bins, n_faixas)
+            histogramas.append({'column': numeric_col, **(histograma or {'edges': [], 'labels': [], 'data': []})})
+
+        if multiplas:
+            return {'histograms': histogramas}, 200
+        histograma = histogramas[0]
+        if not histograma['data']:
+            return {'labels': [], 'datasets': []}, 200
+        return {
+            'labels': histograma['labels'],
+            'edges': histograma['edges'],
+            'datasets': [{
+                'label': f'Distribuição de {numeric_cols[0]}',
+                'data': histograma['data']
+            }]
+        }, 200
+    # --- AQUI ADICIONAREMOS A LÓGICA PARA OUTROS TIPOS DE GRÁFICO (pie, timeseries, etc.) NO FUTURO ---
+
+    else:
+        return {"error": f"Tipo de gráfico '{chart_type}' não suportado."}, 400
+
+@bp.route('/api/generic_chart', methods=['POST'])
+@cache_resposta
+def get_generic_chart_data():
+    # 1. Pega a configuração do gráfico e os filtros do corpo da requisição
+    config = request.get_json()
+    dashboard_id = request.args.get('dashboard_id')
 
-            # Remove valores nulos e converte para numérico, tratando erros
-            series = pd.to_numeric(df_filtered[numeric_col], errors='coerce').dropna()
-
-            if series.empty:
-                return jsonify({'labels': [], 'datasets': []})
-
-            # Define as faixas (bins) para o histograma. 
-            # Ex: para idades, podemos ir de 0 a 100, em intervalos de 10.
-            # Esta lógica pode ser tornada mais dinâmica no futuro.
-            max_val = series.max()
-            bins = np.arange(0, max_val + 10, 10) # Cria faixas: 0-10, 10-20, ...
-            
-            # Cria labels para as faixas (ex: "0-9", "10-19", ...)
-            labels = [f"{int(i)}-{int(i+9)}" for i in bins[:-1]]
-            
-            # Usa pd.cut para agrupar os dados nas faixas
-            binned_data = pd.cut(series, bins=bins, labels=labels, right=False)
-            
-            # Conta os valores em cada faixa
-            data_counts = binned_data.value_counts().sort_index()
-            
-            return jsonify({
-                'labels': data_counts.index.tolist(),
-                'datasets': [{
-                    'label': f'Distribuição de {numeric_col}',
-                    'data': data_counts.values.tolist()
-                }]
-            })        
-        # --- AQUI ADICIONAREMOS A LÓGICA PARA OUTROS TIPOS DE GRÁFICO (pie, timeseries, etc.) NO FUTURO ---
+    # 2. Carrega o dataframe correto
+    df_base = get_dataframe(dashboard_id)
+    indice = obter_indice_bitmap(dashboard_id, df_base)
 
-        else:
-            return jsonify({"error": f"Tipo de gráfico '{chart_type}' não suportado."}), 400
+    try:
+        # 3. Lógica de cada tipo de gráfico (ver calcular_grafico_generico)
+        resposta, status = calcular_grafico_generico(config, df_base, dashboard_id, indice)
+        return jsonify(resposta), status
 
     except Exception as e:
         import traceback
@@ -723,7 +3184,96 @@ def get_generic_chart_data():
         print(traceback.format_exc())
         return jsonify({"error": str(e)}), 500
 
+# Gráficos de um lote avaliados em paralelo (1 = em sequência): as agregações do NumPy liberam o GIL
+LOTE_THREADS = int(os.environ.get('MULTIDASH_BATCH_THREADS', '4'))
+MAX_GRAFICOS_LOTE = 50
 
+def calcular_grafico_lote(spec, filters, df_base, dashboard_id, indice, selecao):
+    """Avalia um gráfico do lote com os filtros comuns; um erro fica no próprio item, sem derrubar os demais."""
+    from werkzeug.datastructures import MultiDict
+    config = {**spec, 'filters': filters}
+    try:
+        tipo = spec.get('chartType')
+        if tipo == 'map':
+            resposta, status = calcular_mapa(spec.get('view'), df_base, filters, dashboard_id, indice, MultiDict(spec.get('params') or {}), selecao)
+        elif tipo == 'history':
+            resposta, status = calcular_historico_municipios(config, df_base, dashboard_id, indice, selecao)
+        else:
+            resposta, status = calcular_grafico_generico(config, df_base, dashboard_id, indice, selecao)
+    except Exception as e:
+        import traceback
+        print(f"ERRO ao gerar gráfico do lote ({spec.get('chartType')}): {e}")
+        print(traceback.format_exc())
+        resposta, status = {"error": str(e)}, 500
+    return {'status': status, 'data': resposta}
+
+@bp.route('/api/batch', methods=['POST'])
+@cache_resposta
+def get_batch():
+    """
+    Vários gráficos sob um único conjunto de filtros: o recorte filtrado é calculado uma vez (SelecaoFiltrada)
+    e compartilhado por todas as agregações. Corpo: {"filters": {...}, "parallel": true, "charts": [
+    {"chartType": "bar" | "timeseries" | "pie" | "histogram", "columnMap": {...}, ...},
+    {"chartType": "map", "view": "municipality" | "ais" | "heatmap", "params": {"zoom": 8, "bbox": "..."}},
+    {"chartType": "history", "municipalities": [...] ou "all", "granularity": "year" | "month"}]}.
+    Responde {"results": [{"status": ..., "data": ...}]} na ordem dos gráficos pedidos.
+    """
+    config = request.get_json() or {}
+    graficos = config.get('charts')
+    filters = config.get('filters') or {'dates': {}, 'checkboxes': {}}
+    if not isinstance(graficos, list) or not graficos or not all(isinstance(g, dict) for g in graficos):
+        return jsonify({"error": "'charts' deve ser uma lista não vazia de gráficos."}), 400
+    if len(graficos) > MAX_GRAFICOS_LOTE:
+        return jsonify({"error": f"No máximo {MAX_GRAFICOS_LOTE} gráficos por lote."}), 400
+
+    dashboard_id = request.args.get('dashboard_id')
+    df_base = get_dataframe(dashboard_id)
+    indice = obter_indice_bitmap(dashboard_id, df_base)
+    # Os mapas precisam das camadas geográficas e da população (espaço de municípios), mesmo num dashboard
+    # customizado; carrega antes de abrir as threads
+    if any(g.get('chartType') == 'map' for g in graficos):
+        garantir_dados_crimes()
+        garantir_dados_geo()
+
+    selecao = SelecaoFiltrada(df_base, filters, indice)
+    tarefa = functools.partial(calcular_grafico_lote, filters=filters, df_base=df_base, dashboard_id=dashboard_id, indice=indice, selecao=selecao)
+    n_threads = min(LOTE_THREADS, len(graficos)) if config.get('parallel', True) else 1
+    if n_threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            resultados = list(executor.map(tarefa, graficos))
+    else:
+        resultados = [tarefa(g) for g in graficos]
+    return jsonify({'results': resultados})
+
+def create_app(preload=False):
+    """
+    Monta a aplicação Flask. Com preload=True os dados (e o geopandas) são carregados já aqui,
+    o que permite ao gunicorn com preload_app compartilhar essa memória entre os workers.
+    """
+    app = Flask(__name__)
+    app.json.ensure_ascii = False
+    # Limite de tamanho dos uploads de CSV (o Flask responde 413 acima disso)
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MULTIDASH_MAX_UPLOAD_MB', '4096')) * 1024 * 1024
+    app.register_blueprint(bp)
+    if preload:
+        garantir_dados_crimes()
+        garantir_dados_geo()
+        print("Aplicação pronta.")
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'build-snapshot':
+        # Pré-gera os snapshots (ex.: no deploy) para que os workers já subam com os dados processados
+        garantir_dados_crimes(forcar_reprocessamento=True)
+        garantir_dados_geo(forcar_reprocessamento=True)
+        print(f"Snapshots gravados em {SNAPSHOT_DIR}.")
+    elif len(sys.argv) > 2 and sys.argv[1] == 'append':
+        # Anexa lotes ao crimes.csv; os servidores em execução incorporam as linhas novas sozinhos
+        for caminho in sys.argv[2:]:
+            resumo = anexar_lote_crimes(pd.read_csv(caminho, dtype=str))
+            print(f"{caminho}: {resumo['appended']} ocorrências anexadas, {resumo['rejected']} rejeitadas (data inválida); total de {resumo['total']}.")
+    else:
+        app.run(debug=True)
@@ -0,0 +1,10 @@
+# Configuração do gunicorn: `gunicorn -c gunicorn.conf.py`
+# Os dados são carregados uma vez no processo mestre (create_app(preload=True)) e os workers
+# herdam essa memória pelo fork, em vez de cada um ler os arquivos e importar o geopandas.
+import os
+
+wsgi_app = 'app:create_app(preload=True)'
+preload_app = True
+bind = os.environ.get('MULTIDASH_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('MULTIDASH_WORKERS', '4'))
+timeout = 120
@@ -11,6 +11,28 @@ def client(app):
     """Cria um 'cliente' de teste, um navegador simulado para fazer requisições."""
     return app.test_client()
 
+@pytest.fixture
+def dashboard_customizado(client):
+    """Cria um dashboard a partir de um CSV pequeno e o exclui ao final do teste."""
+    import io
+    csv = (
+        "MUNICIPIO,NATUREZA,DATA,IDADE,LATITUDE,LONGITUDE\n"
+        "Fortaleza,ROUBO,01/02/2020,25,-3.73,-38.52\n"
+        "Fortaleza,FURTO,15/03/2021,40,-3.74,-38.53\n"
+        "Sobral,ROUBO,20/07/2021,33,-3.69,-40.35\n"
+        "Caucaia,FURTO,05/11/2022,19,-3.73,-38.66\n"
+    )
+    response = client.post('/api/create_dashboard', data={
+        'name': 'Teste',
+        'description': 'Dashboard de teste',
+        'columns': '["MUNICIPIO", "NATUREZA"]',
+        'file': (io.BytesIO(csv.encode('utf-8')), 'teste.csv')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 201
+    dashboard_id = response.get_json()['dashboard_id']
+    yield dashboard_id
+    client.delete(f'/api/dashboards/{dashboard_id}')
+
 
 def test_pagina_inicial(client):
     """Testa se a página inicial (/) carrega corretamente."""
@@ -112,3 +134,920 @@ def test_api_evolucao_anual_homicidios_estrutura(client):
         assert 'Masculino' in labels
         assert 'Feminino' in labels
 
+
+FILTROS_HOMICIDIO = {
+    'checkboxes': {'NATUREZA': ['HOMICIDIO DOLOSO']},
+    'dates': {'start': '2018-01-01', 'end': '2020-12-31'}
+}
+
+def test_api_map_data_municipios_atributos(client):
+    """NOVO: Testa se o mapa de municípios retorna apenas atributos, sem geometrias."""
+    response = client.post('/api/map_data/municipality', json=FILTROS_HOMICIDIO)
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert 'geojson' not in json_data
+    assert json_data['geometry_url'] == '/api/geometry/municipality'
+    assert 'max_taxa' in json_data and 'taxa_media_estado' in json_data
+    atributos = next(iter(json_data['attributes'].values()))
+    assert {'QUANTIDADE', 'TAXA_POR_100K', 'ranking', 'populacao'} <= set(atributos)
+
+def test_api_map_data_ais_atributos(client):
+    """NOVO: Testa se o mapa de AIS retorna os atributos indexados pelo nome da AIS."""
+    response = client.post('/api/map_data/ais', json=FILTROS_HOMICIDIO)
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert json_data['geometry_url'] == '/api/geometry/ais'
+    assert all(chave.startswith('AIS') for chave in json_data['attributes'])
+
+def test_api_geometria_etag(client):
+    """NOVO: Testa se a geometria é servida com ETag e responde 304 quando não mudou."""
+    response = client.get('/api/geometry/municipality')
+    assert response.status_code == 200
+    geojson = response.get_json()
+    assert len(geojson['features']) > 180
+    assert 'id' in geojson['features'][0]
+
+    etag = response.headers['ETag']
+    response_304 = client.get('/api/geometry/municipality', headers={'If-None-Match': etag})
+    assert response_304.status_code == 304
+
+    assert client.get('/api/geometry/inexistente').status_code == 404
+
+def test_cubo_contagens_equivale_a_varredura():
+    """NOVO: Testa se as contagens do cubo batem com o apply_filters + groupby sobre as linhas."""
+    from app import ESTADO_CRIMES, consultar_cubo, contar_ocorrencias
+
+    df_crimes_raw = ESTADO_CRIMES['df_crimes_raw']
+    contagens_cubo = consultar_cubo(ESTADO_CRIMES['CUBO_CONTAGENS'], FILTROS_HOMICIDIO, ['MUNICIPIO', 'ANO'])
+    contagens_linhas = contar_ocorrencias(df_crimes_raw, FILTROS_HOMICIDIO, ['MUNICIPIO', 'ANO'])
+    assert contagens_cubo is not None
+    assert contagens_cubo.to_dict() == contagens_linhas.to_dict()
+
+def test_cubo_contagens_datas_fora_do_mes():
+    """NOVO: Testa se o cubo recusa intervalos que não caem em limites de mês."""
+    from app import ESTADO_CRIMES, consultar_cubo
+
+    filtros = {'checkboxes': {}, 'dates': {'start': '2018-01-15', 'end': ''}}
+    assert consultar_cubo(ESTADO_CRIMES['CUBO_CONTAGENS'], filtros, ['MUNICIPIO']) is None
+
+def test_cubo_contagens_so_com_dimensoes_de_baixa_cardinalidade():
+    """NOVO: Testa se o cubo comprime as linhas e recusa filtros e agrupamentos fora das suas dimensões."""
+    import numpy as np
+    import pandas as pd
+    import app as app_module
+    from app import DIMENSOES_CUBO, construir_cubo_contagens, consultar_cubo
+
+    app_module.garantir_dados_crimes()
+    CUBO_CONTAGENS = app_module.ESTADO_CRIMES['CUBO_CONTAGENS']
+    assert CUBO_CONTAGENS['dimensoes'] == DIMENSOES_CUBO and 'LOCAL' not in CUBO_CONTAGENS['celulas']
+    sem_filtros = {'checkboxes': {}, 'dates': {}}
+    assert consultar_cubo(CUBO_CONTAGENS, sem_filtros, ['LOCAL']) is None
+    assert consultar_cubo(CUBO_CONTAGENS, {'checkboxes': {'LOCAL': ['VIA PUBLICA']}, 'dates': {}}, ['MUNICIPIO']) is None
+
+    # Volume realista: muitas ocorrências por combinação de dimensões
+    rng = np.random.default_rng(0)
+    n = 200000
+    df = pd.DataFrame({
+        'NATUREZA': rng.choice(['HOMICIDIO DOLOSO', 'FEMINICIDIO', 'LATROCINIO', 'LESAO CORPORAL SEGUIDA DE MORTE'], n),
+        'MUNICIPIO': rng.choice([f'M{i}' for i in range(5)], n),
+        'AIS': rng.choice(['AIS 1', 'AIS 2'], n),
+        'GENERO': rng.choice(['MASCULINO', 'FEMININO'], n),
+        'RACA_VITIMA': rng.choice(['PARDA', 'BRANCA'], n),
+        'DIA_SEMANA': rng.choice(['SABADO', 'DOMINGO'], n),
+        'LOCAL': [f'RUA {i}' for i in range(n)],
+        'DATA': pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 730, n), unit='D'),
+    }).astype({col: 'category' for col in DIMENSOES_CUBO})
+    cubo = construir_cubo_contagens(df, DIMENSOES_CUBO)
+    assert len(cubo['contagens']) < n // 10 and cubo['contagens'].sum() == n
+    contagens = consultar_cubo(cubo, {'checkboxes': {'GENERO': ['FEMININO']}, 'dates': {}}, ['MUNICIPIO'])
+    assert contagens.to_dict() == df[df['GENERO'] == 'FEMININO'].groupby('MUNICIPIO', observed=True).size().to_dict()
+
+def test_api_history_municipio(client):
+    """NOVO: Testa o histórico anual de um município com os filtros da sidebar."""
+    response = client.post('/api/history/municipio/Fortaleza', json=FILTROS_HOMICIDIO)
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert len(json_data['labels']) == len(json_data['data'])
+
+@pytest.mark.parametrize("chart_config", [
+    {'chartType': 'bar', 'columnMap': {'category_axis': 'NATUREZA'}},
+    {'chartType': 'bar', 'columnMap': {'category_axis': 'MUNICIPIO', 'segment_by': 'GENERO'}},
+    {'chartType': 'pie', 'columnMap': {'category_axis': 'RACA_VITIMA'}},
+    {'chartType': 'timeseries', 'columnMap': {'time_axis': 'DATA', 'category_axis': 'NATUREZA'}},
+    {'chartType': 'histogram', 'columnMap': {'numeric_axis': 'IDADE_VITIMA'}},
+])
+def test_api_generic_chart(client, chart_config):
+    """NOVO: Testa se os gráficos genéricos retornam labels e datasets."""
+    response = client.post('/api/generic_chart', json={**chart_config, 'filters': FILTROS_HOMICIDIO})
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert 'labels' in json_data and 'datasets' in json_data
+
+def test_colunas_categoricas_e_filtro_por_codigo():
+    """NOVO: Testa se as colunas de texto viram Categorical limpas e se o filtro por códigos funciona."""
+    import pandas as pd
+    from app import apply_filters, normalizar_colunas_texto
+
+    df = normalizar_colunas_texto(pd.DataFrame({
+        'NATUREZA': [' ROUBO', 'FURTO ', 'ROUBO', 'FURTO', None],
+        'ID': ['a', 'b', 'c', 'd', 'e']
+    }))
+    assert isinstance(df['NATUREZA'].dtype, pd.CategoricalDtype)
+    assert df['ID'].dtype == object
+    assert sorted(df['NATUREZA'].cat.categories) == ['FURTO', 'ROUBO']
+
+    filtros = {'checkboxes': {'NATUREZA': ['ROUBO '], 'ID': ['a', 'c', 'd']}, 'dates': {}}
+    assert apply_filters(df, filtros)['ID'].tolist() == ['a', 'c']
+
+def test_indice_bitmap_equivale_ao_filtro_sequencial():
+    """NOVO: Testa se o filtro pelo índice de bitmaps devolve as mesmas linhas do filtro por máscaras."""
+    from app import ESTADO_CRIMES, apply_filters
+
+    df_crimes_raw = ESTADO_CRIMES['df_crimes_raw']
+    filtros = {
+        'checkboxes': {'NATUREZA': ['HOMICIDIO DOLOSO', 'LATROCINIO'], 'GENERO': ['FEMININO']},
+        'dates': {'start': '2018-03-10', 'end': '2021-07-20'}
+    }
+    esperado = apply_filters(df_crimes_raw, filtros)
+    obtido = apply_filters(df_crimes_raw, filtros, ESTADO_CRIMES['indice_bitmap'])
+    assert obtido.index.equals(esperado.index)
+
+def test_api_index_stats(client):
+    """NOVO: Testa se a memória do índice do dataset padrão é reportada."""
+    response = client.get('/api/index_stats')
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert json_data['padrao']['bytes_total'] > 0
+    assert 'NATUREZA' in json_data['padrao']['bytes_por_coluna']
+
+def test_cache_de_datasets_customizados(client, dashboard_customizado):
+    """NOVO: Testa se o CSV de um dashboard é lido uma vez e servido do cache depois."""
+    def estatisticas():
+        return client.get('/api/cache_stats').get_json()['datasets']
+
+    from app import get_dataframe
+
+    antes = estatisticas()
+    response = client.get(f'/api/schema?dashboard_id={dashboard_customizado}')
+    assert response.status_code == 200
+    assert response.get_json()['NATUREZA'] == ['FURTO', 'ROUBO']
+    # O schema sai do perfil calculado no upload; as leituras do dataset são feitas direto
+    for _ in range(3):
+        assert len(get_dataframe(dashboard_customizado)) == 4
+    depois = estatisticas()
+    assert depois['misses'] == antes['misses'] + 1
+    assert depois['hits'] == antes['hits'] + 2
+
+    # Só os dicionários dos textos contam como memória do processo: o resto é o arquivo mapeado, compartilhado
+    import app as app_module
+    df = get_dataframe(dashboard_customizado)
+    privados = app_module.bytes_privados_dataset(df)
+    assert privados == sum(int(df[c].cat.categories.memory_usage(deep=True)) for c in df.columns if df[c].dtype == 'category')
+    assert privados < df.memory_usage(deep=True).sum()
+
+    client.delete(f'/api/dashboards/{dashboard_customizado}')
+    assert estatisticas()['entradas'] == depois['entradas'] - 1
+
+def test_dashboard_convertido_para_formato_colunar(client, dashboard_customizado):
+    """NOVO: Testa se o upload gera o formato colunar, com datas convertidas e tipos salvos nos metadados."""
+    import pandas as pd
+    from app import carregar_dataset_colunar, ler_metadados_dashboard
+
+    metadata = ler_metadados_dashboard(dashboard_customizado)
+    assert metadata['data_path'].endswith('manifest.json')
+    tipos = {c['name']: c['type'] for c in metadata['column_types']}
+    assert tipos['IDADE'] == 'numeric' and tipos['MUNICIPIO'] == 'categorical'
+
+    df = carregar_dataset_colunar(metadata['data_path'])
+    assert len(df) == 4
+    assert pd.api.types.is_datetime64_any_dtype(df['DATA'])
+    assert df['DATA'].iloc[0] == pd.Timestamp(2020, 2, 1)
+
+    projetado = carregar_dataset_colunar(metadata['data_path'], columns=['NATUREZA'])
+    assert projetado.columns.tolist() == ['NATUREZA']
+
+    response = client.get(f'/api/columns?dashboard_id={dashboard_customizado}')
+    assert response.status_code == 200
+    assert {'name': 'IDADE', 'type': 'numeric'} in response.get_json()
+
+def test_conversao_em_blocos_equivale_a_leitura_completa(tmp_path):
+    """NOVO: Testa se a ingestão em blocos pequenos produz o mesmo dataset que a leitura do CSV inteiro."""
+    import numpy as np
+    import pandas as pd
+    from app import carregar_dataset_colunar, converter_csv_para_colunar, ler_csv_dashboard
+
+    csv_path = tmp_path / 'dados.csv'
+    csv_path.write_text(
+        "NATUREZA,IDADE,QTD,VALOR,DATA\n"
+        "ROUBO ,25,1,1.5,01/02/2020\n"
+        "FURTO,NI,2,,15/03/2021\n"
+        "ROUBO,33,3,2.0,20/07/2021\n"
+        ",40,4,3.25,05/11/2022\n"
+        "FURTO,19,5,4.0,\n",
+        encoding='utf-8'
+    )
+    manifest_path, tipos = converter_csv_para_colunar(str(csv_path), str(tmp_path / 'dados.cols'), tamanho_bloco=2)
+    esperado = ler_csv_dashboard(str(csv_path))
+    obtido = carregar_dataset_colunar(manifest_path)
+
+    assert obtido['QTD'].dtype == 'int64'
+    assert {'name': 'QTD', 'type': 'numeric'} in tipos and {'name': 'DATA', 'type': 'date'} in tipos
+    pd.testing.assert_frame_equal(
+        obtido.astype({'NATUREZA': object, 'IDADE': object}), esperado.astype({'NATUREZA': object, 'IDADE': object})
+    )
+
+    # Textos de baixa (NATUREZA) e de alta cardinalidade (IDADE, com 'NI') ficam sobre os códigos mapeados, sem cópia
+    for coluna in ['NATUREZA', 'IDADE', 'QTD']:
+        valores = obtido[coluna].array.codes if coluna != 'QTD' else obtido[coluna].to_numpy()
+        assert isinstance(valores.base, np.memmap) or isinstance(valores, np.memmap), coluna
+
+def test_conversao_colunar_com_texto_depois_da_amostra(tmp_path, monkeypatch):
+    """NOVO: Testa se um valor não numérico depois da amostra faz a coluna ser gravada como texto, sem perder dados."""
+    import app as app_module
+    monkeypatch.setattr(app_module, 'AMOSTRA_LINHAS_ANALISE', 5)
+    linhas = [f"{i},{i * 10},{i}.5" for i in range(20)] + ["20,N/D,20.5", "21,210,22.5"]
+    csv_path = tmp_path / 'dados.csv'
+    csv_path.write_text("ID,CODIGO,VALOR\n" + "\n".join(linhas) + "\n", encoding='utf-8')
+    manifest_path, tipos = app_module.converter_csv_para_colunar(str(csv_path), str(tmp_path / 'dados.cols'), tamanho_bloco=4)
+
+    obtido = app_module.carregar_dataset_colunar(manifest_path)
+    assert obtido['CODIGO'].astype(str).tolist() == [str(i * 10) for i in range(20)] + ['N/D', '210']
+    assert obtido['ID'].dtype == 'int64' and obtido['VALOR'].dtype == 'float64'
+    # 21 de 22 valores ainda são números: a detecção de novo, sobre a coluna inteira, a mantém numérica
+    assert {'name': 'CODIGO', 'type': 'numeric'} in tipos
+
+def test_snapshot_dados_base(tmp_path, monkeypatch):
+    """NOVO: Testa se o snapshot dos dados pré-processados é reaproveitado e substituído quando a versão muda."""
+    import app as app_module
+    monkeypatch.setattr(app_module, 'SNAPSHOT_DIR', str(tmp_path))
+    chamadas = []
+    arquivos = ['crimes.csv', 'populacao_ce.csv']
+    processar = lambda: chamadas.append(1) or app_module.processar_dados_crimes()
+
+    primeiro = app_module.carregar_snapshot('crimes', arquivos, 'teste', processar)
+    segundo = app_module.carregar_snapshot('crimes', arquivos, 'teste', processar)
+    assert len(chamadas) == 1
+    assert len(list(tmp_path.glob('snapshot_crimes_*.pkl'))) == 1
+    assert segundo['LISTA_DE_CRIMES'] == primeiro['LISTA_DE_CRIMES']
+    assert segundo['CUBO_CONTAGENS']['contagens'].tolist() == primeiro['CUBO_CONTAGENS']['contagens'].tolist()
+    assert segundo['df_crimes_raw'].equals(primeiro['df_crimes_raw'])
+
+    monkeypatch.setattr(app_module, 'SNAPSHOT_VERSAO', app_module.SNAPSHOT_VERSAO + 1)
+    app_module.carregar_snapshot('crimes', arquivos, 'teste', processar)
+    assert len(chamadas) == 2
+    snapshots = list(tmp_path.glob('snapshot_crimes_*.pkl'))
+    assert len(snapshots) == 1
+    assert snapshots[0].name.startswith(f"snapshot_crimes_v{app_module.SNAPSHOT_VERSAO}_")
+
+def test_rotas_leves_sem_dados_pesados():
+    """NOVO: Testa se importar a aplicação e usar rotas leves não carrega o geopandas nem o scikit-learn."""
+    import subprocess
+    import sys
+    import os
+    codigo = (
+        "import sys, app\n"
+        "client = app.app.test_client()\n"
+        "assert client.get('/api/dashboards').status_code == 200\n"
+        "assert client.get('/api/year_range').status_code == 200\n"
+        "print('geopandas' in sys.modules, 'sklearn' in sys.modules)\n"
+    )
+    resultado = subprocess.run([sys.executable, '-c', codigo], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert resultado.returncode == 0, resultado.stderr
+    assert resultado.stdout.strip().splitlines()[-1] == 'False False'
+
+def test_cache_de_respostas_post(client, dashboard_customizado):
+    """NOVO: Testa se filtros equivalentes reaproveitam a resposta em cache e se excluir o dashboard a invalida."""
+    def estatisticas():
+        return client.get('/api/cache_stats').get_json()['respostas']
+
+    url = f'/api/map_data/heatmap?dashboard_id={dashboard_customizado}'
+    filtros_a = {'dates': {'start': '2020-01-01', 'end': '2022-12-31'}, 'checkboxes': {'NATUREZA': ['ROUBO', 'FURTO'], 'MUNICIPIO': []}}
+    filtros_b = {'checkboxes': {'NATUREZA': [' FURTO', 'ROUBO']}, 'dates': {'end': '2022-12-31', 'start': '2020-01-01'}}
+
+    antes = estatisticas()
+    primeira = client.post(url, json=filtros_a)
+    segunda = client.post(url, json=filtros_b)
+    assert primeira.status_code == 200 and segunda.status_code == 200
+    assert primeira.headers['X-Cache'] == 'MISS' and segunda.headers['X-Cache'] == 'HIT'
+    assert segunda.get_json() == primeira.get_json()
+    depois = estatisticas()
+    assert depois['hits'] == antes['hits'] + 1
+    assert depois['misses'] == antes['misses'] + 1
+    assert 0 < depois['hit_rate'] <= 1
+
+    client.delete(f'/api/dashboards/{dashboard_customizado}')
+    assert estatisticas()['entradas'] == depois['entradas'] - 1
+
+def test_backend_de_cache_compartilhado(tmp_path):
+    """NOVO: Testa o backend de cache em arquivos (memória compartilhada entre workers): leitura, TTL, limite e invalidação."""
+    from app import CacheRespostasArquivos
+
+    cache = CacheRespostasArquivos(str(tmp_path), max_bytes=10, ttl=60)
+    cache.guardar('dash', 'a', b'12345')
+    # Outro worker enxerga a mesma entrada por meio de uma instância própria
+    assert CacheRespostasArquivos(str(tmp_path), max_bytes=10, ttl=60).obter('dash', 'a') == b'12345'
+
+    cache.guardar('dash', 'b', b'1234567')
+    assert cache.obter('dash', 'a') is None
+    assert cache.obter('dash', 'b') == b'1234567'
+
+    cache.guardar(None, 'c', b'1')
+    cache.invalidar('dash')
+    assert cache.obter('dash', 'b') is None
+    assert cache.obter(None, 'c') == b'1'
+
+    expirado = CacheRespostasArquivos(str(tmp_path), max_bytes=10, ttl=-1)
+    assert expirado.obter(None, 'c') is None
+
+def test_caches_de_resposta_mantem_total_de_bytes(tmp_path, monkeypatch):
+    """NOVO: Testa se os backends mantêm o total de bytes nas escritas, sem somar todas as entradas a cada vez."""
+    from app import CacheRespostasArquivos, CacheRespostasMemoria
+
+    memoria = CacheRespostasMemoria(max_bytes=10, ttl=60)
+    memoria.guardar('dash', 'a', b'1234')
+    memoria.guardar('dash', 'a', b'12345')
+    memoria.guardar('outro', 'b', b'123')
+    assert memoria.estatisticas() == {'entradas': 2, 'bytes': 8}
+    memoria.guardar('dash', 'c', b'1234')
+    assert memoria.obter('dash', 'a') is None and memoria.estatisticas()['bytes'] == 7
+    memoria.invalidar('dash')
+    assert memoria.estatisticas() == {'entradas': 1, 'bytes': 3}
+
+    arquivos = CacheRespostasArquivos(str(tmp_path), max_bytes=1000, ttl=60)
+    varreduras = []
+    original = arquivos.arquivos
+    monkeypatch.setattr(arquivos, 'arquivos', lambda: varreduras.append(1) or original())
+    for i in range(20):
+        arquivos.guardar('dash', str(i), b'12345')
+    # Só a primeira gravação varre o diretório; as demais atualizam o total em memória
+    assert len(varreduras) == 1 and arquivos.bytes_estimados == 100
+    arquivos.max_bytes = 50
+    arquivos.guardar('dash', 'x', b'12345')
+    assert len(varreduras) == 2 and arquivos.bytes_estimados <= 50
+    assert arquivos.obter('dash', 'x') == b'12345' and arquivos.obter('dash', '0') is None
+
+def test_historico_de_varios_municipios(client, dashboard_customizado):
+    """NOVO: Testa se o histórico em lote bate com as chamadas por município e se aceita 'all' e granularidade mensal."""
+    lote = client.post('/api/history/municipios', json={'municipalities': ['Fortaleza', 'Sobral'], 'filters': FILTROS_HOMICIDIO})
+    assert lote.status_code == 200
+    lote = lote.get_json()
+    for municipio in ['Fortaleza', 'Sobral']:
+        individual = client.post(f'/api/history/municipio/{municipio}', json=FILTROS_HOMICIDIO).get_json()
+        assert individual['labels'] == lote['labels']
+        assert individual['data'] == lote['series'][municipio]
+
+    mensal = client.post(f'/api/history/municipios?dashboard_id={dashboard_customizado}',
+                         json={'municipalities': 'all', 'granularity': 'month'}).get_json()
+    assert mensal['labels'][0] == '2020-02' and mensal['labels'][-1] == '2022-11'
+    assert sorted(mensal['series']) == ['Caucaia', 'Fortaleza', 'Sobral']
+    assert sum(mensal['series']['Fortaleza']) == 2
+    assert mensal['series']['Caucaia'][-1] == 1
+
+    assert client.post('/api/history/municipios', json={'municipalities': 'Fortaleza'}).status_code == 400
+
+@pytest.mark.parametrize('metodo', ['pearson', 'spearman'])
+def test_matriz_de_correlacao(client, metodo):
+    """NOVO: Testa se a matriz de correlação entre naturezas bate com o DataFrame.corr do pandas, respeitando os filtros."""
+    import numpy as np
+    import pandas as pd
+    import app as app_module
+
+    filtros = {'dates': {'start': '2016-01-01', 'end': '2023-12-31'}, 'checkboxes': {'MUNICIPIO': ['Fortaleza', 'Sobral']}}
+    response = client.post('/api/correlation_matrix', json={'method': metodo, 'filters': filtros})
+    assert response.status_code == 200
+    json_data = response.get_json()
+
+    df_filtrado = app_module.apply_filters(app_module.ESTADO_CRIMES['df_crimes_graficos'], filtros)
+    esperado = df_filtrado.groupby(['ANO', 'NATUREZA'], observed=True).size().unstack(fill_value=0).corr(method=metodo)
+    obtido = pd.DataFrame(json_data['matrix'], index=json_data['labels'], columns=json_data['labels']).astype(float)
+    assert json_data['periods'] == 8
+    assert np.allclose(obtido.to_numpy(), esperado.loc[json_data['labels'], json_data['labels']].to_numpy(), equal_nan=True)
+
+    assert client.post('/api/correlation_matrix', json={'method': 'kendall'}).status_code == 400
+
+def test_correlacao_de_par_pela_matriz_pre_calculada(client):
+    """NOVO: Testa se o gráfico de dispersão de um par de crimes continua igual ao cálculo direto na tabela."""
+    import app as app_module
+    app_module.garantir_dados_crimes()
+    crime1, crime2 = app_module.ESTADO_CRIMES['LISTA_DE_CRIMES'][:2]
+    response = client.get(f'/api/correlation_data?crime1={crime1}&crime2={crime2}')
+    assert response.status_code == 200
+
+    df = app_module.ESTADO_CRIMES['df_crimes_graficos']
+    contagens = df[df['NATUREZA'].isin([crime1, crime2])].groupby(['ANO', 'NATUREZA'], observed=True).size().unstack(fill_value=0)
+    esperado = [{'x': int(linha[crime1]), 'y': int(linha[crime2]), 'year': int(ano)} for ano, linha in contagens.iterrows()]
+    assert response.get_json() == esperado
+
+def test_busca_de_municipios_por_prefixo(client):
+    """NOVO: Testa a busca de municípios por prefixo, ignorando acentos e maiúsculas."""
+    response = client.get('/api/municipalities/search?q=for')
+    assert response.status_code == 200
+    nomes = [m['name'] for m in response.get_json()]
+    assert 'Fortaleza' in nomes and 'Fortim' in nomes
+    assert all(n.upper().startswith('FOR') for n in nomes)
+
+    resultado = client.get('/api/municipalities/search?q=maracanau').get_json()
+    assert [m['name'] for m in resultado] == ['Maracanaú']
+    oeste, sul, leste, norte = resultado[0]['bbox']
+    assert oeste <= resultado[0]['lon'] <= leste and sul <= resultado[0]['lat'] <= norte
+
+    assert len(client.get('/api/municipalities/search?q=a&limit=3').get_json()) == 3
+    assert client.get('/api/municipalities/search?q=').get_json() == []
+
+def test_lista_de_municipios_com_etag(client):
+    """NOVO: Testa se a lista de municípios é servida com ETag e responde 304 quando o cliente já a tem."""
+    response = client.get('/api/municipalities')
+    assert response.status_code == 200 and response.headers.get('ETag')
+    assert 'bbox' in response.get_json()[0]
+    revalidacao = client.get('/api/municipalities', headers={'If-None-Match': response.headers['ETag']})
+    assert revalidacao.status_code == 304
+
+def test_mapa_de_calor_agregado_em_grade(client, dashboard_customizado):
+    """NOVO: Testa se o mapa de calor com zoom/bbox devolve células agregadas, respeitando filtros e área visível."""
+    url = f'/api/map_data/heatmap?dashboard_id={dashboard_customizado}'
+    sem_filtros = {'dates': {}, 'checkboxes': {}}
+
+    pontos = client.post(url, json=sem_filtros).get_json()
+    assert len(pontos) == 4
+
+    grade = client.post(f'{url}&zoom=7&bbox=-41.5,-8,-37,-2.5', json=sem_filtros).get_json()
+    assert grade['total'] == 4
+    assert sum(c[2] for c in grade['cells']) == 4
+    assert grade['max'] == 2  # Os dois pontos de Fortaleza caem na mesma célula nesse zoom
+
+    # Com zoom alto as duas ocorrências de Fortaleza se separam; fora da área visível nada é contado
+    detalhe = client.post(f'{url}&zoom=16&bbox=-38.6,-3.8,-38.5,-3.7', json=sem_filtros).get_json()
+    assert detalhe['total'] == 2 and detalhe['max'] == 1
+
+    roubos = client.post(f'{url}&zoom=7&bbox=-41.5,-8,-37,-2.5',
+                         json={'dates': {}, 'checkboxes': {'NATUREZA': ['ROUBO']}}).get_json()
+    assert roubos['total'] == 2
+
+    assert client.post(f'{url}&bbox=1,2,3', json=sem_filtros).status_code == 400
+    for zoom in ['nan', 'inf', '-inf', 'abc']:
+        assert client.post(f'{url}&zoom={zoom}', json=sem_filtros).status_code == 400
+    assert client.post(f'{url}&zoom=7&bbox=nan,-8,-37,-2.5', json=sem_filtros).status_code == 400
+    # Zoom fora de 0-22 é limitado à faixa (o passo da grade não vira zero nem infinito)
+    maximo = client.post(f'{url}&zoom=1e6&bbox=-38.6,-3.8,-38.5,-3.7', json=sem_filtros).get_json()
+    assert maximo['total'] == 2 and maximo['max'] == 1
+
+def test_atribuicao_de_municipio_por_coordenadas(client):
+    """NOVO: Testa se um upload só com coordenadas ganha as colunas MUNICIPIO e AIS pelo ponto-no-polígono."""
+    import io
+    import app as app_module
+    csv = (
+        "NATUREZA,DATA,LATITUDE,LONGITUDE\n"
+        "ROUBO,01/02/2020,-3.73,-38.52\n"
+        "FURTO,15/03/2021,-3.69,-40.35\n"
+        "ROUBO,20/07/2021,-3.73,-38.66\n"
+        "FURTO,05/11/2022,,\n"
+        "ROUBO,06/11/2022,-23.55,-46.63\n"
+    )
+    response = client.post('/api/create_dashboard', data={
+        'name': 'Geolocalizado', 'description': 'Só coordenadas', 'columns': '["NATUREZA"]',
+        'file': (io.BytesIO(csv.encode('utf-8')), 'geo.csv')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 201
+    dashboard_id = response.get_json()['dashboard_id']
+    try:
+        tipos = {c['name']: c['type'] for c in response.get_json()['dashboard_info']['column_types']}
+        assert tipos['MUNICIPIO'] == 'categorical' and tipos['AIS'] == 'categorical'
+
+        df = app_module.get_dataframe(dashboard_id)
+        assert df['MUNICIPIO'].tolist()[:3] == ['Fortaleza', 'Sobral', 'Caucaia']
+        assert df['MUNICIPIO'].iloc[3:].isna().all()
+        assert df['AIS'].tolist()[:3] == ['AIS 1-10', 'AIS 14', 'AIS 11']
+
+        mapa = client.post(f'/api/map_data/municipality?dashboard_id={dashboard_id}', json={'dates': {}, 'checkboxes': {}}).get_json()
+        assert sum(a['QUANTIDADE'] for a in mapa['attributes'].values()) == 3
+    finally:
+        client.delete(f'/api/dashboards/{dashboard_id}')
+
+def test_geometrias_em_niveis_de_detalhe(client):
+    """NOVO: Testa se o zoom escolhe geometrias simplificadas menores e se o formato quantizado decodifica para o GeoJSON."""
+    import numpy as np
+    completa = client.get('/api/geometry/municipality')
+    estado = client.get('/api/geometry/municipality?zoom=7')
+    assert completa.status_code == 200 and estado.status_code == 200
+    assert len(estado.data) < len(completa.data) / 3
+    assert estado.headers['ETag'] != completa.headers['ETag']
+    assert len(estado.get_json()['features']) == len(completa.get_json()['features'])
+
+    mapa = client.post('/api/map_data/municipality?zoom=6', json=FILTROS_HOMICIDIO).get_json()
+    assert mapa['geometry_url'] == '/api/geometry/municipality?zoom=7'
+    assert mapa['geometry_etag'] == estado.headers['ETag'].strip('"')
+
+    quantizado = client.get('/api/geometry/municipality?zoom=7&format=quantized').get_json()
+    escala = np.array(quantizado['transform']['scale'])
+    origem = np.array(quantizado['transform']['translate'])
+    for feature, esperada in zip(quantizado['features'][:5], estado.get_json()['features'][:5]):
+        assert str(feature['id']) == str(esperada['id'])
+        aneis = feature['geometry']['coordinates']
+        aneis_esperados = esperada['geometry']['coordinates']
+        if feature['geometry']['type'] == 'MultiPolygon':
+            aneis, aneis_esperados = aneis[0], aneis_esperados[0]
+        decodificado = np.cumsum(np.array(aneis[0]), axis=0) * escala + origem
+        assert np.allclose(decodificado, np.array(aneis_esperados[0]), atol=escala.max())
+
+    assert client.get('/api/geometry/municipality?format=svg').status_code == 400
+
+def test_vector_tiles_das_camadas(client, tmp_path, monkeypatch):
+    """NOVO: Testa se a tile MVT traz a camada com as feições esperadas e se fica gravada em disco."""
+    import numpy as np
+    import app as app_module
+    monkeypatch.setattr(app_module, 'TILES_DIR', str(tmp_path))
+
+    def ler_varint(buf, i):
+        resultado = deslocamento = 0
+        while True:
+            byte = buf[i]
+            i += 1
+            resultado |= (byte & 0x7F) << deslocamento
+            deslocamento += 7
+            if not byte & 0x80:
+                return resultado, i
+
+    def campos(buf):
+        i, saida = 0, []
+        while i < len(buf):
+            chave, i = ler_varint(buf, i)
+            if chave & 7 == 0:
+                valor, i = ler_varint(buf, i)
+            else:
+                tamanho, i = ler_varint(buf, i)
+                valor, i = buf[i:i + tamanho], i + tamanho
+            saida.append((chave >> 3, valor))
+        return saida
+
+    # Tile z=5 que cobre todo o Ceará
+    response = client.get('/tiles/municipality/5/12/16.pbf')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.mapbox-vector-tile'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert len(list(tmp_path.rglob('16.pbf'))) == 1
+
+    camada = [valor for numero, valor in campos(response.data) if numero == 3][0]
+    campos_camada = campos(camada)
+    assert [v for n, v in campos_camada if n == 1] == [b'municipality']
+    features = [dict(campos(v)) for n, v in campos_camada if n == 2]
+    assert len(features) == len(app_module.gdf_municipios_raw)
+    assert {f[3] for f in features} == {3}  # Todas são polígonos
+    assert sorted(f[1] for f in features) == sorted(int(i) for i in app_module.gdf_municipios_raw['id'])
+
+    # Soma das áreas (fórmula do agrimensor nos comandos decodificados) bate com a área projetada
+    def decodificar(geometria):
+        comandos, j = [], 0
+        while j < len(geometria):
+            valor, j = ler_varint(geometria, j)
+            comandos.append(valor)
+        x = y = i = 0
+        aneis, atual = [], []
+        while i < len(comandos):
+            comando, quantidade = comandos[i] & 7, comandos[i] >> 3
+            i += 1
+            if comando == 7:
+                aneis.append(np.array(atual))
+                continue
+            for _ in range(quantidade):
+                x += (comandos[i] >> 1) ^ -(comandos[i] & 1)
+                y += (comandos[i + 1] >> 1) ^ -(comandos[i + 1] & 1)
+                i += 2
+                atual = [(x, y)] if comando == 1 else atual + [(x, y)]
+        return aneis
+
+    area = sum(
+        np.sum(a[:, 0] * np.roll(a[:, 1], -1) - np.roll(a[:, 0], -1) * a[:, 1]) / 2
+        for f in features for a in decodificar(f[4])
+    )
+    tamanho_pixel = 2 * app_module.LIMITE_MERCATOR / 2 ** 5 / app_module.EXTENSAO_TILE
+    esperada = app_module.camada_mercator('municipality', 0)['gdf'].geometry.area.sum() / tamanho_pixel ** 2
+    assert abs(area - esperada) / esperada < 0.001
+
+    # Tiles fora da extensão da camada saem vazias e não vão para o disco; zoom acima do teto é rejeitado
+    arquivos = len(list(tmp_path.rglob('*.pbf')))
+    assert client.get('/tiles/municipality/3/0/0.pbf').data == b''
+    assert client.get('/tiles/municipality/16/0/0.pbf').data == b''
+    assert len(list(tmp_path.rglob('*.pbf'))) == arquivos
+    assert not list(tmp_path.rglob('*.tmp'))
+    assert client.get(f'/tiles/municipality/{app_module.MAX_ZOOM_TILE + 1}/0/0.pbf').status_code == 400
+    # Acima de MAX_ZOOM_TILE_DISCO a tile (dentro da camada) é gerada, mas não gravada
+    monkeypatch.setattr(app_module, 'MAX_ZOOM_TILE_DISCO', 4)
+    response = client.get('/tiles/municipality/5/12/16.pbf')
+    assert response.status_code == 200 and len(response.data) > 0
+    (arquivo,) = tmp_path.rglob('16.pbf')
+    arquivo.unlink()
+    assert client.get('/tiles/municipality/5/12/16.pbf').data == response.data
+    assert not list(tmp_path.rglob('*.pbf'))
+    assert client.get('/tiles/bairros/5/12/16.pbf').status_code == 404
+    assert client.get('/tiles/ais/1/5/0.pbf').status_code == 400
+
+def test_anexacao_incremental_de_ocorrencias(client, tmp_path, monkeypatch):
+    """NOVO: Testa se anexar um lote atualiza tabelas, agregados, cubo e índice igual a reprocessar o crimes.csv inteiro."""
+    import io
+    import shutil
+    import numpy as np
+    import pandas as pd
+    import app as app_module
+    linhas = open(app_module.os.path.join(app_module.BASE_DIR, 'crimes.csv'), encoding='utf-8').read().splitlines()
+    (tmp_path / 'crimes.csv').write_text('\n'.join(linhas[:3001]) + '\n', encoding='utf-8')
+    shutil.copy(app_module.os.path.join(app_module.BASE_DIR, 'populacao_ce.csv'), tmp_path / 'populacao_ce.csv')
+    monkeypatch.setattr(app_module, 'BASE_DIR', str(tmp_path))
+    monkeypatch.setattr(app_module, 'SNAPSHOT_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(app_module, 'ESTADO_CRIMES', app_module.ESTADO_CRIMES)
+    monkeypatch.setattr(app_module, 'INDICES_BITMAP', {})
+    monkeypatch.setattr(app_module, 'INDICES_ESPACIAIS', {})
+    monkeypatch.setattr(app_module, 'ESTADO_CSV_CRIMES', {'bytes_lidos': 0, 'verificado_em': 0.0})
+    app_module.garantir_dados_crimes(forcar_reprocessamento=True)
+
+    # A rota fica fechada sem token configurado ou com token errado, e nada é gravado
+    tamanho_original = (tmp_path / 'crimes.csv').stat().st_size
+    def enviar(**cabecalhos):
+        return client.post('/api/crimes/append', data={'file': (io.BytesIO(f'{linhas[0]}\n{linhas[3001]}\n'.encode('utf-8')), 'lote.csv')},
+                           content_type='multipart/form-data', headers=cabecalhos)
+    monkeypatch.setattr(app_module, 'TOKEN_ANEXACAO', None)
+    assert enviar().status_code == 403
+    assert enviar(**{'X-Append-Token': ''}).status_code == 403
+    monkeypatch.setattr(app_module, 'TOKEN_ANEXACAO', 'segredo')
+    assert enviar().status_code == 403
+    assert enviar(**{'X-Append-Token': 'errado'}).status_code == 403
+    assert (tmp_path / 'crimes.csv').stat().st_size == tamanho_original
+
+    lote = [linhas[0]] + linhas[3001:3501] + [
+        'AIS 99,CRIME NOVO,Município Novo,VIA PUBLICA,01/01/2025,10:00,SEGUNDA,OUTROS,FEMININO,NI,30,NI,PARDA',
+        'AIS 1,ROUBO,Fortaleza,VIA PUBLICA,data inválida,10:00,SEGUNDA,OUTROS,FEMININO,NI,30,NI,PARDA'
+    ]
+    response = client.post('/api/crimes/append', data={'file': (io.BytesIO('\n'.join(lote).encode('utf-8')), 'lote.csv')},
+                           content_type='multipart/form-data', headers={'X-Append-Token': 'segredo'})
+    assert response.status_code == 200
+    assert response.get_json() == {'appended': 501, 'rejected': 1, 'total': 3501}
+    assert len(list((tmp_path / 'cache').glob('snapshot_crimes_*.pkl'))) == 1
+
+    completo = app_module.processar_dados_crimes()
+    estado = app_module.ESTADO_CRIMES
+    incremental = estado['df_crimes_raw']
+    pd.testing.assert_frame_equal(incremental.astype(str).reset_index(drop=True), completo['df_crimes_raw'].astype(str).reset_index(drop=True))
+    assert estado['LISTA_DE_CRIMES'] == completo['LISTA_DE_CRIMES']
+    pd.testing.assert_frame_equal(estado['MATRIZ_ANO_NATUREZA'].rename(columns=str).sort_index(axis=1),
+                                  completo['MATRIZ_ANO_NATUREZA'].rename(columns=str).sort_index(axis=1), check_names=False)
+    assert estado['crimes_com_pop_ais']['QUANTIDADE'].sum() == completo['crimes_com_pop_ais']['QUANTIDADE'].sum()
+    assert estado['crimes_agrupados_mun']['QUANTIDADE'].sum() == 3501
+
+    filtros = {'dates': {'start': '2019-01-01', 'end': '2024-12-31'},
+               'checkboxes': {'NATUREZA': ['CRIME NOVO', 'FEMINICIDIO'], 'GENERO': ['FEMININO']}}
+    pelo_cubo = app_module.contar_ocorrencias(incremental, filtros, ['MUNICIPIO', 'ANO'], usar_cubo=True)
+    por_varredura = app_module.contar_ocorrencias(incremental, filtros, ['MUNICIPIO', 'ANO'])
+    assert pelo_cubo.to_dict() == por_varredura.to_dict()
+    assert app_module.contar_ocorrencias(incremental, {'dates': {}, 'checkboxes': {}}, ['NATUREZA'], usar_cubo=True)['CRIME NOVO'] == 1
+    indice = estado['indice_bitmap']
+    assert indice['n_linhas'] == 3501 and app_module.obter_indice_bitmap(None, incremental) is indice
+    mascara = app_module.mascara_por_indice(incremental, filtros, indice)
+    assert np.array_equal(mascara, app_module.mascara_por_indice(incremental, filtros, app_module.construir_indice_bitmap(incremental)))
+    assert mascara.sum() == len(app_module.apply_filters(incremental, filtros))
+
+    # Linhas gravadas direto no arquivo (ex.: por outro worker) entram na próxima sincronização
+    with open(tmp_path / 'crimes.csv', 'a', encoding='utf-8') as f:
+        f.write('\n'.join(linhas[3501:3511]) + '\n')
+    monkeypatch.setattr(app_module, 'INTERVALO_SINCRONIZACAO_CRIMES', 0)
+    assert client.get('/api/year_range').status_code == 200
+    assert len(app_module.ESTADO_CRIMES['df_crimes_raw']) == 3511
+    # O estado anterior continua inteiro e coerente para quem já o tinha capturado
+    assert len(estado['df_crimes_raw']) == estado['indice_bitmap']['n_linhas'] == estado['CUBO_CONTAGENS']['contagens'].sum() == 3501
+
+    resposta_invalida = client.post('/api/crimes/append', data={'file': (io.BytesIO(b'A,B\n1,2\n'), 'lote.csv')},
+                                    content_type='multipart/form-data', headers={'X-Append-Token': 'segredo'})
+    assert resposta_invalida.status_code == 400
+
+def test_histograma_com_faixas_configuraveis(client, dashboard_customizado):
+    """NOVO: Testa os métodos de faixas do histograma, as várias colunas em um passe e a equivalência com o np.histogram."""
+    import numpy as np
+    import pandas as pd
+    import app as app_module
+    from app import calcular_histograma, get_dataframe, apply_filters
+    sem_filtros = {'dates': {}, 'checkboxes': {}}
+    idades = pd.to_numeric(apply_filters(get_dataframe(), FILTROS_HOMICIDIO)['IDADE_VITIMA'], errors='coerce').dropna()
+
+    for bins in ['auto', 'fd', 'sturges', 'quantile', 7, [0, 18, 30, 60, 120]]:
+        response = client.post('/api/generic_chart', json={
+            'chartType': 'histogram', 'columnMap': {'numeric_axis': 'IDADE_VITIMA'}, 'filters': FILTROS_HOMICIDIO, 'bins': bins
+        })
+        assert response.status_code == 200
+        dados = response.get_json()
+        contagens = dados['datasets'][0]['data']
+        assert len(dados['labels']) == len(contagens) == len(dados['edges']) - 1
+        assert contagens == np.histogram(idades, bins=dados['edges'])[0].tolist()
+    assert sum(contagens) == ((idades >= 0) & (idades <= 120)).sum()
+
+    # Valores negativos e não inteiros
+    faixas = calcular_histograma(np.array([-3.5, -1.25, 0.0, 2.75, np.nan]), 'sturges')
+    assert faixas['edges'][0] == -3.5 and faixas['edges'][-1] == 2.75 and sum(faixas['data']) == 4
+
+    # Várias colunas do dashboard customizado com um único passe de filtros
+    response = client.post(f'/api/generic_chart?dashboard_id={dashboard_customizado}', json={
+        'chartType': 'histogram', 'columnMap': {'numeric_axis': ['IDADE', 'LATITUDE']}, 'filters': sem_filtros, 'bins': 'quantile', 'bin_count': 2
+    })
+    assert response.status_code == 200
+    histogramas = response.get_json()['histograms']
+    assert [h['column'] for h in histogramas] == ['IDADE', 'LATITUDE']
+    assert histogramas[0]['edges'] == [19.0, 29.0, 40.0] and histogramas[0]['data'] == [2, 2]
+    assert sum(histogramas[1]['data']) == 4
+
+    # Quantis respeitam o teto de faixas e opções inválidas voltam 400
+    faixas = calcular_histograma(np.arange(100000, dtype=float), 'quantile', 10 ** 9)
+    assert len(faixas['data']) == app_module.MAX_FAIXAS_HISTOGRAMA
+    for opcoes in [{'bins': 'quantile', 'bin_count': 'abc'}, {'bins': 'quantile', 'bin_count': 0}, {'bins': 'xyz'},
+                   {'bins': True}, {'bins': -3}, {'bins': [1]}, {'bins': [0, 'a']}, {'bins': {'a': 1}}]:
+        response = client.post('/api/generic_chart', json={
+            'chartType': 'histogram', 'columnMap': {'numeric_axis': 'IDADE_VITIMA'}, 'filters': FILTROS_HOMICIDIO, **opcoes
+        })
+        assert response.status_code == 400, opcoes
+        assert 'error' in response.get_json()
+
+def test_perfil_de_colunas_serve_schema_e_colunas(client, dashboard_customizado, monkeypatch):
+    """NOVO: Testa se /api/schema e /api/columns saem do perfil calculado no upload, sem ler o dataset."""
+    import os
+    import app as app_module
+    metadata = app_module.ler_metadados_dashboard(dashboard_customizado)
+    assert os.path.exists(metadata['profile_path'])
+
+    def sem_leitura(*args, **kwargs):
+        raise AssertionError('o dataset não deveria ser lido')
+    monkeypatch.setattr(app_module, 'get_dataframe', sem_leitura)
+    monkeypatch.setattr(app_module, 'detectar_tipo_coluna', sem_leitura)
+
+    schema = client.get(f'/api/schema?dashboard_id={dashboard_customizado}').get_json()
+    assert schema == {'MUNICIPIO': ['Caucaia', 'Fortaleza', 'Sobral'], 'NATUREZA': ['FURTO', 'ROUBO']}
+
+    colunas = client.get(f'/api/columns?dashboard_id={dashboard_customizado}&details=1').get_json()
+    por_nome = {c['name']: c for c in colunas}
+    assert por_nome['IDADE'] == {'name': 'IDADE', 'type': 'numeric', 'cardinality': 4, 'null_ratio': 0.0, 'min': 19, 'max': 40}
+    assert por_nome['DATA']['type'] == 'date' and por_nome['DATA']['min'].startswith('2020-02-01')
+    assert por_nome['MUNICIPIO']['type'] == 'categorical'
+
+    perfil = app_module.obter_perfil_colunas(dashboard_customizado)
+    assert perfil['colunas']['MUNICIPIO']['counts'] == [1, 2, 1]
+
+def test_espaco_canonico_de_municipios(client):
+    """NOVO: Testa se nomes com acento ou caixa diferentes caem no mesmo id e se AIS e municípios somam o mesmo total."""
+    import pandas as pd
+    import app as app_module
+    espaco = app_module.obter_espaco_municipios()
+    assert len(espaco['populacao']) == len(espaco['ids_geo']) == len(espaco['ais_codigo'])
+    assert (espaco['ais_codigo'] >= 0).all()
+    assert espaco['populacao_ais'].sum() == espaco['populacao'].sum()
+
+    contagens = pd.Series([3, 2, 5, 1], index=['Fortaleza', 'FORTALEZA ', 'sao goncalo do amarante', 'Atlântida'])
+    quantidade = app_module.contagens_por_municipio(espaco, contagens)
+    ids = app_module.ids_municipios(espaco, ['Fortaleza', 'São Gonçalo do Amarante'])
+    assert quantidade[ids[0]] == 5 and quantidade[ids[1]] == 5 and quantidade.sum() == 10
+
+    municipios = client.post('/api/map_data/municipality', json=FILTROS_HOMICIDIO).get_json()
+    ais = client.post('/api/map_data/ais', json=FILTROS_HOMICIDIO).get_json()
+    total = sum(a['QUANTIDADE'] for a in municipios['attributes'].values())
+    assert total > 0 and total == sum(a['QUANTIDADE'] for a in ais['attributes'].values())
+    rankings = sorted(a['ranking'] for a in municipios['attributes'].values())
+    assert rankings == list(range(1, len(rankings) + 1))
+    primeiro = min(municipios['attributes'].values(), key=lambda a: a['ranking'])
+    assert primeiro['TAXA_POR_100K'] == municipios['max_taxa']
+
+def test_previsao_em_lote_equivale_ao_ajuste_por_grupo(client):
+    """NOVO: Testa se a projeção vetorizada bate com projetar_ano_incompleto e com um ajuste linear por janela, em todos os grupos."""
+    import numpy as np
+    import pandas as pd
+    import app as app_module
+    resposta = client.post('/api/forecast', json={})
+    assert resposta.status_code == 200
+    tabela = resposta.get_json()
+    assert tabela['group_by'] == ['MUNICIPIO', 'NATUREZA'] and tabela['windows'] == [1, 5, 10]
+    n = len(tabela['projection'])
+    assert n > 100 and len(tabela['keys']['MUNICIPIO']) == len(tabela['trends']['10']['slope']) == n
+    # A janela de w anos vai de ano_atual - w até ano_atual (limitada aos anos do histórico)
+    assert [tabela['trends'][j]['years'] for j in ['1', '5', '10']] == [1, 5, min(10, len(tabela['years']) - 1)]
+
+    app_module.garantir_dados_crimes()
+    df = app_module.ESTADO_CRIMES['df_crimes_raw']
+    # Colunas em texto: o groupby do projetar_ano_incompleto só vê os grupos que existem
+    historico = pd.DataFrame({
+        'MUNICIPIO': df['MUNICIPIO'].astype(str), 'NATUREZA': df['NATUREZA'].astype(str),
+        'ANO': df['DATA'].dt.year, 'MES': df['DATA'].dt.month
+    }).groupby(['MUNICIPIO', 'NATUREZA', 'ANO', 'MES']).size().rename('TOTAL').reset_index()
+    ano_atual, ultimo_mes = tabela['current_year'], tabela['last_month']
+    projetado = app_module.projetar_ano_incompleto(historico, ano_atual, ultimo_mes, ['MUNICIPIO', 'NATUREZA'])
+    projetado = projetado.set_index(['MUNICIPIO', 'NATUREZA'])['TOTAL']
+    anuais = historico[historico['ANO'] < ano_atual].groupby(['MUNICIPIO', 'NATUREZA', 'ANO'])['TOTAL'].sum()
+
+    for i in range(n):
+        chave = (tabela['keys']['MUNICIPIO'][i], tabela['keys']['NATUREZA'][i])
+        esperado_atual = float(projetado.get(chave, 0.0))
+        assert tabela['projection'][i] == pytest.approx(esperado_atual, abs=0.01)
+        for janela, tendencia in tabela['trends'].items():
+            anos = np.arange(ano_atual - tendencia['years'], ano_atual + 1)
+            serie = [anuais.get(chave + (a,), 0) for a in anos[:-1]] + [esperado_atual]
+            inclinacao, intercepto = np.polyfit(anos, serie, 1)
+            assert tendencia['slope'][i] == pytest.approx(inclinacao, abs=1e-3), janela
+            assert tendencia['next_year'][i] == pytest.approx(max(intercepto + inclinacao * (ano_atual + 1), 0), abs=0.01)
+        # Janela de 1 ano: a inclinação é a variação entre o ano anterior e o corrente projetado
+        assert tabela['trends']['1']['slope'][i] == pytest.approx(esperado_atual - anuais.get(chave + (ano_atual - 1,), 0), abs=1e-3)
+
+    assert client.post('/api/forecast', json={'windows': [0]}).status_code == 400
+    assert client.post('/api/forecast', json={'windows': ['x']}).status_code == 400
+
+def test_lote_de_graficos_com_um_passe_de_filtros(client, dashboard_customizado, monkeypatch):
+    """NOVO: Testa se o /api/batch devolve o mesmo que as rotas individuais, filtrando uma única vez."""
+    import app as app_module
+    graficos = [
+        {'chartType': 'bar', 'columnMap': {'category_axis': 'MUNICIPIO', 'segment_by': 'NATUREZA'}},
+        {'chartType': 'pie', 'columnMap': {'category_axis': 'NATUREZA'}},
+        {'chartType': 'timeseries', 'columnMap': {'time_axis': 'DATA', 'category_axis': 'NATUREZA'}},
+        {'chartType': 'histogram', 'columnMap': {'numeric_axis': 'IDADE'}, 'bins': 'quantile', 'bin_count': 2},
+        {'chartType': 'history', 'municipalities': ['Fortaleza', 'Sobral']},
+        {'chartType': 'map', 'view': 'heatmap'},
+        {'chartType': 'radar', 'columnMap': {}},
+    ]
+    filtros = {'dates': {'start': '2021-01-01'}, 'checkboxes': {}}
+    passes = []
+    mascara_original = app_module.mascara_por_indice
+    monkeypatch.setattr(app_module, 'mascara_por_indice', lambda *args: passes.append(1) or mascara_original(*args))
+
+    for paralelo in [True, False]:
+        passes.clear()
+        response = client.post(f'/api/batch?dashboard_id={dashboard_customizado}', json={'filters': filtros, 'charts': graficos, 'parallel': paralelo})
+        assert response.status_code == 200
+        resultados = response.get_json()['results']
+        assert len(passes) == 1
+        assert [r['status'] for r in resultados] == [200] * 6 + [400]
+
+    for grafico, resultado in zip(graficos[:4], resultados):
+        individual = client.post(f'/api/generic_chart?dashboard_id={dashboard_customizado}', json={**grafico, 'filters': filtros}).get_json()
+        assert resultado['data'] == individual
+    historico = client.post(f'/api/history/municipios?dashboard_id={dashboard_customizado}', json={'municipalities': ['Fortaleza', 'Sobral'], 'filters': filtros})
+    assert resultados[4]['data'] == historico.get_json() and resultados[4]['data']['labels'] == [2021, 2022]
+    assert sorted(resultados[5]['data']) == sorted(client.post(f'/api/map_data/heatmap?dashboard_id={dashboard_customizado}', json=filtros).get_json())
+
+    # Dataset padrão: mapa de municípios e barras saem do cubo, como nas rotas individuais
+    response = client.post('/api/batch', json={'filters': FILTROS_HOMICIDIO, 'charts': [
+        {'chartType': 'map', 'view': 'municipality', 'params': {'zoom': 6}},
+        {'chartType': 'bar', 'columnMap': {'category_axis': 'MUNICIPIO'}},
+    ]})
+    mapa, barras = response.get_json()['results']
+    assert mapa['data'] == client.post('/api/map_data/municipality?zoom=6', json=FILTROS_HOMICIDIO).get_json()
+    assert barras['data'] == client.post('/api/generic_chart', json={'chartType': 'bar', 'columnMap': {'category_axis': 'MUNICIPIO'}, 'filters': FILTROS_HOMICIDIO}).get_json()
+    assert client.post('/api/batch', json={'charts': []}).status_code == 400
+
+    # Worker recém-iniciado (carga sob demanda): o mapa de um dashboard customizado carrega o que precisa
+    monkeypatch.setattr(app_module, 'ESTADO_CRIMES', None)
+    monkeypatch.setattr(app_module, 'ESPACO_MUNICIPIOS', None)
+    sem_ocorrencias = {'dates': {}, 'checkboxes': {'NATUREZA': ['INEXISTENTE']}}
+    response = client.post(f'/api/batch?dashboard_id={dashboard_customizado}', json={'filters': sem_ocorrencias, 'charts': [
+        {'chartType': 'map', 'view': 'municipality'}, {'chartType': 'map', 'view': 'ais'}]})
+    assert [r['status'] for r in response.get_json()['results']] == [200, 200]
+    mapa = response.get_json()['results'][0]['data']
+    assert mapa['attributes'] == {} and mapa['total_municipios'] == int(app_module.obter_espaco_municipios()['tem_populacao'].sum()) > 0
+
+def test_motor_de_agregacao_com_medidas_e_top_k(client, dashboard_customizado):
+    """NOVO: Testa as medidas numéricas, o top-k por eixo com o grupo 'Outros' e o desempate igual ao nlargest."""
+    import numpy as np
+    import pandas as pd
+    from app import maiores_k
+    url = f'/api/generic_chart?dashboard_id={dashboard_customizado}'
+    sem_filtros = {'dates': {}, 'checkboxes': {}}
+
+    def grafico(**config):
+        response = client.post(url, json={'filters': sem_filtros, **config})
+        assert response.status_code == 200
+        return response.get_json()
+
+    media = grafico(chartType='bar', columnMap={'category_axis': 'MUNICIPIO', 'value_axis': 'IDADE'}, aggregation='mean')
+    assert media['labels'] == ['Sobral', 'Fortaleza', 'Caucaia'] and media['datasets'][0]['data'] == [33, 32.5, 19]
+    outros = grafico(chartType='bar', columnMap={'category_axis': 'MUNICIPIO', 'value_axis': 'IDADE'}, aggregation='mean', top_k=1, other=True)
+    assert outros['labels'] == ['Sobral', 'Outros'] and outros['datasets'][0]['data'] == [33, pytest.approx(28)]
+    distintos = grafico(chartType='pie', columnMap={'category_axis': 'MUNICIPIO', 'value_axis': 'NATUREZA'}, aggregation='nunique')
+    assert dict(zip(distintos['labels'], distintos['datasets'][0]['data'])) == {'Fortaleza': 2, 'Sobral': 1, 'Caucaia': 1}
+
+    soma = grafico(chartType='bar', columnMap={'category_axis': 'MUNICIPIO', 'segment_by': 'NATUREZA', 'value_axis': 'IDADE'},
+                   aggregation='sum', top_k=1, segment_top_k=1, other=True)
+    assert soma['labels'] == ['Fortaleza', 'Outros']
+    assert {d['label']: d['data'] for d in soma['datasets']} == {'FURTO': [40, 19], 'Outros': [25, 33]}
+    mediana = grafico(chartType='timeseries', columnMap={'time_axis': 'DATA', 'category_axis': 'NATUREZA', 'value_axis': 'IDADE'}, aggregation='median')
+    assert mediana['labels'] == ['2020', '2021', '2022']
+    assert {d['label']: d['data'] for d in mediana['datasets']} == {'ROUBO': [25, 33, None], 'FURTO': [None, 40, 19]}
+    assert client.post(url, json={'chartType': 'bar', 'columnMap': {'category_axis': 'MUNICIPIO'}, 'filters': sem_filtros, 'aggregation': 'moda'}).status_code == 400
+
+    # Séries temporais: categorias que cabem no top-k ficam na ordem natural; acima dele, pela contagem
+    def series(coluna):
+        dados = client.post('/api/generic_chart', json={'chartType': 'timeseries', 'columnMap': {'time_axis': 'DATA', 'category_axis': coluna},
+                                                        'filters': FILTROS_HOMICIDIO}).get_json()['datasets']
+        return [d['label'] for d in dados], [sum(v for v in d['data'] if v) for d in dados]
+    rotulos, _ = series('GENERO')
+    assert len(rotulos) <= 10 and rotulos == sorted(rotulos)
+    rotulos, totais = series('MUNICIPIO')
+    assert len(rotulos) == 10 and totais == sorted(totais, reverse=True)
+
+    # Coluna de alta cardinalidade com 'Outros': nada se perde na soma
+    contagens = client.post('/api/generic_chart', json={'chartType': 'bar', 'columnMap': {'category_axis': 'LOCAL'}, 'filters': FILTROS_HOMICIDIO, 'top_k': 5, 'other': True}).get_json()
+    completo = client.post('/api/generic_chart', json={'chartType': 'bar', 'columnMap': {'category_axis': 'LOCAL'}, 'filters': FILTROS_HOMICIDIO, 'top_k': 1000}).get_json()
+    assert len(contagens['labels']) <= 6 and sum(contagens['datasets'][0]['data']) == sum(completo['datasets'][0]['data'])
+
+    totais = np.array([5, 9, 5, 1, 9, 5, 2])
+    for k in range(len(totais) + 1):
+        assert maiores_k(totais, k).tolist() == pd.Series(totais).nlargest(k).index.tolist()